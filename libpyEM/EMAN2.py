@@ -62,6 +62,7 @@ import traceback
 from pathlib import Path
 
 import threading
+import mmap
 #from Sparx import *
 
 ### If we ever need to add 'cleanup' exit code, this is how to do it. Drawn from the old BDB code.
@@ -2462,18 +2463,24 @@ The file begins with
 number<\t>filename<\t>comment
 ...
 """
-	def __init__(self,path,ifexists=False, comments=""):
+	def __init__(self,path,ifexists=False, comments="", usemmap=False, readonly=False):
 		"""Initialize the object using the .lst file in 'path'. If 'ifexists' is set, an exception will be raised
-if the lst file does not exist."""
+if the lst file does not exist. If 'usemmap' is set, records are read through a read-only memory map of the file,
+which avoids a seek and buffered read per record, but the map is dropped on the first write. If 'readonly' is set
+the file is opened for reading only, and must exist. For read-only access to many records, see LSXFile.cached()."""
 
 		self.path=path
+		self.mm=None
+		self.sidecar_checked=False
+		self.readonly=readonly
+		self.mode="r" if readonly else "r+"
 		if len(comments)==0:
-			comments="# This file is in fast LST format. All lines after the next line have exactly the number of characters shown on the next line. This MUST be preserved if editing."
+			comments=LSXFile.defcomment
 
 		if os.path.isfile(path):
-			self.ptr=open(path,"r+")		# file exists
+			self.ptr=open(path,self.mode)		# file exists
 		else:
-			if ifexists: raise Exception("Error: lst file {} does not exist".format(path))
+			if ifexists or readonly: raise Exception("Error: lst file {} does not exist".format(path))
 
 			try: os.makedirs(os.path.dirname(path))
 			except: pass
@@ -2515,9 +2522,10 @@ if the lst file does not exist."""
 				self.seekbase=newseekbase
 
 				# rename the temporary file over the original
+				LSXFile.uncache(self.path)
 				os.unlink(self.path)
 				os.rename(self.path+".tmp",self.path)
-				self.ptr=open(self.path,"r+")
+				self.ptr=open(self.path,self.mode)
 				self.ptr.readline()
 
 			else: raise Exception("ERROR: The file {} is not in #LSX format".format(self.path))
@@ -2534,10 +2542,51 @@ if the lst file does not exist."""
 			self.filekeys=self.filecomment[7:].split(';')
 		else: self.filekeys=None
 
-		# potentially time consuming, but this also gives us self.n
-		self.normalize()
+		# with fixed length records the number of records follows from the file size. Only if that doesn't
+		# work out do we need to read the whole file to fix it
+		if not self.check_size(): self.normalize()
 		self.lock=threading.Lock()
 
+		if usemmap and self.n>0:
+			self.mm=mmap.mmap(self.ptr.fileno(),0,access=mmap.ACCESS_READ)
+
+	defcomment="# This file is in fast LST format. All lines after the next line have exactly the number of characters shown on the next line. This MUST be preserved if editing."
+
+	# process-wide cache of open read-only LSXFile objects, see cached()
+	cache=OrderedDict()
+	cachelock=threading.Lock()
+	cachemax=16
+
+	@classmethod
+	def cached(cls,path):
+		"""Returns a memory-mapped, read-only LSXFile for reading 'path', reusing a previously opened object unless the file
+has been modified since, or written through LSXFile or LSXWriter in this process. db_read_image reads a single record
+per call, so opening the file each time was a large overhead. The returned object is shared, and must not be closed."""
+		st=os.stat(path)
+		key=(os.path.abspath(path),st.st_mtime_ns,st.st_size)
+		with cls.cachelock:
+			try:
+				lsx=cls.cache.pop(key)
+				cls.cache[key]=lsx
+				return lsx
+			except KeyError: pass
+
+		lsx=cls(path,True,usemmap=True,readonly=True)
+		with cls.cachelock:
+			# stale versions of the same file are useless
+			for k in [k for k in cls.cache if k[0]==key[0]]: del cls.cache[k]
+			cls.cache[key]=lsx
+			while len(cls.cache)>cls.cachemax: cls.cache.popitem(last=False)
+		return lsx
+
+	@classmethod
+	def uncache(cls,path):
+		"""Drops any cached reader for 'path'. Called before the file is modified, so cached() can't return stale records
+(the modification time may not change for a same-size rewrite), and so no open handle prevents replacing the file on Windows."""
+		path=os.path.abspath(path)
+		with cls.cachelock:
+			for k in [k for k in cls.cache if k[0]==path]: del cls.cache[k]
+
 	def __del__(self):
 		self.close()
 
@@ -2550,8 +2599,11 @@ if the lst file does not exist."""
 
 	def close(self):
 		"""Once you call this, you should not try to access this object any more"""
+		if self.mm!=None :
+			self.mm.close()
+			self.mm=None
 		if self.ptr!=None :
-			self.normalize()
+			if not self.readonly and not self.check_size(): self.normalize()
 			self.ptr=None
 
 	def write(self,n,nextfile,extfile,jsondict=None):
@@ -2563,17 +2615,8 @@ jsondict : optional string in JSON format or a JSON compatible dictionary. value
 """
 
 		self.lock.acquire()
-		if jsondict==None : 
-			outln="{}\t{}".format(nextfile,extfile)
-		elif isinstance(jsondict,str) and jsondict[0]=="{" and jsondict[-1]=='}' : 
-			outln="{}\t{}\t{}".format(nextfile,extfile,jsondict)
-		else:
-			if not isinstance(jsondict,dict) and jsondict!=None: 
-				jsondict={"__default__":jsondict}
-			if jsondict!=None:
-				jss=json.dumps(jsondict,indent=None,sort_keys=True,separators=(',',':'),default=EMAN2jsondb.obj_to_json)			
-				outln="{}\t{}\t{}".format(nextfile,extfile,jss)
-			else: outln="{}\t{}".format(nextfile,extfile)
+		self.prepare_write()
+		outln=LSXFile.format_line(nextfile,extfile,jsondict)
 			
 		# We can't write in the middle of the file if the existing linelength is too short
 		if len(outln)+1>self.linelen : self.rewrite(len(outln))
@@ -2590,16 +2633,71 @@ jsondict : optional string in JSON format or a JSON compatible dictionary. value
 		self.ptr.write(outln)
 		self.lock.release()
 
+	def write_many(self,records):
+		"""Appends a list of (nextfile,extfile,jsondict) records (jsondict optional) to the file. Unlike calling write()
+repeatedly, the file is rewritten at most once, for the longest record, and all records are written with a single call."""
+		lines=[LSXFile.format_line(*r) for r in records]
+		if len(lines)==0 : return
+
+		self.lock.acquire()
+		self.prepare_write()
+		maxlen=max(len(l) for l in lines)
+		if maxlen+1>self.linelen : self.rewrite(maxlen)
+
+		fmtstr="{{:<{}}}\n".format(self.linelen-1)
+		self.ptr.seek(0,os.SEEK_END)
+		self.ptr.write("".join(fmtstr.format(l) for l in lines))
+		self.n+=len(lines)
+		self.lock.release()
+
+	def prepare_write(self):
+		"""Called with the lock held before modifying the file"""
+		if self.readonly :
+			self.lock.release()
+			raise Exception("Error: lst file {} was opened read-only".format(self.path))
+		LSXFile.uncache(self.path)
+		if self.mm!=None :
+			self.mm.close()
+			self.mm=None
+		if not self.sidecar_checked :
+			# any binary sidecar (see save_lst_params) no longer matches the file
+			try: os.unlink(lst_sidecar_path(self.path))
+			except: pass
+			self.sidecar_checked=True
+
+	@staticmethod
+	def format_line(nextfile,extfile,jsondict=None):
+		"""Returns the unpadded text of a single record"""
+		if jsondict==None : 
+			outln="{}\t{}".format(nextfile,extfile)
+		elif isinstance(jsondict,str) and jsondict[0]=="{" and jsondict[-1]=='}' : 
+			outln="{}\t{}\t{}".format(nextfile,extfile,jsondict)
+		else:
+			if not isinstance(jsondict,dict) and jsondict!=None: 
+				jsondict={"__default__":jsondict}
+			if jsondict!=None:
+				jss=json.dumps(jsondict,indent=None,sort_keys=True,separators=(',',':'),default=EMAN2jsondb.obj_to_json)			
+				outln="{}\t{}\t{}".format(nextfile,extfile,jss)
+			else: outln="{}\t{}".format(nextfile,extfile)
+		return outln
+
 	def read(self,n):
 		"""Reads the nth record in the file. Note that this does not read the referenced image, which can be
 performed with read_image either here or in the EMData class. Returns a tuple (n extfile,extfile,dict). dict
 contains decoded information from the stored JSON dictionary. Will also read certain other legacy comments
 and translate them into a dictionary."""
 		if n>=self.n : raise IndexError("Attempt to read record {} from #LSX {} with {} records".format(n,self.path,self.n))
-		self.lock.acquire()
 		n=int(n)
-		self.ptr.seek(self.seekbase+self.linelen*n)
-		ln=self.ptr.readline().strip().split("\t")
+		mm=self.mm
+		if mm!=None :
+			# slicing the map doesn't depend on a shared file position
+			loc=self.seekbase+self.linelen*n
+			ln=mm[loc:loc+self.linelen].decode("utf-8").strip().split("\t")
+			self.lock.acquire()
+		else:
+			self.lock.acquire()
+			self.ptr.seek(self.seekbase+self.linelen*n)
+			ln=self.ptr.readline().strip().split("\t")
 		if len(ln)==2 : ln.append("")
 		try: ln[0]=int(ln[0])
 		except:
@@ -2701,6 +2799,19 @@ but this method prevents multiple open/close operations on the #LSX file."""
 
 	def __len__(self): return self.n
 
+	def check_size(self):
+		"""Sets self.n from the file size, without reading the file. Returns False if the size isn't consistent
+with the line length, in which case normalize() must be used."""
+		self.ptr.seek(0,os.SEEK_END)
+		size=self.ptr.tell()-self.seekbase
+		if size%self.linelen!=0 : return False
+		self.n=size//self.linelen
+		if self.n==0 : return True
+
+		# cheap sanity check that the last record is where we expect it
+		self.ptr.seek(self.seekbase+self.linelen*(self.n-1))
+		return len(self.ptr.readline())==self.linelen
+
 	def normalize(self):
 		"""This will read the entire file and insure that the line-length parameter is valid. If it is not,
 it will rewrite the file with a valid line-length. """
@@ -2753,12 +2864,56 @@ line length. Used when a line must be added in the middle of the file."""
 		self.seekbase=newseekbase
 
 		# rename the temporary file over the original
+		LSXFile.uncache(self.path)
 		os.unlink(self.path)
 		os.rename(self.path+".tmp",self.path)
-		self.ptr=open(self.path,"r+")
+		self.ptr=open(self.path,self.mode)
 
 #		print "rewrite ",self.linelen
 
+class LSXWriter(object):
+	"""Writes a complete new #LSX file in a single pass. Records are collected in memory, and when the writer is
+closed (or the with block exits without an exception) the line length is computed once, the file is written
+to a temporary name, and then atomically renamed over 'path'. Readers never see a partially written file.
+
+with LSXWriter("sets/ptcls.lst") as out:
+	for i in range(n): out.write(i,"particles/ptcls.hdf",{"score":scores[i]})
+"""
+	def __init__(self,path,comments=""):
+		self.path=path
+		self.comments=comments if len(comments)>0 else LSXFile.defcomment
+		self.lines=[]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,exc_type,exc_value,tb):
+		if exc_type is None : self.close()
+		else : self.lines=None
+
+	def write(self,nextfile,extfile,jsondict=None):
+		"""Adds a record to the end of the file. Same arguments as LSXFile.write(), without the record number."""
+		self.lines.append(LSXFile.format_line(nextfile,extfile,jsondict))
+
+	def close(self):
+		"""Writes the file. Once you call this, you should not try to write any more records"""
+		if self.lines is None : return
+
+		linelen=max([len(l) for l in self.lines]+[15])+1+4		# 4 characters of slack, as in LSXFile.rewrite()
+		fmtstr="{{:<{}}}\n".format(linelen-1)
+
+		try: os.makedirs(os.path.dirname(self.path))
+		except: pass
+		with open(self.path+".tmp","w") as out:
+			out.write("#LSX\n{}\n# {}\n".format(self.comments,linelen))
+			out.write("".join(fmtstr.format(l) for l in self.lines))
+		LSXFile.uncache(self.path)
+		os.replace(self.path+".tmp",self.path)
+		self.lines=None
+
+		try: os.unlink(lst_sidecar_path(self.path))
+		except: pass
+
 def image_eosplit(filename):
 	"""This will take an input image stack in LSX or normal image format and produce output .lst (LSX)
 files corresponding to even and odd numbered particles. It will return a tuple with two filenames
@@ -2812,27 +2967,41 @@ corresponding to each 1/2 of the data."""
 
 	return (eset,oset)
 
-def save_lst_params(lst,fsp, overwrite=True):
+def save_lst_params(lst,fsp, overwrite=True, sidecar=False):
 	"""Saves a LSX file (fsp) with metadata represented by a list of dictionaries (lst).
 	each dictionary must contain 'src', the image file containing the actual image and
 	'idx' the index in that file. Additional keys will be stored in the LSX metadata
-	region. Overwrite existing file by default."""
+	region. Overwrite existing file by default. If sidecar is set, a binary columnar copy
+	of the metadata is also written (see load_lst_arrays), which load_lst_params will use
+	as long as the LSX file is unchanged."""
 	if len(lst)==0: raise(Exception,"ERROR: save_lst_params with empty list")
 	
-	if overwrite:
-		if os.path.isfile(fsp):
-			os.remove(fsp)
-	
-	lsx=LSXFile(fsp)
+	records=[]
 	for d in lst:
 		dct=d.copy()
 		p=dct.pop("src")
 		n=dct.pop("idx")
-		lsx.write(-1,n,p,dct)
+		records.append((n,p,dct))
+
+	if overwrite or not os.path.isfile(fsp):
+		with LSXWriter(fsp) as out:
+			for r in records: out.write(*r)
+		if sidecar: save_lst_sidecar(fsp,lst_params_to_arrays(lst))
+	else:
+		lsx=LSXFile(fsp)
+		lsx.write_many(records)		# this also removes any existing sidecar
+		lsx.close()
+		lsx=None
+		# the sidecar must describe the whole file, not just the records we appended
+		if sidecar: save_lst_sidecar(fsp,lst_params_to_arrays(load_lst_params(fsp)))
 
 def load_lst_params(fsp , imgns=None):
 	"""Reads the metadata for all of the images in an LSX file (fsp) with an optional list of
 	image numbers (imgns, iterable or None)"""
+	cols=load_lst_sidecar(fsp)
+	if cols is not None:
+		return arrays_to_lst_params(cols,imgns)
+
 	lsx=LSXFile(fsp,True)
 	if imgns==None or len(imgns)==0: imgns=range(lsx.n)
 	
@@ -2842,6 +3011,113 @@ def load_lst_params(fsp , imgns=None):
 		ret.append({"idx":n,"src":p,**d})
 		
 	return ret
+
+def load_lst_arrays(fsp, sidecar=True):
+	"""Reads the metadata for all of the images in an LSX file (fsp) as a dictionary of NumPy arrays
+	rather than a list of dictionaries. See lst_params_to_arrays() for the layout. If the file has an
+	up to date binary sidecar it is used directly, otherwise the file is parsed, and if sidecar is set
+	a sidecar is written so the next call is fast."""
+	cols=load_lst_sidecar(fsp)
+	if cols is not None: return cols
+
+	cols=lst_params_to_arrays(load_lst_params(fsp))
+	if sidecar: save_lst_sidecar(fsp,cols)
+	return cols
+
+def lst_params_to_arrays(lst):
+	"""Converts a list of metadata dictionaries, as used by load_lst_params/save_lst_params, into a
+	dictionary of NumPy arrays with one element (or row) per image:
+	'idx' - int array
+	'src' - str array
+	int/bool/float values - array of that type. If the key is missing for some images, a bool array
+		'has:<key>' marks the images where it is present
+	Transform values - (N,12) float array of the 3x4 matrices (see Transform.get_matrix)
+	anything else - str array of the values in JSON format"""
+	import numpy as np
+
+	n=len(lst)
+	cols={"idx":np.array([d["idx"] for d in lst],dtype=np.int64), "src":np.array([d["src"] for d in lst],dtype=str)}
+
+	keys=set()
+	for d in lst: keys.update(d.keys())
+	keys-={"idx","src"}
+
+	for k in sorted(keys):
+		has=np.array([k in d for d in lst],dtype=bool)
+		vals=[d[k] for d in lst if k in d]
+		if all(isinstance(v,bool) for v in vals): dtype=bool
+		elif all(isinstance(v,int) and not isinstance(v,bool) for v in vals): dtype=np.int64
+		elif all(isinstance(v,float) for v in vals): dtype=np.float64
+		elif all(isinstance(v,Transform) for v in vals): dtype="xform"
+		else: dtype=str
+
+		if dtype=="xform":
+			col=np.zeros((n,12))
+			col[has]=[v.get_matrix() for v in vals]
+		elif dtype==str:
+			col=np.array([json.dumps(d[k],sort_keys=True,default=EMAN2jsondb.obj_to_json) if k in d else "" for d in lst],dtype=str)
+		else:
+			col=np.zeros(n,dtype=dtype)
+			col[has]=vals
+
+		cols[k]=col
+		if not has.all(): cols["has:"+k]=has
+
+	return cols
+
+def arrays_to_lst_params(cols,imgns=None):
+	"""The inverse of lst_params_to_arrays, optionally for only the images in imgns"""
+	n=len(cols["idx"])
+	if imgns is None or len(imgns)==0: imgns=range(n)
+
+	# decide how to decode each column once, rather than for every image
+	keys=[]
+	for k in cols:
+		if k in ("idx","src") or k.startswith("has:") : continue
+		col=cols[k]
+		if len(col.shape)==2 : conv=lambda v: Transform(v.tolist())
+		elif col.dtype.kind=="U" : conv=lambda v: json.loads(str(v),object_hook=EMAN2jsondb.json_to_obj)
+		else : conv=lambda v: v.item()
+		keys.append((k,col,cols.get("has:"+k),conv))
+
+	ret=[]
+	for i in imgns:
+		d={"idx":int(cols["idx"][i]),"src":str(cols["src"][i])}
+		for k,col,has,conv in keys:
+			if has is None or has[i] : d[k]=conv(col[i])
+		ret.append(d)
+
+	return ret
+
+def lst_sidecar_path(fsp):
+	"""Path of the binary metadata sidecar for an LSX file"""
+	return fsp+".npz"
+
+def save_lst_sidecar(fsp,cols):
+	"""Writes the arrays from lst_params_to_arrays next to LSX file fsp, stamped with the current
+	size and modification time of fsp, so it can be recognized as stale if fsp changes"""
+	import numpy as np
+	st=os.stat(fsp)
+	out=lst_sidecar_path(fsp)
+	with open(out+".tmp","wb") as f:
+		np.savez(f,__lst_stamp__=np.array([st.st_size,st.st_mtime_ns],dtype=np.int64),**cols)
+	os.replace(out+".tmp",out)
+
+def load_lst_sidecar(fsp):
+	"""Returns the arrays stored in the sidecar of LSX file fsp, or None if there is no sidecar,
+	or it doesn't match the current LSX file"""
+	sc=lst_sidecar_path(fsp)
+	if not os.path.isfile(sc) : return None
+
+	import numpy as np
+	try:
+		st=os.stat(fsp)
+		with np.load(sc) as npz:
+			stamp=npz["__lst_stamp__"]
+			if stamp[0]!=st.st_size or stamp[1]!=st.st_mtime_ns : return None
+			return {k:npz[k] for k in npz.files if k!="__lst_stamp__"}
+	except:
+		return None
 	
 ##########
 #### replace a few EMData methods with python versions to intercept 'bdb:' filenames
@@ -2932,7 +3208,7 @@ def db_read_image(self, fsp, *parms, **kparms):
 		print("ERROR: BDB is not supported in this version of EMAN2. You must use EMAN2.91 or earlier to access legacy data.")
 		return None
 	if fsp[-4:].lower()==".lst":
-		return LSXFile(fsp).read_into_image(self,*parms)
+		return LSXFile.cached(fsp).read_into_image(self,*parms)
 		#global lsxcache
 		#if lsxcache==None or lsxcache.path!=fsp: lsxcache=LSXFile(fsp,True)
 		#return lsxcache.read_image(parms[0])
@@ -2976,7 +3252,7 @@ def db_read_images(fsp, *parms):
 		return []
 
 	if fsp[-4:].lower()==".lst":
-		return LSXFile(fsp).read_images(*parms)
+		return LSXFile.cached(fsp).read_images(*parms)
 		#global lsxcache
 		#if lsxcache==None or lsxcache.path!=fsp: lsxcache=LSXFile(fsp,True)
 		#return lsxcache.read_images(*parms)
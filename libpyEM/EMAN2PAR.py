@@ -38,11 +38,11 @@ standard_library.install_aliases()
 from builtins import range
 from builtins import object
 
-import sys, os, getpass, socket, subprocess, threading, time,select,shutil, traceback, random,_thread, queue
+import sys, os, getpass, socket, subprocess, threading, time,select,shutil, traceback, random,_thread, queue, multiprocessing, hashlib, collections
 from pickle import dumps,loads,dump,load
 
 from EMAN2jsondb import JSTask,JSTaskQueue,js_open_dict
-from EMAN2 import test_image,EMData,abs_path,local_datetime,EMUtil,Util,get_platform, e2getinstalldir
+from EMAN2 import test_image,EMData,EMNumPy,abs_path,local_datetime,EMUtil,Util,get_platform, e2getinstalldir
 
 # If we can't import it then we probably won't be trying to use MPI
 try :
@@ -70,18 +70,102 @@ EMAN2PARVER=14
 # This is the maximum number of active server threads before telling clients to wait
 DCMAXTHREADS=7
 
+def load_module(module):
+	"""Imports the JSTask subclass specified as 'file.Class' (as passed to EMTaskCustomer(module=)) and
+	makes it visible in __main__ so pickled tasks can be reconstructed in a worker process. Any other
+	JSTask subclasses defined in the same file (eg - merge tasks for tree_reduce) are made visible as well."""
+	fname, cls=module.split('.')
+	sys.path.append(os.path.join(e2getinstalldir(),"bin"))
+	mod=__import__(fname, fromlist=[cls])
+	for k,v in list(vars(mod).items()):
+		if isinstance(v,type) and issubclass(v,JSTask) and v.__module__==mod.__name__ : setattr(sys.modules["__main__"], k, v)
+	setattr(sys.modules["__main__"], cls, getattr(mod,cls))
+
+
+class EMTaskJournal(object):
+	"""A persistent record of the results of completed tasks, stored as one pickle per task in a directory.
+	Tasks are identified by a hash of their command, data and options, and of the size and modification
+	time of every file they name, so a rerun of the same program on the same inputs will find the results
+	of tasks which completed before the previous run was interrupted, even if the tasks are submitted in a
+	different order, while a change to an option or a rebuilt reference invalidates them. Used by
+	EMTaskCustomer(journal=)."""
+	# options which don't affect the results of a task, so they may differ in a resumed run
+	ignore=("parallel","threads","retries","resume","verbose","ppid","minchunk")
+
+	def __init__(self,path,resume=True,ignore=()):
+		"""If resume is False, any existing journal at path is discarded. ignore lists additional option
+		names which should not invalidate journaled results (eg - a timestamp)."""
+		self.path=path
+		self.ignore=EMTaskJournal.ignore+tuple(ignore)
+		if not resume: shutil.rmtree(path,True)
+		try: os.makedirs(path)
+		except: pass
 
+	def key(self,task):
+		options=task.options
+		if options is None : options={}
+		elif not isinstance(options,dict) : options=vars(options)		# argparse Namespace
+		options=sorted([(k,v) for k,v in options.items() if k not in self.ignore],key=lambda x:x[0])
+		files={}
+		self.find_files((task.data,options),files)
+		return hashlib.sha1(dumps((task.command,task.data,options,sorted(files.items())),-1)).hexdigest()
+
+	def find_files(self,obj,files):
+		"""Records (size,mtime) in files for every string in obj (recursively) naming an existing file"""
+		if isinstance(obj,str):
+			if obj in files : return
+			try:
+				st=os.stat(obj)
+				files[obj]=(st.st_size,st.st_mtime) if os.path.isfile(obj) else None
+			except: files[obj]=None
+		elif isinstance(obj,dict):
+			for k,v in obj.items():
+				self.find_files(k,files)
+				self.find_files(v,files)
+		elif isinstance(obj,(list,tuple)):
+			for v in obj: self.find_files(v,files)
+
+	def get(self,key):
+		"""Returns the recorded results for key, or None"""
+		try: return load(open(os.path.join(self.path,key),"rb"))
+		except: return None
+
+	def put(self,key,results):
+		# write then rename, so an interrupted write can't leave a truncated entry behind
+		fsp=os.path.join(self.path,key)
+		dump(results,open(fsp+".tmp","wb"),-1)
+		os.rename(fsp+".tmp",fsp)
+
+	def clear(self):
+		"""Removes the journal. Call once the results of the whole run have been saved."""
+		shutil.rmtree(self.path,True)
+
+class MapItemsPieces(list):
+	"""Journal record for a map_items chunk which was completed as several smaller pieces. A list of
+	(chunk,results) pairs, one per piece."""
+	pass
 
 class EMTaskCustomer(object):
 	"""This will communicate with the specified task server on behalf of an application needing to
 	have tasks completed"""
-	def __init__(self,target,module=""):
+	def __init__(self,target,module="",retries=0,journal=None):
 		"""Specify the type and target host of the parallelism server to use.
 	dc[:hostname[:port]] - default hostname localhost, default port 9990
 	thread:nthreads[:scratch_dir]
+	pool:nproc
 	mpi:ncpu[:scratch_dir_on_nodes]
+
+	retries is the number of times a failed task will be rerun before giving up. If journal is an
+	EMTaskJournal, the results of each task are recorded there as they are retrieved, and tasks
+	already recorded are not run again.
 	"""
 		origtarget=target
+		self.retries=retries
+		self.journal=journal
+		self.journaled={}		# key is a (negative) taskid for a task found in the journal, value is (task,results)
+		self.njournaled=0
+		self.taskkeys={}		# key is handler taskid, value is the journal key of the task
+		self.abandoned=[]		# cancelled tasks the handler couldn't stop, whose results are discarded as they complete
 		#target=target.lower()
 		self.servtype=target.split(":")[0]
 		self.servtype=self.servtype.replace("threads","thread")
@@ -92,11 +176,16 @@ class EMTaskCustomer(object):
 			self.maxthreads=int(target.split(":")[1])
 			try: self.scratchdir=target.split(":")[2]
 			except: self.scratchdir="/tmp"
-			self.handler=EMLocalTaskHandler(self.maxthreads,self.scratchdir, module)
+			self.handler=EMLocalTaskHandler(self.maxthreads,self.scratchdir, module, retries)
 		elif self.servtype=="thread_sm":
 			self.maxthreads=int(target.split(":")[1])
-			self.handler=EMSharedMemoryLocalTaskHandler(self.maxthreads)
-		
+			self.handler=EMSharedMemoryLocalTaskHandler(self.maxthreads, retries)
+
+		elif self.servtype=="pool":
+			self.groupn=0
+			self.maxthreads=int(target.split(":")[1])
+			self.handler=EMPoolTaskHandler(self.maxthreads,module,retries)
+
 		elif self.servtype=="mpi":
 			tsplit=origtarget.split(":")
 			self.maxthreads=int(tsplit[1])
@@ -105,8 +194,8 @@ class EMTaskCustomer(object):
 			
 			try: self.usethreads=int(tsplit[3])+1
 			except: self.usethreads=self.maxthreads
-			self.handler=EMMpiTaskHandler(self.maxthreads,self.scratchdir, module, self.usethreads)
-		else : raise Exception("Only 'thread' and 'mpi' servertypes currently supported")
+			self.handler=EMMpiTaskHandler(self.maxthreads,self.scratchdir, module, self.usethreads, retries)
+		else : raise Exception("Only 'thread', 'pool' and 'mpi' servertypes currently supported")
 
 	def __del__(self):
 		#if self.servtype=="thread" :
@@ -159,14 +248,9 @@ class EMTaskCustomer(object):
 
 	def send_tasks(self,tasks):
 		"""Send a group of tasks to the server. Returns a list of taskids."""
-		ret=[]
-
-		for task in tasks:
-			try: task.user=getpass.getuser()
-			except: task.user="anyone"
 
 		#if self.servtype in ("thread","mpi"):
-		return [self.handler.add_task(t) for t in tasks]
+		return [self.send_task(t) for t in tasks]
 
 
 		#raise Exception("Unknown server type")
@@ -177,6 +261,21 @@ class EMTaskCustomer(object):
 		try: task.user=getpass.getuser()
 		except: task.user="anyone"
 
+		if len(self.abandoned)>0 : self.collect_abandoned()
+
+		if self.journal is not None:
+			key=self.journal.key(task)
+			results=self.journal.get(key)
+			if results is not None:
+				# already completed in a previous run, so we never send it to the handler
+				self.njournaled+=1
+				self.journaled[-self.njournaled]=(task,results)
+				return -self.njournaled
+
+			taskid=self.handler.add_task(task)
+			self.taskkeys[taskid]=key
+			return taskid
+
 		#if self.servtype in ("thread","mpi"):
 		return self.handler.add_task(task)
 
@@ -186,15 +285,239 @@ class EMTaskCustomer(object):
 		"""Check on the status of a list of tasks. Returns a list of ints, -1 to 100. -1 for a task
 		that hasn't been started. 0-99 for tasks that have begun, but not completed. 100 for completed tasks."""
 		#if self.servtype in ("thread","mpi") :
-		return self.handler.check_task(taskid_list)
+		if len(self.journaled)==0 : return self.handler.check_task(taskid_list)
+
+		tids=[i for i in taskid_list if i not in self.journaled]
+		st=iter(self.handler.check_task(tids) if len(tids)>0 else [])
+		return [100 if i in self.journaled else next(st) for i in taskid_list]
 
 		#raise Exception("Unknown server type")
 
 	def get_results(self,taskid,retry=True):
 		"""Get the results for a completed task. Returns a tuple (task object,dictionary}."""
 
+		if taskid in self.journaled : return self.journaled.pop(taskid)
+
 		#if self.servtype in ("thread","mpi") :
-		return self.handler.get_results(taskid)
+		ret=self.handler.get_results(taskid)
+		if ret is not None and taskid in self.taskkeys:
+			self.journal.put(self.taskkeys.pop(taskid),ret[1])
+		return ret
+
+	def cancel_tasks(self,taskid_list):
+		"""Tells the server that the results of these tasks are no longer needed. Handlers which support it
+		drop the tasks if they haven't started and discard their results if they have. Otherwise the tasks
+		run to completion and their results are retrieved and discarded later, so no state is left behind
+		on the server either way."""
+		for tid in taskid_list:
+			if tid in self.journaled:
+				del self.journaled[tid]
+				continue
+			self.taskkeys.pop(tid,None)
+			if hasattr(self.handler,"cancel_task") and self.handler.cancel_task(tid) : continue
+			self.abandoned.append(tid)
+		self.collect_abandoned()
+
+	def collect_abandoned(self):
+		"""Retrieves and discards the results of cancelled tasks which have finished since the last call"""
+		st_vals=self.handler.check_task(self.abandoned)
+		keep=[]
+		for tid,st in zip(self.abandoned,st_vals):
+			if st==100:
+				try: self.handler.get_results(tid)
+				except: pass
+			elif st!=-100 : keep.append(tid)
+		self.abandoned=keep
+
+	def wait_tasks(self,taskid_list,timeout=None):
+		"""Blocks until at least one task in the list has completed (or failed), or timeout seconds
+		have passed. Returns the same status list as check_task."""
+		if any(i in self.journaled for i in taskid_list) : return self.check_task(taskid_list)
+		return self.handler.wait_tasks(taskid_list,timeout)
+
+	def as_completed(self,taskid_list,progress=None):
+		"""Generator yielding (taskid,task,results) for each task in the list as soon as it completes,
+		in completion order rather than submission order. Results are retrieved (and cleaned up on the
+		server) as they are yielded, so the caller only needs to hold results it hasn't consumed yet.
+		If provided, progress is called with the mean fractional completion (0-1) of the list whenever
+		the status changes. Raises an Exception if any task fails."""
+		pending=list(taskid_list)
+		ntask=len(pending)
+		ndone=0
+		while len(pending)>0:
+			st_vals=self.wait_tasks(pending,30.0)
+			if -100 in st_vals:
+				raise Exception("Error executing task {}".format(pending[st_vals.index(-100)]))
+
+			done=[tid for tid,st in zip(pending,st_vals) if st==100]
+			if progress is not None:
+				progress((ndone*100.0+sum([max(st,0) for st in st_vals]))/(ntask*100.0))
+
+			pending=[tid for tid,st in zip(pending,st_vals) if st!=100]
+			for tid in done:
+				ndone+=1
+				task,results=self.get_results(tid)
+				yield (tid,task,results)
+
+	def map_items(self,items,taskfn,minchunk=1,steal=True,progress=None):
+		"""Dynamic alternative to statically splitting work into cpu_est() tasks. items is a list of
+		fine-grained work items, and taskfn(chunk) must return a JSTask which processes the sub-list
+		chunk. Chunks are handed out as workers become free, with sizes shrinking as the remaining
+		work does (guided self-scheduling: remaining/(2*ncpu), but at least minchunk), so the end of
+		the run is made of small chunks. If steal is set, once all items are handed out, idle workers
+		take over the items of a straggling chunk by splitting it into smaller chunks. Whichever
+		finishes first, the original chunk or all of its pieces, provides the results, so each item
+		is reported exactly once. Yields (chunk,results) as each chunk completes, in completion order.
+		Chunk boundaries depend only on the number of items, cpu_est() and minchunk, and chunks completed as
+		pieces are journaled as a whole, so with a journal a rerun with the same parallelism finds all of
+		the chunks completed before an interruption. Superseded tasks are cancelled (see cancel_tasks) as soon as the other copy of their items is
+		reported, and any left when we return, or if the caller stops early, are cancelled then. Failure
+		of a superseded task is ignored."""
+		ncpu=max(1,self.cpu_est())
+		todo=list(items)
+		nitem=len(todo)
+		ndone=0
+		chunks={}		# chunk id -> [items, parent chunk id, child chunk ids, buffered child results]
+		tasks={}		# task id -> (chunk id, start time)
+		resolved=set()	# chunk ids whose items have been reported (or superseded)
+		rates=[]		# seconds per item for completed chunks, used to identify stragglers
+
+		def submit(chunk,parent=None):
+			cid=len(chunks)
+			task=taskfn(chunk)
+			# a chunk completed as pieces is journaled under its own key too, see MapItemsPieces
+			key=self.journal.key(task) if self.journal is not None and parent is None else None
+			chunks[cid]=[chunk,parent,[],[],key]
+			tasks[self.send_task(task)]=(cid,time.time())
+			return cid
+
+		def superseded(cid):
+			parent=chunks[cid][1]
+			return cid in resolved or (parent is not None and parent in resolved)
+
+		def cancel_superseded():
+			tids=[tid for tid,(cid,t0) in tasks.items() if superseded(cid)]
+			for tid in tids: del tasks[tid]
+			self.cancel_tasks(tids)
+
+		try:
+			while ndone<nitem:
+				# keep exactly one task per CPU in flight while there is work to hand out
+				while len(todo)>0 and len(tasks)<ncpu:
+					n=max(minchunk,len(todo)//(2*ncpu),1)
+					submit(todo[:n])
+					todo=todo[n:]
+
+				# nothing left to hand out, so let idle workers take over work from stragglers
+				idle=ncpu-len(tasks)
+				if steal and len(todo)==0 and idle>0 and len(rates)>0:
+					rate=sorted(rates)[len(rates)//2]
+					now=time.time()
+					for tid,(cid,t0) in sorted(tasks.items(),key=lambda x:x[1][1]):
+						chunk,parent,children,buf,key=chunks[cid]
+						if parent is not None or len(children)>0 or len(chunk)<2 or cid in resolved: continue
+						if now-t0<2.0*rate*len(chunk): continue
+						# the pieces may briefly queue behind other running tasks, but all of the other
+						# workers are about to become idle anyway
+						nsplit=min(max(idle,ncpu-1),len(chunk))
+						for i in range(nsplit):
+							children.append(submit(chunk[i::nsplit],cid))
+						idle-=nsplit
+						if idle<=0: break
+
+				tids=list(tasks.keys())
+				st_vals=self.wait_tasks(tids,1.0)
+				for tid,st in zip(tids,st_vals):
+					if st!=-100 : continue
+					if not superseded(tasks[tid][0]) : raise Exception("Error executing task {}".format(tid))
+					del tasks[tid]
+					self.cancel_tasks([tid])
+
+				for tid,st in zip(tids,st_vals):
+					if st!=100 or tid not in tasks : continue		# may have been cancelled above
+					cid,t0=tasks.pop(tid)
+					task,results=self.get_results(tid)
+					chunk,parent,children,buf,key=chunks[cid]
+					if tid>=0 : rates.append((time.time()-t0)/len(chunk))	# tasks from the journal took no time
+
+					if superseded(cid): continue
+
+					if parent is None:
+						resolved.add(cid)
+						resolved.update(children)
+						cancel_superseded()
+						if isinstance(results,MapItemsPieces):		# completed as pieces in a previous run
+							for c,r in results:
+								ndone+=len(c)
+								yield (c,r)
+						else:
+							ndone+=len(chunk)
+							yield (chunk,results)
+					else:
+						# pieces of a split chunk are only reported once all of them are done
+						resolved.add(cid)
+						pchunk,pp,siblings,pbuf,pkey=chunks[parent]
+						pbuf.append((chunk,results))
+						if all(c in resolved for c in siblings):
+							resolved.add(parent)
+							cancel_superseded()
+							if pkey is not None : self.journal.put(pkey,MapItemsPieces(pbuf))
+							for c,r in pbuf:
+								ndone+=len(c)
+								yield (c,r)
+
+				if progress is not None:
+					progress(float(ndone)/nitem)
+		finally:
+			# superseded tasks still running (or queued) would compete with whatever the caller does next
+			self.cancel_tasks(list(tasks.keys()))
+
+	def wait_for_tasks(self,taskid_list,callback,progress=None):
+		"""Calls callback(taskid,task,results) for each task in the list as it completes, and returns
+		once all of the tasks are finished. See as_completed()."""
+		for tid,task,results in self.as_completed(taskid_list,progress):
+			callback(tid,task,results)
+
+	def tree_reduce(self,taskid_list,mergetask,progress=None,discard=None):
+		"""Combines the results of all of the tasks in the list pairwise on the workers, rather than in the calling
+		process. mergetask(a,b) must return a JSTask whose result is the combination of results a and b, which must
+		be of the same form, so the combination must be associative and commutative (eg - a sum). As soon as two
+		results are available they are sent back out as a new merge task, so only one unpaired result is ever held
+		here and the final result emerges after ~log2(N) rounds of merging instead of N serial steps. Returns the
+		single combined result, or None for an empty list. If provided, progress is called with the fractional
+		completion (0-1) of all N-1 merges as well as the original N tasks. Raises an Exception if any task fails.
+		If we fail or are interrupted, discard (if provided) is called with the result held here, if any, so
+		results which own external resources (eg - EMSharedImage) can be released. Each merge sends two results
+		out and gets one back, so this only pays off when results are small handles (eg - EMSharedImage). With
+		pickled volumes it is generally faster to combine them in the caller using as_completed()."""
+		pending=list(taskid_list)
+		if len(pending)==0 : return None
+		ntask=2*len(pending)-1
+		ndone=0
+		held=[]		# the unpaired result, or briefly a pair while their merge task is sent
+		try:
+			while len(pending)>0:
+				st_vals=self.wait_tasks(pending,30.0)
+				if -100 in st_vals:
+					raise Exception("Error executing task {}".format(pending[st_vals.index(-100)]))
+
+				if progress is not None:
+					progress((ndone*100.0+sum([max(st,0) for st in st_vals]))/(ntask*100.0))
+
+				done=[tid for tid,st in zip(pending,st_vals) if st==100]
+				pending=[tid for tid,st in zip(pending,st_vals) if st!=100]
+				for tid in done:
+					ndone+=1
+					held.append(self.get_results(tid)[1])
+					if len(held)==2:
+						pending.append(self.send_task(mergetask(held[0],held[1])))
+						held=[]
+		except BaseException:
+			if discard is not None:
+				for results in held: discard(results)
+			raise
+
+		return held[0]
 
 
 
@@ -204,7 +527,7 @@ class EMMpiTaskHandler(object):
 	file caching naming scheme here, since the MPI task is not persistent across jobs. If this handler dies,
 	all knowledge of running processes dies with it."""
 	lock=threading.Lock()
-	def __init__(self,ncpus=2,scratchdir="/tmp",module="", usethreads=-1):
+	def __init__(self,ncpus=2,scratchdir="/tmp",module="", usethreads=-1, retries=0):
 		if not MPIOK:
 			print("Error: MPI import failed")
 			sys.exit(1)
@@ -240,6 +563,8 @@ class EMMpiTaskHandler(object):
 			load=" --loadmodule={}".format(module)
 		if usethreads>0:
 			thrd=" --usethreads={:d}".format(usethreads)
+		if retries>0:
+			thrd+=" --retries={:d}".format(retries)
 		cmd="mpirun {opt} e2parallel.py --mode=mpi --scratchdir={sdir} {load} {thrd} -v 2".format(
 			opt=mpiopts,sdir=self.scratchdir, load=load, thrd=thrd)
 		print(cmd)
@@ -325,6 +650,16 @@ class EMMpiTaskHandler(object):
 
 		return chk
 
+	def wait_tasks(self,id_list,timeout=None):
+		"""Waits until at least one task in the list is complete or has failed. Rank 0 has no way to
+		notify us, so this polls it, but much more often than drivers typically do"""
+		t0=time.time()
+		while 1:
+			chk=self.check_task(id_list)
+			if 100 in chk or -100 in chk : return chk
+			if timeout is not None and time.time()-t0>timeout : return chk
+			time.sleep(0.2)
+
 	def get_results(self,taskid):
 		"""This returns a (task,dictionary) tuple for a task, and cleans up files"""
 #		print "Retrieve ",taskid
@@ -444,7 +779,7 @@ class EMMpiClient(object):
 		mpi_barrier(MPI_COMM_WORLD)		# make sure all ranks are done before we move on
 
 
-	def run(self,verbose, usethreads=-1):
+	def run(self,verbose, usethreads=-1, retries=0):
 
 		# rank 0 is responsible for communications and i/o, and otherwise does no real work
 		if self.rank==0:
@@ -482,6 +817,8 @@ class EMMpiClient(object):
 			self.maxjob=-1						# current highest job number waiting for execution
 			self.nextjob=1						# next job waiting to run
 			self.status={}						# status of each job
+			self.retryjobs=[]					# failed jobs waiting to be rerun
+			self.failcount={}					# number of times each job has failed
 			self.error=""
 			while 1:
 				# Look for a command from our controlling process
@@ -527,21 +864,24 @@ class EMMpiClient(object):
 					continue
 
 
-				# Finally, see if we have any jobs that need to be executed
-				if self.nextjob<=self.maxjob :
+				# Finally, see if we have any jobs that need to be executed. Failed jobs being retried go first
+				if self.nextjob<=self.maxjob or len(self.retryjobs)>0 :
 
 					if -1 in self.rankjobs :
 						ranki=self.rankjobs.index(-1)
 						rank=self.ranklst[ranki]
-						if verbose>1 : print("Sending job {} to rank {} on {} ({} idle)".format(self.nextjob,rank,self.rankmap[rank],self.rankjobs.count(-1)))
+						if len(self.retryjobs)>0 : job=self.retryjobs.pop(0)
+						else :
+							job=self.nextjob
+							self.nextjob+=1
+						if verbose>1 : print("Sending job {} to rank {} on {} ({} idle)".format(job,rank,self.rankmap[rank],self.rankjobs.count(-1)))
 
-						task = open("%s/%07d"%(self.queuedir,self.nextjob),"rb").read()		# we don't unpickle
-						self.log("Sending task %d to rank %d (%s)"%(self.nextjob,rank,str(type(task))))
+						task = open("%s/%07d"%(self.queuedir,job),"rb").read()		# we don't unpickle
+						self.log("Sending task %d to rank %d (%s)"%(job,rank,str(type(task))))
 						r=mpi_eman2_send("EXEC",task,rank)
 
 						# if we got here, the task should be running
-						self.rankjobs[ranki]=self.nextjob
-						self.nextjob+=1
+						self.rankjobs[ranki]=job
 						self.log("Sending task rank %d done"%(rank))
 						continue
 
@@ -565,8 +905,17 @@ class EMMpiClient(object):
 					elif com=="EROR":
 						print("Error in executing task {}".format(data[0]))
 						print(data[1])
-						self.error=data[1]
-						self.status[data[0]]=-100
+						self.failcount[data[0]]=self.failcount.get(data[0],0)+1
+						if self.failcount[data[0]]<=retries:
+							# the rank stays alive when retries are enabled, so it can take new work
+							print("Retrying task {} ({}/{})".format(data[0],self.failcount[data[0]],retries))
+							self.log("Retrying task {} ({}/{})".format(data[0],self.failcount[data[0]],retries))
+							self.rankjobs[self.ranklst.index(src)]=-1
+							self.retryjobs.append(data[0])
+							self.status[data[0]]=-1
+						else:
+							self.error=data[1]
+							self.status[data[0]]=-100
 						
 					else : print("Warning: unknown task command ",com)
 					continue
@@ -604,6 +953,7 @@ class EMMpiClient(object):
 							err=traceback.format_exc()
 							print(err)
 							r=mpi_eman2_send("EROR",(self.task.taskid,err),0)
+							if retries>0: continue
 							break
 
 						# return results to rank 0
@@ -669,27 +1019,34 @@ class EMSharedMemoryLocalTaskHandler(object):
 	subclass of EMTaskHandler for efficient local processing and to avoid data name translation."""
 	lock=threading.Lock()
 	allrunning = {}	# Static dict of running local tasks. Used for killing thses task upon parent kill
-	def __init__(self,nthreads=2):
+	def __init__(self,nthreads=2,retries=0):
 		self.maxthreads=nthreads
+		self.retries=retries
 		#print("max thread : {}".format(nthreads))
 		self.jobs=[]
 		self.threads=[]
+		self.nextjob=0			# jobs before this have been launched
+		self.running=0
+		self.stopping=False
+		self.cond=threading.Condition()
+		# the dispatcher stays alive until stop(), since tasks may be added at any time (map_items, tree_reduce)
 		self.thr=threading.Thread(target=self.run)
+		self.thr.daemon=True
 		self.thr.start()
 
 	def stop(self):
-		#print("stop")
-		return
+		"""Stops the dispatcher. Tasks which are already running will finish."""
+		with self.cond:
+			self.stopping=True
+			self.cond.notify_all()
 
 	def add_task(self,task):
-		EMLocalTaskHandler.lock.acquire()
-		if not isinstance(task,JSTask) : raise Exception("Non-task object passed to EMLocalTaskHandler for execution")
-	
-		self.jobs.append([-1, task, None]) ### progress, task, result
-		#print("adding task {}".format(len(self.jobs)-1))
-		
-		EMLocalTaskHandler.lock.release()
-		return len(self.jobs)-1
+		if not isinstance(task,JSTask) : raise Exception("Non-task object passed to EMSharedMemoryLocalTaskHandler for execution")
+
+		with self.cond:
+			self.jobs.append([-1, task, None]) ### progress, task, result
+			self.cond.notify_all()
+			return len(self.jobs)-1
 
 	def check_task(self,id_list):
 		
@@ -698,9 +1055,15 @@ class EMSharedMemoryLocalTaskHandler(object):
 			
 		return ret
 
+	def wait_tasks(self,id_list,timeout=None):
+		"""Waits until at least one task in the list is complete"""
+		with self.cond:
+			self.cond.wait_for(lambda: any(self.jobs[i][0] in (100,-100) for i in id_list),timeout)
+		return self.check_task(id_list)
+
 	def get_results(self,taskid):
 		
-		task=self.jobs[taskid][0]
+		task=self.jobs[taskid][1]
 		results=self.jobs[taskid][2]
 
 		return (task,results)
@@ -708,70 +1071,69 @@ class EMSharedMemoryLocalTaskHandler(object):
 	def callback(self, idx, prog):
 		self.jobs[idx][0]=prog
 		#print("task {} prog {}".format(idx, prog))
-		
+
+	def execute(self,i):
+		callback=lambda c: self.callback(i, c)
+		for attempt in range(self.retries+1):
+			try:
+				ret=self.jobs[i][1].execute(callback)
+				break
+			except:
+				print("Error running task {} (attempt {}/{})".format(i,attempt+1,self.retries+1))
+				traceback.print_exc()
+		else:
+			with self.cond:
+				self.jobs[i][0]=-100
+				self.running-=1
+				self.cond.notify_all()
+			return
+		with self.cond:
+			self.jobs[i][2]=ret
+			self.jobs[i][0]=100
+			self.running-=1
+			self.cond.notify_all()
+
 	def run(self):
-		curthread=threading.active_count()
-		thrtolaunch=0
+		# -1 is waiting to launch, -100 failed for good. Jobs are launched in submission order.
 		while 1:
-			if len(self.jobs)==0:
-				#print('no job yet...')
-				time.sleep(1)
-				continue
-			
-			if (threading.active_count()>=curthread+self.maxthreads) : 
-				
-				#print('sleeping...{}/{} used'.format(threading.active_count(), curthread+self.maxthreads))
-				
-				#print([j[0] for j in self.jobs])
-				time.sleep(1)
-				continue
-				
-			minprog=min([j[0] for j in self.jobs])
-			if (minprog>=0): 
-				#print('all jobs running...', minprog)
-				if minprog==100:
-					break
-				time.sleep(1)
-				continue
-			
-			for idx, job in enumerate(self.jobs):
-				if job[0]<0: ### to launch
-					job[0]=0
-					#print("start job {}".format(idx))
-					
-					def execute(i):
-						callback=lambda c: self.callback(i, c)
-						ret=job[1].execute(callback)
-						self.jobs[i][0]=100
-						self.jobs[i][2]=ret
-						return
-						
-					thrd=threading.Thread(target=execute, args=[idx])
-					thrd.start()
-					self.threads.append(thrd)
-					break
-				
+			with self.cond:
+				self.cond.wait_for(lambda: self.stopping or (self.running<self.maxthreads and self.nextjob<len(self.jobs)))
+				if self.stopping: break
+				idx=self.nextjob
+				self.nextjob+=1
+				self.jobs[idx][0]=0
+				self.running+=1
+
+			#print("start job {}".format(idx))
+			thrd=threading.Thread(target=self.execute, args=[idx])
+			thrd.start()
+			self.threads.append(thrd)
 			
 		#print("all done")
 
 
 
 
+#######################
 # Here we define the classes for local threaded parallelism
 class EMLocalTaskHandler(object):
 	"""Local threaded Taskserver. This runs as a thread in the 'Customer' and executes tasks. Not a
 	subclass of EMTaskHandler for efficient local processing and to avoid data name translation."""
 	lock=threading.Lock()
 	allrunning = {}	# Static dict of running local tasks. Used for killing thses task upon parent kill
-	def __init__(self,nthreads=2,scratchdir="/tmp", module=""):
+	def __init__(self,nthreads=2,scratchdir="/tmp", module="", retries=0):
 		self.maxthreads=nthreads
+		self.retries=retries
+		self.failcount={}		# number of times each task has failed
 		self.running=[]			# running subprocesses
 		self.completed=set()	# completed subprocesses
+		self.cancelled=set()	# tasks whose results are no longer wanted, skipped or discarded when they finish
 		self.scratchdir="%s/e2tmp.%d"%(scratchdir,random.randint(1,2000000000))
 		self.maxid=0
 		self.nextid=0
 		self.doexit=0
 		self.module=module
+		self.cond=threading.Condition()		# notified when tasks are added or complete
 
 
 		os.makedirs(self.scratchdir)
@@ -781,6 +1143,7 @@ class EMLocalTaskHandler(object):
 	def stop(self):
 		"""Called externally (by the Customer) to nicely shut down the task handler"""
 		self.doexit=1
+		with self.cond: self.cond.notify_all()
 		self.thr.join()
 		shutil.rmtree(self.scratchdir,True)
 
@@ -791,8 +1154,24 @@ class EMLocalTaskHandler(object):
 		ret=self.maxid
 		self.maxid+=1
 		EMLocalTaskHandler.lock.release()
+		with self.cond: self.cond.notify_all()
 		return ret
 
+	def cancel_task(self,taskid):
+		"""Forgets a task whose results are no longer needed. If it hasn't been launched it never will be,
+		and if it is running its output is discarded when it exits. Returns True."""
+		with self.cond:
+			if taskid in self.completed:
+				self.completed.remove(taskid)
+				self.remove_files(taskid)
+			else: self.cancelled.add(taskid)
+		return True
+
+	def remove_files(self,taskid):
+		for ext in ("",".out",".prog"):
+			try: os.unlink("%s/%07d%s"%(self.scratchdir,taskid,ext))
+			except: pass
+
 	def check_task(self,id_list):
 		"""Checks a list of tasks for completion. Note that progress is not currently
 		handled, so results are always -1, 0 or 100 """
@@ -824,11 +1203,39 @@ class EMLocalTaskHandler(object):
 
 		return (task,results)
 
+	def wait_tasks(self,id_list,timeout=None):
+		"""Waits until at least one task in the list is complete"""
+		with self.cond:
+			self.cond.wait_for(lambda: any(i in self.completed for i in id_list),timeout)
+		return self.check_task(id_list)
+
+	def wait_proc(self,proc):
+		"""Runs in a small thread per subprocess to wake up the main loop as soon as the task exits"""
+		proc.wait()
+		with self.cond: self.cond.notify_all()
+
+	def launch(self,taskid,logfile):
+		"""Starts the subprocess executing a single task"""
+		fname=os.path.join(self.scratchdir,"{:07d}".format(taskid))
+		cmd="e2parallel.py --mode=thread --taskin={} --taskout={}.out --progres={}.prog".format(fname, fname, fname)
+		if self.module!="":
+			cmd+=" --loadmodule={}".format(self.module)
+			
+		if get_platform() == 'Windows':
+			cmd="python {}\\bin\\".format(e2getinstalldir())+cmd
+			
+		proc=subprocess.Popen(cmd, shell=True, stderr=logfile)
+		waiter=threading.Thread(target=self.wait_proc,args=(proc,))
+		waiter.daemon=True
+		waiter.start()
+		return proc
+
 	def run(self):
 
 		logfile=open("thread.out","a")
 		while(1):
-			time.sleep(1)		# only go active at most 1/second
+			# sleep until a task is added or finishes (or at most 1 second)
+			with self.cond: self.cond.wait(1)
 			if self.doexit==1:
 #				shutil.rmtree(self.scratchdir)
 				break
@@ -837,7 +1244,23 @@ class EMLocalTaskHandler(object):
 				# Check to see if the task is complete
 				if p[0].poll()!=None :
 
+					# nobody wants the results, so don't retry or abort on failure either
+					with self.cond:
+						if p[1] in self.cancelled:
+							self.cancelled.remove(p[1])
+							self.remove_files(p[1])
+							EMLocalTaskHandler.allrunning.pop(p[1],None)
+							self.running[i]=(p[0],None)		# removed from running below
+							continue
+
 					# This means that the task failed to execute properly
+					if p[0].returncode!=0 and self.failcount.get(p[1],0)<self.retries:
+						self.failcount[p[1]]=self.failcount.get(p[1],0)+1
+						print("Error running task {}, retrying ({}/{})".format(p[1],self.failcount[p[1]],self.retries))
+						self.running[i]=(self.launch(p[1],logfile),p[1])
+						EMLocalTaskHandler.allrunning[p[1]]=self.running[i][0]
+						continue
+
 					if p[0].returncode!=0 :
 						print("Error running task : ",p[1])
 						_thread.interrupt_main()
@@ -847,27 +1270,31 @@ class EMLocalTaskHandler(object):
 
 #					print "Task complete ",p[1]
 					# if we get here, the task completed
-					self.completed.add(p[1])
+					with self.cond:
+						if p[1] in self.cancelled:		# cancelled since we checked above
+							self.cancelled.remove(p[1])
+							self.remove_files(p[1])
+							self.running[i]=(p[0],None)
+						else: self.completed.add(p[1])
+						self.cond.notify_all()
 					try:
 						del(EMLocalTaskHandler.allrunning[p[1]])
 					except:
 						print("Error: Very strange threading error when trying to delete ",p[1]," Continuing execution, but be wary of any strange results.")
 
-			self.running=[i for i in self.running if i[1] not in self.completed]	# remove completed tasks
+			self.running=[i for i in self.running if i[1] is not None and i[1] not in self.completed]	# remove completed and cancelled tasks
 
 			while self.nextid<self.maxid and len(self.running)<self.maxthreads:
+				with self.cond:
+					if self.nextid in self.cancelled:
+						self.cancelled.remove(self.nextid)
+						self.remove_files(self.nextid)
+						self.nextid+=1
+						continue
 #				print "Launch task ",self.nextid
 				EMLocalTaskHandler.lock.acquire()
 
-				fname=os.path.join(self.scratchdir,"{:07d}".format(self.nextid))
-				cmd="e2parallel.py --mode=thread --taskin={} --taskout={}.out --progres={}.prog".format(fname, fname, fname)
-				if self.module!="":
-					cmd+=" --loadmodule={}".format(self.module)
-					
-				if get_platform() == 'Windows':
-					cmd="python {}\\bin\\".format(e2getinstalldir())+cmd
-					
-				proc=subprocess.Popen(cmd, shell=True, stderr=logfile)
+				proc=self.launch(self.nextid,logfile)
 				self.running.append((proc,self.nextid))
 				EMLocalTaskHandler.allrunning[self.nextid] = proc
 				self.nextid+=1
@@ -875,6 +1302,469 @@ class EMLocalTaskHandler(object):
 
 
 
+#######################
+# Shared memory image transport for local (single node) parallelism
+
+try:
+	from multiprocessing import shared_memory, resource_tracker
+	import numpy as np
+	SHMOK=True
+except:
+	SHMOK=False
+
+class EMSharedImage(object):
+	"""A picklable handle to an EMData whose pixels live in a named shared memory block. Passing one of
+	these in JSTask.data, or returning one from JSTask.execute, transfers only the name, size and header
+	through the task system, rather than pickling the pixel data. This only works when the customer and
+	the workers are on the same machine (thread, thread_sm or pool parallelism).
+
+	Creating the handle copies the image into shared memory once. get() then maps the pixels in any
+	process without copying, as a buffer-backed EMData which must not be resized (clip_inplace, do_fft_inplace,
+	...), and which is only valid while the handle exists. Use get(copy=True) for a normal, independent
+	EMData. The block persists until unlink() is called, normally by whichever process consumes it last."""
+	def __init__(self,img):
+		if not SHMOK : raise Exception("Shared memory transport requires Python 3.8+ and numpy")
+		src=EMNumPy.em2numpy(img)
+		self.shape=tuple(src.shape)
+		self.hdr=img.get_attr_dict()
+		self.shm=shared_memory.SharedMemory(create=True,size=max(4,src.nbytes))
+		self.name=self.shm.name
+		# the creator may be a short-lived worker, whose exit would otherwise destroy the block
+		try: resource_tracker.unregister(self.shm._name,"shared_memory")
+		except: pass
+		dst=np.ndarray(self.shape,dtype=np.float32,buffer=self.shm.buf)
+		dst[...]=src
+		self.emnumpy=None
+
+	def __getstate__(self):
+		return {"name":self.name,"shape":self.shape,"hdr":self.hdr}
+
+	def __setstate__(self,state):
+		self.__dict__.update(state)
+		self.shm=None
+		self.emnumpy=None
+
+	def attach(self):
+		if self.shm is None:
+			self.shm=shared_memory.SharedMemory(name=self.name)
+			try: resource_tracker.unregister(self.shm._name,"shared_memory")
+			except: pass
+		return self.shm
+
+	def numpy(self):
+		"""Returns a float32 numpy view of the shared pixel data"""
+		return np.ndarray(self.shape,dtype=np.float32,buffer=self.attach().buf)
+
+	def get(self,copy=False):
+		"""Returns the image. Without copy, the EMData is a view on the shared memory block."""
+		if copy:
+			ret=EMNumPy.numpy2em(self.numpy())
+		else:
+			# each EMNumPy object owns a single buffer-backed EMData, so we keep one per handle
+			self.emnumpy=EMNumPy()
+			ret=self.emnumpy.register_numpy_to_emdata(self.numpy())
+		ret.set_attr_dict(self.hdr)
+		return ret
+
+	def close(self):
+		"""Detaches this process from the block without destroying it"""
+		if self.emnumpy is not None:
+			self.emnumpy.unregister_numpy_from_emdata()
+			self.emnumpy=None
+		if self.shm is not None:
+			try: self.shm.close()
+			except BufferError: pass		# numpy views still exist, the mapping goes away with them
+			self.shm=None
+
+	def unlink(self):
+		"""Destroys the shared memory block. Any views returned by get() become invalid."""
+		self.attach()
+		shm=self.shm
+		self.close()
+		shm.unlink()
+
+def shared_get(obj,copy=False):
+	"""Convenience function for tasks. Returns obj.get(copy) for an EMSharedImage, otherwise obj unchanged"""
+	if isinstance(obj,EMSharedImage) : return obj.get(copy)
+	return obj
+
+#######################
+# Cache of per-task input preparation (eg - references read, FFTed and rotated by every alignment task)
+
+prep_cache={}		# prepared images in this process, most recently used last
+prep_lock=threading.Lock()
+
+def prepared_images(fsps,params,build,path=None,maxkeep=4):
+	"""Convenience function for tasks which all begin by preparing the same images from the same files. Returns
+	a copy of the list of EMData returned by build(), calling build() only when needed. Results are keyed on
+	the files in fsps, their modification times and params (which must have a stable repr), so an updated
+	reference is never served stale. The last maxkeep results are kept in memory, which covers thread parallelism
+	and persistent (pool:N) workers. If path is given, results are also written there as HDF files, so tasks in
+	other processes or on other nodes read them instead of recomputing. Call clear_prepared_images(path) when done."""
+	key=repr((tuple((f,os.path.getmtime(f)) for f in fsps),params))
+	with prep_lock:
+		if key in prep_cache:
+			imgs=prep_cache.pop(key)
+		else:
+			imgs=None
+			if path!=None:
+				fsp=os.path.join(path,"prepcache_{}.hdf".format(hashlib.sha1(key.encode()).hexdigest()[:16]))
+				if os.path.isfile(fsp):
+					try: imgs=EMData.read_images(fsp)
+					except: imgs=None
+
+			if imgs==None:
+				imgs=build()
+				if path!=None:
+					# write then rename, so other processes never read a partial file
+					tmp=fsp[:-4]+"_{}.tmp.hdf".format(os.getpid())
+					try:
+						for i,m in enumerate(imgs): m.write_image(tmp,i)
+						os.replace(tmp,fsp)
+					except:
+						print("Warning: could not write {}".format(fsp))
+
+		prep_cache[key]=imgs
+		while len(prep_cache)>maxkeep: prep_cache.pop(next(iter(prep_cache)))
+
+	return [m.copy() for m in imgs]
+
+def clear_prepared_images(path):
+	"""Removes the files written by prepared_images() in path"""
+	for f in os.listdir(path):
+		if f.startswith("prepcache_") and f.endswith(".hdf"):
+			try: os.unlink(os.path.join(path,f))
+			except: pass
+
+class EMStackCache(object):
+	"""A preprocessed copy of an image stack shared by all of the tasks of a run, eg - particles shrunk or
+	normalized the same way by every task. The customer calls build() once before sending the tasks, and each
+	task creates an EMStackCache with the same arguments and calls get() in place of reading and processing
+	the image. Pixels are stored in a .npy file which is memory mapped, so the page cache is shared by all
+	processes on a node, and headers as individually pickled dicts so a task only reads the ones it needs.
+	The files are named after the input file, its modification time and the processing. For .lst files the
+	size and modification time of every referenced image file is also recorded, and build() rebuilds the
+	cache if any of them have changed, so a stale cache is never used. Call remove() when the run is complete."""
+
+	open_caches={}		# (data, header offsets, open header file, lock) for caches already opened by this process
+	open_lock=threading.Lock()
+
+	def __init__(self,fsp,procs,path=None):
+		"""procs is a list of (processor name, parameter dict) applied to each image in order, as returned by parsemodopt().
+		path is the folder to store the cache in, by default the folder containing fsp"""
+		self.fsp=fsp
+		self.procs=[tuple(p) for p in procs if p!=None and p[0]!=None]
+		key=repr((abs_path(fsp),os.path.getmtime(fsp),self.procs))
+		if path==None : path=os.path.dirname(fsp)
+		self.base=os.path.join(path,"stackcache_{}".format(hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+	def exists(self):
+		return os.path.isfile(self.base+"_idx.npy")
+
+	def sources(self):
+		"""Returns a sorted list of (path,size,mtime) for the image files the input stack refers to. Only .lst files refer
+		to other files, the input itself is already part of the cache name."""
+		if self.fsp[-4:].lower() not in (".lst",".lsx") : return []
+		from EMAN2 import load_lst_arrays
+		ret=[]
+		for src in sorted(set(load_lst_arrays(self.fsp,False)["src"])):
+			try:
+				st=os.stat(src)
+				ret.append((src,st.st_size,st.st_mtime))
+			except OSError: ret.append((src,None,None))
+		return ret
+
+	def build(self):
+		"""Processes every image in the input stack and writes the cache, unless an up to date copy already exists"""
+		import numpy as np
+		srcs=self.sources()
+		if self.exists() :
+			try:
+				with open(self.base+".src","rb") as f: cursrcs=load(f)
+			except: cursrcs=None
+			if cursrcs==srcs : return
+			self.remove()
+
+		n=EMUtil.get_image_count(self.fsp)
+		tmp="{}_{}.tmp".format(self.base,os.getpid())
+		data=None
+		offsets=np.zeros(n+1,dtype=np.int64)
+		with open(tmp+".hdr","wb") as hdrf:
+			for i in range(n):
+				im=EMData(self.fsp,i)
+				for p in self.procs: im.process_inplace(p[0],p[1])
+				if data is None : data=np.lib.format.open_memmap(tmp+".npy",mode="w+",dtype=np.float32,shape=(n,)+im.numpy().shape)
+				data[i]=im.numpy()
+				dump(im.get_attr_dict(),hdrf,-1)
+				offsets[i+1]=hdrf.tell()
+		if data is None : np.save(tmp+".npy",np.zeros(0,dtype=np.float32))		# empty stack, so there is no image shape
+		else:
+			data.flush()
+			del data
+		with open(tmp+".src","wb") as f: dump(srcs,f,-1)
+
+		# the index is renamed last, so the cache only exists once it is complete
+		os.replace(tmp+".npy",self.base+".npy")
+		os.replace(tmp+".hdr",self.base+".hdr")
+		os.replace(tmp+".src",self.base+".src")
+		np.save(tmp+"_idx.npy",offsets)
+		os.replace(tmp+"_idx.npy",self.base+"_idx.npy")
+
+	def __len__(self):
+		return len(self.__open()[1])-1
+
+	def __open(self):
+		import numpy as np
+		with EMStackCache.open_lock:
+			try: return EMStackCache.open_caches[self.base]
+			except KeyError: pass
+			ret=(np.load(self.base+".npy",mmap_mode="r"),np.load(self.base+"_idx.npy"),open(self.base+".hdr","rb"),threading.Lock())
+			EMStackCache.open_caches[self.base]=ret
+			return ret
+
+	def get(self,i):
+		"""Returns image i of the processed stack as a new EMData"""
+		data,offsets,hdrf,lock=self.__open()
+		with lock:
+			hdrf.seek(offsets[i])
+			hdr=load(hdrf)
+		ret=EMNumPy.numpy2em(data[i])
+		ret.set_attr_dict(hdr)
+		return ret
+
+	def close(self):
+		"""Releases the files held open by get() in this process"""
+		with EMStackCache.open_lock:
+			c=EMStackCache.open_caches.pop(self.base,None)
+		if c!=None : c[2].close()
+
+	def remove(self):
+		self.close()
+		# the index goes first, so a partly removed cache no longer exists
+		for s in ("_idx.npy",".npy",".hdr",".src"):
+			try: os.unlink(self.base+s)
+			except: pass
+
+#######################
+# Here we define the classes for local parallelism with a pool of persistent worker processes
+
+def pool_worker(taskq,resultq,module="",wid=0):
+	"""Main loop of a single EMPoolTaskHandler worker process. The task module is loaded once, then
+	pickled tasks are executed as they arrive on taskq (private to this worker) until a None is received.
+	Everything we report goes back to the customer through resultq as (command,wid,taskid,data) tuples"""
+	if module!="": load_module(module)
+
+	while 1:
+		job=taskq.get()
+		if job is None: break
+
+		taskid,data=job
+		resultq.put(("STRT",wid,taskid,os.getpid()))
+		lastupdate=[0]
+		def progress(prog):
+			# progress is only informational, so we don't flood the pipe with it
+			if time.time()-lastupdate[0]>1.0 :
+				resultq.put(("PROG",wid,taskid,prog))
+				lastupdate[0]=time.time()
+			return True
+
+		try:
+			task=loads(data)
+			ret=task.execute(progress)
+			resultq.put(("DONE",wid,taskid,dumps(ret,-1)))
+		except:
+			err=traceback.format_exc()
+			print("Error executing task {} in worker {}".format(taskid,os.getpid()))
+			print(err)
+			resultq.put(("EROR",wid,taskid,err))
+
+class EMPoolTaskHandler(object):
+	"""Local Taskserver using a fixed pool of long-lived worker processes. Unlike EMLocalTaskHandler,
+	which launches a new e2parallel.py (and pays for importing EMAN2) for every task, workers here are
+	started once, load the task module once, and receive tasks and return results over pipes. A
+	collector thread in the customer records results as they arrive and notifies any waiters, so
+	completion does not depend on polling the filesystem. Tasks are handed to each worker one at a
+	time from here, so we always know which task a worker which died was running."""
+	def __init__(self,nproc=2,module="",retries=0):
+		self.maxthreads=nproc
+		self.module=module
+		self.retries=retries
+		self.failcount={}		# number of times each task has failed
+		self.maxid=0
+		self.status={}			# key is taskid, value is -1 (queued), 0-99 (running) or 100 (complete), -100 on error
+		self.tasks={}			# the task objects themselves, returned with the results
+		self.pickled={}			# pickled task for each task not yet complete, sent to the workers
+		self.queued=collections.deque()	# taskids waiting for a free worker
+		self.assigned={}		# key is worker number, value is the taskid it was given
+		self.results={}			# pickled results of completed tasks, removed by get_results
+		self.errors={}			# traceback for each task which failed
+		self.cond=threading.Condition()
+		self.doexit=0
+		self.checkinterval=1.0	# seconds between checks for dead workers
+
+		# fork is much cheaper than spawn, and inherits the already imported EMAN2
+		if get_platform()=="Windows" : self.ctx=multiprocessing.get_context("spawn")
+		else : self.ctx=multiprocessing.get_context("fork")
+		self.resultq=self.ctx.Queue()
+		self.workers=[self.start_worker(i) for i in range(nproc)]		# (process,task queue) for each worker, None while being replaced
+
+		self.thr=threading.Thread(target=self.run)
+		self.thr.daemon=True
+		self.thr.start()
+
+	def start_worker(self,wid):
+		taskq=self.ctx.Queue()
+		proc=self.ctx.Process(target=pool_worker,args=(taskq,self.resultq,self.module,wid))
+		proc.daemon=True
+		proc.start()
+		return (proc,taskq)
+
+	def stop(self):
+		"""Called externally (by the Customer) to nicely shut down the task handler"""
+		if self.doexit : return
+		self.doexit=1
+		self.thr.join()
+		workers=[w for w in self.workers if w is not None]
+		for proc,taskq in workers: taskq.put(None)
+		for proc,taskq in workers:
+			proc.join(5)
+			if proc.is_alive() : proc.terminate()
+
+	def add_task(self,task):
+		if not isinstance(task,JSTask) : raise Exception("Non-task object passed to EMPoolTaskHandler for execution")
+		with self.cond:
+			taskid=self.maxid
+			task.taskid=taskid
+			self.maxid+=1
+		data=dumps(task,-1)
+		with self.cond:
+			self.tasks[taskid]=task
+			self.pickled[taskid]=data
+			self.status[taskid]=-1
+			self.queued.append(taskid)
+			self.dispatch()
+		return taskid
+
+	def dispatch(self):
+		"""Hands queued tasks to idle workers. Call with cond held."""
+		for i,w in enumerate(self.workers):
+			if len(self.queued)==0 : break
+			if w is None or i in self.assigned : continue
+			taskid=self.queued.popleft()
+			self.assigned[i]=taskid
+			w[1].put((taskid,self.pickled[taskid]))
+
+	def cancel_task(self,taskid):
+		"""Forgets a task whose results are no longer needed. If it hasn't been started it never will be,
+		and if it is running its results are discarded when it finishes. Returns True."""
+		with self.cond:
+			try: self.queued.remove(taskid)
+			except ValueError: pass
+			for d in (self.status,self.tasks,self.pickled,self.results,self.errors,self.failcount):
+				d.pop(taskid,None)
+		return True
+
+	def check_task(self,id_list):
+		"""Checks a list of tasks for completion. Returns -1 (not started), 0-99 (running),
+		100 (complete) or -100 (failed) for each task"""
+		with self.cond:
+			return [self.status.get(i,-1) for i in id_list]
+
+	def get_results(self,taskid):
+		"""This returns a (task,dictionary) tuple for a completed task"""
+		with self.cond:
+			if self.status.get(taskid,-1)!=100 : raise Exception("Task %d not complete !!!"%taskid)
+			task=self.tasks.pop(taskid)
+			results=self.results.pop(taskid)
+			del self.status[taskid]
+
+		return (task,loads(results))
+
+	def wait_tasks(self,id_list,timeout=None):
+		"""Waits until at least one task in the list is complete or has failed"""
+		with self.cond:
+			self.cond.wait_for(lambda: any(self.status.get(i,-1) in (100,-100) for i in id_list),timeout)
+			return [self.status.get(i,-1) for i in id_list]
+
+	def run(self):
+		"""Collector thread. Records messages from the workers, hands out queued tasks as workers become
+		free, and replaces workers which die. Workers are checked every checkinterval seconds no matter
+		how busy the result queue is."""
+		nextcheck=time.time()+self.checkinterval
+		while not self.doexit:
+			try: com,wid,taskid,data=self.resultq.get(timeout=max(0.0,nextcheck-time.time()))
+			except queue.Empty: com=None
+
+			if com is not None:
+				with self.cond:
+					self.message(com,wid,taskid,data)
+					self.cond.notify_all()
+
+			if time.time()>=nextcheck:
+				self.check_workers()
+				nextcheck=time.time()+self.checkinterval
+
+	def message(self,com,wid,taskid,data):
+		"""Handles one message from worker wid. Call with cond held."""
+		if com=="STRT":
+			if self.status.get(taskid)==-1 : self.status[taskid]=0
+			return
+		if com=="PROG":
+			if taskid in self.status and 0<=self.status[taskid]<100 :
+				self.status[taskid]=min(99,max(0,int(data)))
+			return
+
+		# DONE or EROR, the worker is free again. A message from a worker which has since been replaced
+		# doesn't free its replacement.
+		if self.assigned.get(wid)==taskid : del self.assigned[wid]
+		if self.status.get(taskid,-100) in (100,-100) : pass		# already finished elsewhere (retried after a worker death)
+		elif com=="DONE":
+			try: self.queued.remove(taskid)
+			except ValueError: pass
+			self.results[taskid]=data
+			self.status[taskid]=100
+			self.pickled.pop(taskid,None)
+		elif taskid not in self.queued:
+			self.failed(taskid,data)
+		self.dispatch()
+
+	def check_workers(self):
+		"""If a worker was killed (eg - out of memory) the task it was given is marked as failed (or
+		requeued) and the worker is replaced, so the remaining tasks can still complete"""
+		with self.cond:
+			dead=[i for i,w in enumerate(self.workers) if w is not None and not w[0].is_alive()]
+			for i in dead:
+				proc=self.workers[i][0]
+				self.workers[i]=None
+				taskid=self.assigned.pop(i,None)
+				if taskid in self.status and self.status[taskid] not in (100,-100):
+					print("Error: worker {} died while running task {}".format(proc.pid,taskid))
+					self.failed(taskid,"Worker process {} exited with code {}".format(proc.pid,proc.exitcode))
+			self.dispatch()
+			self.cond.notify_all()
+		if len(dead)==0 : return
+
+		# fork outside the lock, so the new workers can't inherit it in a held state
+		new={i:self.start_worker(i) for i in dead}
+		with self.cond:
+			for i in dead: self.workers[i]=new[i]
+			self.dispatch()
+
+	def failed(self,taskid,err):
+		"""Requeues a failed task if it has retries left, otherwise marks it as failed. Call with cond held."""
+		self.failcount[taskid]=self.failcount.get(taskid,0)+1
+		if self.failcount[taskid]<=self.retries:
+			print("Error running task {}, retrying ({}/{})".format(taskid,self.failcount[taskid],self.retries))
+			self.status[taskid]=-1
+			self.queued.append(taskid)
+		else:
+			print("Error running task : ",taskid)
+			self.errors[taskid]=err
+			self.status[taskid]=-100
+			self.pickled.pop(taskid,None)
+
+
+
 
 
 #######################
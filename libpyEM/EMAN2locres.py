@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2026- Baylor College of Medicine
+#
+# This software is issued under a joint BSD/GNU license. You may use the
+# source code in this file under either license. However, note that the
+# complete EMAN2 and SPARX software packages have some GPL dependencies,
+# so you are responsible for compliance with the licenses of these packages
+# if you opt to use BSD licensing. The warranty disclaimer below holds
+# in either instance.
+#
+# This complete copyright notice must be included in any revised version of the
+# source code. Additional authorship citations may be added, but existing
+# author citations must be preserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston MA 02111-1307 USA
+#
+#
+
+import os
+import multiprocessing
+import queue
+import traceback
+import numpy as np
+from EMAN2_cppwrap import EMData, Util, Processor
+
+######
+# Local resolution by real-space FSC within a sliding box, for a single computer. This is the
+# shared-memory counterpart of the MPI locres in sphire/libpy/sp_statistics.py, which re-exports
+# these functions. Only EMAN2_cppwrap is needed, so e2fsc_local.py can use it without MPI or SPHIRE.
+######
+
+def fft(e):
+	"""Out-of-place forward or inverse FFT, depending on the input"""
+	if e.is_complex(): return e.do_ift()
+	return e.do_fft()
+
+def tophat_band(e,fl,fh):
+	"""Top-hat band-pass filter between absolute frequencies fl and fh"""
+	return Processor.EMFourierFilter(e,{"filter_type":Processor.fourier_filter_types.TOP_HAT_BAND_PASS,"low_cutoff_frequency":fl,"high_cutoff_frequency":fh,"dopad":False})
+
+def positive_sqrt(e):
+	"""Square root of an image with negative values set to zero"""
+	return e.process("threshold.belowtozero",{"minval":0.0}).process("math.sqrt")
+
+def blank(nx,ny,nz,value=0.0):
+	e=EMData(nx,ny,nz)
+	e.to_value(value)
+	return e
+
+def locres_shell(vf,uf,m,mc,nk,i,step):
+	"""Local real-space FSC of frequency shell i (from step*i to step*(i+1)) of two volumes,
+	computed within boxes of size nk inside mask m. vf and uf are the Fourier transforms
+	of the volumes and mc is the complement of the mask (1 - m).
+	Returns the local FSC volume and [frequency, overall FSC within the mask]."""
+	nx=m.get_xsize()
+	ny=m.get_ysize()
+	nz=m.get_zsize()
+
+	fl=step*i
+	fh=fl+step
+	freq=(fl+fh)/2.0
+
+	if i>0:
+		v=fft(tophat_band(vf,fl,fh))
+		u=fft(tophat_band(uf,fl,fh))
+		tmp1=Util.muln_img(v,v)
+		tmp2=Util.muln_img(u,u)
+		tmp3=Util.muln_img(u,v)
+		do=Util.infomask(positive_sqrt(Util.muln_img(tmp1,tmp2)),m,True)[0]
+		dp=Util.infomask(tmp3,m,True)[0]
+		if do==0.0: dis=[freq,0.0]
+		else: dis=[freq,dp/do]
+	else:
+		tmp1=blank(nx,ny,nz,1.0)
+		tmp2=blank(nx,ny,nz,1.0)
+		tmp3=blank(nx,ny,nz,1.0)
+		dis=[freq,1.0]
+
+	tmp1=Util.box_convolution(tmp1,nk)
+	tmp2=Util.box_convolution(tmp2,nk)
+	tmp3=Util.box_convolution(tmp3,nk)
+
+	Util.mul_img(tmp1,tmp2)
+
+	tmp1=positive_sqrt(tmp1)
+
+	Util.mul_img(tmp1,m)
+	Util.add_img(tmp1,mc)
+
+	Util.mul_img(tmp3,m)
+	Util.add_img(tmp3,mc)
+
+	Util.div_img(tmp3,tmp1)
+
+	Util.mul_img(tmp3,m)
+
+	return tmp3,dis
+
+def locres_worker(vf,uf,m,mc,nk,cutoff,step,shells,first,mask,results):
+	"""Computes the listed frequency shells for locres_shared. first holds one entry per voxel in mask,
+	the lowest shell at which the local FSC dropped below cutoff, or the number of shells if none.
+	The [frequency, FSC] pairs are put on results, or None in case of failure."""
+	try:
+		for i in shells:
+			tmp3,dis=locres_shell(vf,uf,m,mc,nk,i,step)
+			below=tmp3.get_3dview().reshape(-1)[mask]<cutoff
+			# shells are in increasing order, so only voxels which have not yet been set are updated
+			below&=first>i
+			first[below]=i
+			results.put(dis)
+	except Exception:
+		traceback.print_exc()
+		results.put(None)
+
+def available_memory():
+	"""Bytes of memory available to new processes, or None if unknown"""
+	try:
+		for l in open("/proc/meminfo"):
+			if l.startswith("MemAvailable:"): return int(l.split()[1])*1024
+	except: pass
+	try: return os.sysconf("SC_AVPHYS_PAGES")*os.sysconf("SC_PAGE_SIZE")
+	except: return None
+
+def default_nproc(nvox,nshell):
+	"""Number of worker processes for locres_shared with nvox voxels and nshell shells. One per core,
+	but no more than fit in 80% of the available memory, and no more than there are shells."""
+	nproc=multiprocessing.cpu_count()
+	mem=available_memory()
+	# each shell in locres_shell has about 12 full-size float volumes allocated at its peak
+	if mem is not None: nproc=min(nproc,int(mem*0.8)//(12*4*nvox))
+	return max(1,min(nproc,nshell))
+
+def locres_shared(vi,ui,m,nk,cutoff,step,nproc=0,timeout=10.0):
+	"""Non-MPI version of locres for a single computer. The frequency shells are divided among
+	nproc forked processes (by default, see default_nproc) which share the input volumes. Rather than
+	returning a volume for each shell, each process merges its shells into its own row of a
+	shared-memory array holding, for each voxel inside the mask, the first shell at which the
+	local FSC falls below cutoff. These are combined at the end, giving the same result as
+	applying Util.set_freq_sphire to the shells in order. Voxels outside the mask are 0.
+	Shells are limited to Nyquist. Every timeout seconds without a result the workers are checked,
+	and an Exception is raised if one was killed (eg - by the OOM killer).
+	Returns freqvol, resolut as locres does on the main node."""
+	nx=m.get_xsize()
+	ny=m.get_ysize()
+	nz=m.get_zsize()
+
+	mc=blank(nx,ny,nz,1.0)-m
+
+	st=Util.infomask(vi,m,True)
+	vi=vi-st[0]
+	st=Util.infomask(ui,m,True)
+	ui=ui-st[1]
+
+	vf=fft(vi)
+	uf=fft(ui)
+
+	lp=int(max(nx,ny,nz)/2/step+0.5)
+	step=0.5/lp
+
+	if nproc<1: nproc=default_nproc(nx*ny*nz,lp)
+	nproc=max(1,min(nproc,lp))
+	if "fork" not in multiprocessing.get_all_start_methods(): nproc=1
+
+	# only voxels inside the mask are stored, as int16 unless there are too many shells
+	mask=m.get_3dview().reshape(-1)>0.5
+	nmask=int(mask.sum())
+	if lp<np.iinfo(np.int16).max: code,dtype="h",np.int16
+	else: code,dtype="i",np.int32
+	shared=multiprocessing.RawArray(code,max(1,nproc*nmask))
+	first=np.frombuffer(shared,dtype=dtype)[:nproc*nmask].reshape(nproc,nmask)
+	first[:]=lp
+
+	if nproc==1:
+		results=queue.Queue()
+		locres_worker(vf,uf,m,mc,nk,cutoff,step,list(range(lp)),first[0],mask,results)
+		procs=[]
+	else:
+		ctx=multiprocessing.get_context("fork")
+		results=ctx.Queue()
+		procs=[ctx.Process(target=locres_worker,args=(vf,uf,m,mc,nk,cutoff,step,list(range(k,lp,nproc)),first[k],mask,results)) for k in range(nproc)]
+		for p in procs: p.start()
+
+	resolut=[]
+	try:
+		while len(resolut)<lp:
+			try: dis=results.get(timeout=timeout)
+			except queue.Empty:
+				# a worker killed by a signal never reports, and one which exited has nothing more to send
+				dead=[p for p in procs if p.exitcode is not None and p.exitcode!=0]
+				if len(dead)>0: raise Exception("locres_shared: worker process {} exited with code {}".format(dead[0].pid,dead[0].exitcode))
+				if all(p.exitcode is not None for p in procs): raise Exception("locres_shared: workers exited without computing all frequency shells")
+				continue
+			if dis is None: raise Exception("locres_shared: computation of a frequency shell failed")
+			resolut.append(dis)
+	except BaseException:
+		for p in procs: p.terminate()
+		raise
+	for p in procs: p.join()
+	resolut.sort()
+
+	# frequency of each shell, with voxels which never fell below cutoff set to 0
+	freqs=np.append((np.arange(lp)+0.5)*step,0.0).astype(np.float32)
+	freqvol=blank(nx,ny,nz)
+	fv=freqvol.get_3dview().reshape(-1)
+	fv[mask]=freqs[first.min(axis=0)]
+	freqvol.update()
+
+	return freqvol,resolut
@@ -72,6 +72,120 @@ def goodval(vals):
 		except: pass
 	return val
 
+def loop_columns(tokens,ncol,dtypes=None):
+	"""Converts a flat (row-major) list of loop_ value strings into a list of ncol columns. Each column becomes an int64 or
+	float64 numpy array if all of its values convert, otherwise it is returned as a list of strings. This is much faster
+	than calling goodval() on each value for large loops. If dtypes is provided (a numpy dtype or str for each column),
+	the columns are converted to those types rather than detecting them."""
+	if len(tokens)%ncol!=0 : raise Exception("StarFile: {} loop values is not a multiple of {} columns".format(len(tokens),ncol))
+	a=np.array(tokens,dtype=object).reshape((-1,ncol))
+	ret=[]
+	for i in range(ncol):
+		c=a[:,i]
+		if dtypes!=None :
+			if dtypes[i]==str : ret.append(c.tolist())
+			else:
+				try: ret.append(c.astype(dtypes[i]))
+				except (ValueError,TypeError,OverflowError): raise Exception("StarFile: non-numeric value in numeric loop_ column {}".format(i+1))
+			continue
+		try: ret.append(c.astype(np.int64))
+		except (ValueError,TypeError,OverflowError):
+			try: ret.append(c.astype(np.float64))
+			except (ValueError,TypeError): ret.append(c.tolist())
+	return ret
+
+def star_value(val):
+	"""Returns a string representation of a single value suitable for writing to a STAR file, quoting as required"""
+	if isinstance(val,(bool,np.bool_)): return str(int(val))
+	if isinstance(val,(int,float,np.integer,np.floating)): return str(val)
+	val=str(val)
+	if "\n" in val: return "\n;{}\n;".format(val)
+	if len(val)==0 : return '""'
+	if len(val)>1 and val[0] in ("'",'"') and val[-1]==val[0] : return val		# loop_ values retain their quotes when read
+	if val[0] in ("_","#","'",'"',";","$") or len(val.split())>1 or val[:5].lower() in ("data_","loop_","save_","stop_"):
+		if "'" in val : return '"{}"'.format(val)
+		return "'{}'".format(val)
+	return val
+
+def star_column(vals):
+	"""Converts one loop_ column (list or numpy array) into a list of strings for writing"""
+	if isinstance(vals,np.ndarray) and vals.dtype.kind in "iuf": return vals.astype(str).tolist()
+	if isinstance(vals,np.ndarray) and vals.dtype.kind=="b": return vals.astype(np.int8).astype(str).tolist()
+	return [star_value(v) for v in vals]
+
+def write_loop(out,names,cols,chunksize=100000):
+	"""Writes a single loop_ with the column names in names and data in the corresponding list of columns to the open file out.
+	Rows are converted in chunks, so very large loops are written without building the entire text in RAM."""
+	out.write("loop_\n")
+	for i,k in enumerate(names): out.write("_{} #{}\n".format(k,i+1))
+	n=len(cols[0]) if len(cols)>0 else 0
+	for k,c in zip(names,cols):
+		if len(c)!=n : raise Exception("StarFile: loop_ column {} has {} values, expected {}".format(k,len(c),n))
+	for i in range(0,n,chunksize):
+		strs=[star_column(c[i:i+chunksize]) for c in cols]
+		out.write("\n".join([" ".join(r) for r in zip(*strs)]))
+		out.write("\n")
+	out.write("\n")
+
+def iter_loop(filename,key=None,dataname=None,chunksize=100000):
+	"""Iterates over the rows of a single loop_ in a STAR file without reading the whole file into RAM. Yields
+	dictionaries of column name (without the leading "_") -> values as returned by loop_columns(), with up to chunksize rows
+	each. The loop used is the first one containing column key, if specified, within the block dataname
+	(eg - "data_particles"), if specified. Multi-line (;) values are not supported inside loops here.
+	Column types are decided by the first chunk, with integer columns returned as float64, so every chunk has the same
+	types even if, say, a column only has non-integer values later in the file."""
+	if dataname!=None and dataname[:5].lower()!="data_" : dataname="data_"+dataname
+	matcher=re.compile("""("[^"]+")|('[^']+')|([^\s]+)""")
+
+	with open(filename,"r") as fin:
+		curdata=None
+		line=fin.readline()
+		while len(line)>0:
+			l=line.strip()
+			line=fin.readline()
+			if l[:5].lower()=="data_" : curdata=l
+			if l[:5].lower()!="loop_" : continue
+
+			# column names
+			names=[]
+			while len(line)>0:
+				l=line.strip()
+				if len(l)>0 and l[0]=="_": names.append(l.split()[0][1:])
+				elif len(l)>0 and l[0]!="#": break
+				line=fin.readline()
+			if (dataname!=None and curdata!=dataname) or (key!=None and key not in names) or len(names)==0: continue
+
+			# loop data, line is the first row here
+			rows=[]
+			dtypes=None
+			while len(line)>0:
+				l=line.strip()
+				if len(l)>0 and l[0]!="#":
+					if l[0]=="_" or l[:5].lower() in ("loop_","data_") : break
+					rows.append(l)
+				line=fin.readline()
+				if len(rows)>=chunksize or (len(line)==0 and len(rows)>0):
+					dtypes,cols=loop_chunk(rows,matcher,len(names),dtypes)
+					yield dict(zip(names,cols))
+					rows=[]
+			if len(rows)>0 : yield dict(zip(names,loop_chunk(rows,matcher,len(names),dtypes)[1]))
+			return
+
+def loop_chunk(rows,matcher,ncol,dtypes):
+	"""converts one chunk of loop_ rows for iter_loop(). If dtypes is None, the column types are detected, with integer
+	columns promoted to float64. Returns (dtypes,columns)"""
+	cols=loop_columns(loop_tokens(rows,matcher),ncol,dtypes)
+	if dtypes==None :
+		cols=[c.astype(np.float64) if isinstance(c,np.ndarray) and c.dtype.kind=="i" else c for c in cols]
+		dtypes=[c.dtype if isinstance(c,np.ndarray) else str for c in cols]
+	return dtypes,cols
+
+def loop_tokens(rows,matcher):
+	"""splits a list of loop_ data lines into individual value strings, dealing with quotes only if present"""
+	block=" ".join(rows)
+	if "'" not in block and '"' not in block : return block.split()
+	return [max(v) for v in matcher.findall(block)]
+
 class StarFile3(dict):
 	"""This is a more complete Star file implementation (than StarFile) which also supports formats like mmCIF without breaking
 	the original simplistic class.
@@ -127,17 +241,26 @@ class StarFile3(dict):
 
 				self.loops[self.curdata].append(parms)		# store the list of column headers for potential later use
 
+				rows=[]
 				while len(line)>0 and line[0]!="_" and line[:5]!="data_" and line[:5]!="loop_":
-					for i,v in enumerate(matcher.findall(line)): lsts[i].append(goodval(v))
+					rows.append(line)
 					line=self.__readline(fin)
 
-				# try and convert all of the non string lists into numpy arrays
-				p=self.loops[self.curdata][-1]		# list of column names we just created
-				for k in p:
-					try:
-						x=float(self.curdict[k][0])		# if we can convert the first item to a float then we do the array conversion, not perfect, but will block most strings from conversion
-						self.curdict[k]=np.array(self.curdict[k])
-					except: pass
+				# whole columns are converted at once, numeric columns become numpy arrays, string columns remain lists
+				tokens=loop_tokens(rows,matcher)
+				if len(parms)>0 and len(tokens)%len(parms)==0:
+					for k,c in zip(parms,loop_columns(tokens,len(parms))): self.curdict[k]=c
+				else:
+					# ragged rows, fall back to the value by value conversion
+					for row in rows:
+						for i,v in enumerate(matcher.findall(row)): lsts[i].append(goodval(v))
+
+					# try and convert all of the non string lists into numpy arrays
+					for k in parms:
+						try:
+							x=float(self.curdict[k][0])		# if we can convert the first item to a float then we do the array conversion, not perfect, but will block most strings from conversion
+							self.curdict[k]=np.array(self.curdict[k])
+						except: pass
 
 		if len(self["default"])==0: del self["default"]
 
@@ -154,7 +277,7 @@ class StarFile3(dict):
 		spl=line.split(None,1)
 		key=spl[0][1:]
 		if len(spl)==2:
-			if spl[1][0] in ("'",'"') : return key,spl[1:-1]		# we assume the last non-whitespace character is the ending delimiter
+			if spl[1][0] in ("'",'"') : return key,spl[1][1:-1]		# we assume the last non-whitespace character is the ending delimiter
 			else:
 				try: return key,int(spl[1])
 				except:
@@ -177,6 +300,20 @@ class StarFile3(dict):
 
 		raise Exception("StarFile: Key-value pair error. Matching value not found. ",key)
 
+	def writefile(self,filename=None):
+		"""Writes all data_ blocks to disk using either the existing filename, or an alternative name passed in.
+		Keys which are part of a loop_ (self.loops) are written as loops, with all other keys written as single values."""
+		if filename==None: filename=self.filename
+		with open(filename,"w") as out:
+			for name,block in self.items():
+				out.write("\ndata_{}\n\n".format(name))
+				loops=self.loops.get(name,[])
+				inloop=set([k for l in loops for k in l])
+				for k,v in block.items():
+					if k not in inloop : out.write("_{} {}\n".format(k,star_value(v)))
+				out.write("\n")
+				for l in loops: write_loop(out,l,[block[k] for k in l])
+
 
 class StarFile(dict):
 	
@@ -187,6 +324,9 @@ If not set, it will read the first block encountered. Value should be of the for
 		self.filename=filename
 		self.dataname=dataname
 		self.loops=[]
+		self.loopblocks=[]		# the data_ block (name without "data_") each of self.loops was read from, for writefile()
+		self.valueblocks={}		# the same for single values, keyed by key
+		self.hidden=[]			# for each of self.loops, columns replaced in the dictionary by a later loop with the same name
 		
 		if os.path.isfile(filename) :
 			self.readfile()
@@ -202,6 +342,9 @@ If not set, it will read the first block encountered. Value should be of the for
 		"""This parses the STAR file, replacing any previous contents in the dictionary"""
 		
 		self.loops=[]
+		self.loopblocks=[]
+		self.valueblocks={}
+		self.hidden=[]
 		self.clear()
 		
 		matcher=re.compile("""("[^"]+")|('[^']+')|([^\s]+)""")
@@ -218,6 +361,8 @@ If not set, it will read the first block encountered. Value should be of the for
 			else:
 				raise Exception("Dataname '{}' not found".format(self.dataname))
 			self.lineptr=i+1
+		block=self.dataname
+		if block!=None and block[:5].lower()=="data_" : block=block[5:]
 		
 		while 1:
 			try: line=self._nextline().strip()
@@ -226,9 +371,10 @@ If not set, it will read the first block encountered. Value should be of the for
 			if line[0]=="_" :				# A single key/value pair
 				spl=line.split(None,1)		# split on whitespace
 				key=spl[0][1:]
+				self.valueblocks[key]=block
 				
 				if len(spl)==2:				# value on the same line
-					if spl[1][0] in ("'",'"') : self[key]=spl[1:-1]		# we assume the last non-whitespace character is the ending delimiter
+					if spl[1][0] in ("'",'"') : self[key]=spl[1][1:-1]		# we assume the last non-whitespace character is the ending delimiter
 					else:
 						try: val=int(spl[1])
 						except: 
@@ -256,18 +402,45 @@ If not set, it will read the first block encountered. Value should be of the for
 #					print("WARNING: second data_ block encountered in ",self.filename,". Cannot deal with this at present. Second block ignored")
 					return
 				self.dataname=line[5:]
+				block=self.dataname
 			elif line[:5].lower()=="loop_":
 				loop=[]
 				self.loops.append(loop)				# add it to the list of loops immediately then update it as we go
+				self.loopblocks.append(block)
+				self.hidden.append({})
 				# First we read the parameter names for the loop
 				while 1:
 					line2=self._nextline().strip()
 					if line2[0]=="_":
 						loop.append(line2.split()[0][1:])
+						# a merged block may reuse a column name (eg - rlnOpticsGroup), keep the earlier column for writefile()
+						for l,h in reversed(list(zip(self.loops[:-1],self.hidden[:-1]))):
+							if loop[-1] in l and loop[-1] not in h :
+								h[loop[-1]]=self[loop[-1]]
+								break
 						self[loop[-1]]=[]			# this will hold the data values when we read them
 					else: break
 				self.lineptr-=1
 				
+				# Blocks of simple values (the normal case) are converted a column at a time. Quoted and multi-line values
+				# fall through to the value by value parser below. Note that, as in the value by value parser, a data_ line
+				# immediately following a loop is skipped, so the next block is merged into this one (eg - the optics and
+				# particles blocks of Relion 3.1 files)
+				end=self.lineptr
+				while end<len(self.lines):
+					c=self.lines[end].lstrip()[:5].lower()
+					if c[:1] in ("_",";") or c in ("loop_","data_") : break
+					end+=1
+				if end==len(self.lines) or self.lines[end].lstrip()[:1]!=";" :
+					tokens=loop_tokens(self.lines[self.lineptr:end],matcher)
+					if len(loop)>0 and len(tokens)%len(loop)==0 :
+						for k,c in zip(loop,loop_columns(tokens,len(loop))): self[k]=c if isinstance(c,list) else c.tolist()
+						self.lineptr=end
+						if end<len(self.lines) and self.lines[end].lstrip()[:5].lower()=="data_" :
+							block=self.lines[end].strip()[5:]
+							self.lineptr+=1
+						continue
+
 				# Now we read the actual loop data elements
 				vals=[]
 				while 1:
@@ -302,9 +475,32 @@ If not set, it will read the first block encountered. Value should be of the for
 
 				
 	def writefile(self,filename=None):
-		"""Writes the contents of the current dictionary back to disk using either the existing filename, or an alternative name passed in"""
-		
-		print("Sorry, writing not implemented yet")
+		"""Writes the contents of the current dictionary back to disk using either the existing filename, or an alternative name passed in.
+		Keys listed in self.loops are written as loop_ columns, all others as single values. Loops and values are written back to the
+		data_ block they were read from, so merged blocks (eg - the optics and particles blocks of Relion 3.1 files) are split again.
+		Anything added since the file was read goes in the first block."""
+		if filename==None: filename=self.filename
+		name=self.dataname if self.dataname!=None else ""
+		if name[:5].lower()=="data_" : name=name[5:]
+		inloop=set([k for l in self.loops for k in l])
+
+		# the block of each value and loop, new ones go in the first block
+		valblocks={k:self.valueblocks.get(k,None) or name for k in self if k not in inloop}
+		loopblocks=[(self.loopblocks[i] if i<len(self.loopblocks) else None) or name for i in range(len(self.loops))]
+		hidden=[self.hidden[i] if i<len(self.hidden) else {} for i in range(len(self.loops))]
+		blocks=[]
+		for b in [name]+list(valblocks.values())+loopblocks:
+			if b not in blocks : blocks.append(b)
+
+		with open(filename,"w") as out:
+			for b in blocks:
+				vals=[(k,self[k]) for k in valblocks if valblocks[k]==b]
+				loops=[(l,h) for l,h,lb in zip(self.loops,hidden,loopblocks) if lb==b]
+				if len(vals)==0 and len(loops)==0 : continue
+				out.write("\ndata_{}\n\n".format(b))
+				for k,v in vals: out.write("_{} {}\n".format(k,star_value(v)))
+				out.write("\n")
+				for l,h in loops: write_loop(out,l,[h.get(k,self[k]) for k in l])
 					
 			
 			
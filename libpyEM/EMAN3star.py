@@ -36,6 +36,7 @@ import os.path
 import re
 import traceback
 import numpy as np
+from EMAN2star import loop_columns,loop_tokens,star_value,star_column,write_loop,iter_loop
 
 #from libpyEMData2 import EMData
 #from libpyUtils2 import EMUtil
@@ -126,17 +127,26 @@ class StarFile(dict):
 
 				self.loops[self.curdata].append(parms)		# store the list of column headers for potential later use
 
+				rows=[]
 				while len(line)>0 and line[0]!="_" and line[:5]!="data_" and line[:5]!="loop_":
-					for i,v in enumerate(matcher.findall(line)): lsts[i].append(goodval(v))
+					rows.append(line)
 					line=self.__readline(fin)
 
-				# try and convert all of the non string lists into numpy arrays
-				p=self.loops[self.curdata][-1]		# list of column names we just created
-				for k in p:
-					try:
-						x=float(self.curdict[k][0])		# if we can convert the first item to a float then we do the array conversion, not perfect, but will block most strings from conversion
-						self.curdict[k]=np.array(self.curdict[k])
-					except: pass
+				# whole columns are converted at once, numeric columns become numpy arrays, string columns remain lists
+				tokens=loop_tokens(rows,matcher)
+				if len(parms)>0 and len(tokens)%len(parms)==0:
+					for k,c in zip(parms,loop_columns(tokens,len(parms))): self.curdict[k]=c
+				else:
+					# ragged rows, fall back to the value by value conversion
+					for row in rows:
+						for i,v in enumerate(matcher.findall(row)): lsts[i].append(goodval(v))
+
+					# try and convert all of the non string lists into numpy arrays
+					for k in parms:
+						try:
+							x=float(self.curdict[k][0])		# if we can convert the first item to a float then we do the array conversion, not perfect, but will block most strings from conversion
+							self.curdict[k]=np.array(self.curdict[k])
+						except: pass
 
 		if len(self["default"])==0: del self["default"]
 
@@ -153,7 +163,7 @@ class StarFile(dict):
 		spl=line.split(None,1)
 		key=spl[0][1:]
 		if len(spl)==2:
-			if spl[1][0] in ("'",'"') : return key,spl[1:-1]		# we assume the last non-whitespace character is the ending delimiter
+			if spl[1][0] in ("'",'"') : return key,spl[1][1:-1]		# we assume the last non-whitespace character is the ending delimiter
 			else:
 				try: return key,int(spl[1])
 				except:
@@ -176,5 +186,19 @@ class StarFile(dict):
 
 		raise Exception("StarFile: Key-value pair error. Matching value not found. ",key)
 
+	def writefile(self,filename=None):
+		"""Writes all data_ blocks to disk using either the existing filename, or an alternative name passed in.
+		Keys which are part of a loop_ (self.loops) are written as loops, with all other keys written as single values."""
+		if filename==None: filename=self.filename
+		with open(filename,"w") as out:
+			for name,block in self.items():
+				out.write("\ndata_{}\n\n".format(name))
+				loops=self.loops.get(name,[])
+				inloop=set([k for l in loops for k in l])
+				for k,v in block.items():
+					if k not in inloop : out.write("_{} {}\n".format(k,star_value(v)))
+				out.write("\n")
+				for l in loops: write_loop(out,l,[block[k] for k in l])
+
 
 
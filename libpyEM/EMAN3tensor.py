@@ -59,60 +59,48 @@ np.fromfunction(lambda x,y: np.hypot(x,y),(nx,ny)) - for example
 from EMAN3 import *
 import tensorflow as tf
 import numpy as np
+import threading
 
 class StackCache():
 	"""This object serves as a cache of EMStack objects which can be conveniently read back in. This provides
 	methods for easy/efficient sampling of subsets of data sets which may be too large for RAM. Caches are not persistent across sessions
-	Writing images to the cache will coerce them to tensorflow representation."""
+	Images are stored with a fixed stride in a memory mapped file, so any subset is read back with a single indexing operation,
+	and reads may safely be made from multiple threads. All images in the cache must have the same shape and type, normally complex64 FFTs."""
 
 	def __init__(self,filename,n):
 		"""Specify filename and number of images to be cached."""
 		self.filename=filename
+		self.n=n
 
-		self.fp=open(filename,"wb+")		# erase file!
-		self.locs=np.zeros(n+1,dtype=np.int64)
+		open(filename,"wb").close()		# erase file!
+		self.data=None		# memory mapped {N,Y,X} array, created by the first write once the image shape is known
 		self.orts=np.zeros((n,3),dtype=np.float32)
 		self.tytx=np.zeros((n,2),dtype=np.float32)
-		self.cloc=0
-		self.locked=False
+		self.lock=threading.Lock()
 
 	def __del__(self):
 		"""free all resources if possible"""
-		self.fp=None
-		os.unlink(self.filename)
-		self.locs=None
+		self.data=None
+		try: os.unlink(self.filename)
+		except: pass
 
 	def write(self,stack,n0,ortss=None,tytxs=None):
 		"""writes stack of images starting at n0 to cache"""
-		while self.locked: time.sleep(0.1)
-		self.locked=True
-		stack.coerce_tensor()
-		if ortss is not None: self.orts[n0:n0+len(stack)]=ortss.numpy
-		if tytxs is not None: self.tytx[n0:n0+len(stack)]=tytxs
-
-		# we go through the images one at a time, serialze, and write to a file with a directory
-		self.fp.seek(self.cloc)
-		for i in range(len(stack)):
-			im=stack[i]
-			self.locs[n0+i]=self.cloc
-			self.fp.write(tf.io.serialize_tensor(im).numpy())
-			self.cloc=self.fp.tell()
-			self.locs[n0+i+1]=self.cloc
-
-		self.locked=False
+		ary=stack.tensor.numpy()
+		with self.lock:
+			if self.data is None:
+				self.data=np.memmap(self.filename,dtype=ary.dtype,mode="w+",shape=(self.n,)+ary.shape[1:])
+			elif self.data.shape[1:]!=ary.shape[1:] or self.data.dtype!=ary.dtype:
+				raise Exception(f"StackCache: cannot write {ary.dtype} {ary.shape[1:]} images to a cache of {self.data.dtype} {self.data.shape[1:]}")
+			self.data[n0:n0+len(ary)]=ary
+			if ortss is not None: self.orts[n0:n0+len(stack)]=ortss.numpy
+			if tytxs is not None: self.tytx[n0:n0+len(stack)]=tytxs
 
 	def read(self,nlist):
-		while self.locked: time.sleep(0.1)
-
-		self.locked=True
-
-		stack=[]
-		for i in nlist:
-			self.fp.seek(self.locs[i])
-			stack.append(tf.io.parse_tensor(self.fp.read(self.locs[i+1]-self.locs[i]),out_type=tf.complex64))
-
-		self.locked=False
-		ret=EMStack2D(tf.stack(stack))
+		"""reads the images in nlist (any sequence of image numbers) from the cache, returning (EMStack2D,Orientations,tytx)"""
+		if self.data is None: raise Exception("StackCache: cannot read before any images have been written, the image shape isn't known yet")
+		nlist=np.array(nlist,dtype=np.int64)
+		ret=EMStack2D(tf.constant(self.data[nlist]))		# fancy indexing copies only the requested images out of the mapping
 		orts=Orientations(self.orts[nlist])
 		tytx=self.tytx[nlist]
 		return ret,orts,tytx
@@ -127,15 +115,19 @@ class EMStack():
 	  but beware, as coercing the EMDataStack to a differnt type will invalidate these NumPy arrays, and could create a crash!
 
 	Individual images in the stack may be accessed using [n]
+
+	Stacks too large for RAM may be backed by a memory mapped NumPy array (see to_memmap() and images_to_memmap()). Only
+	the images actually used are then read from disk, and chunks() can be used to coerce/process the stack a piece at a time.
 	"""
 
 	def __init__(self,imgs=None):
 		"""	imgs - one of:
 		None
 		filename, with optional ":" range specifier (see https://eman2.org/ImageFormats)
+		filename of a .npy file, which will be memory mapped copy-on-write rather than read, so the file is never modified
 		single EMData object
 		list or tuple of EMData objects
-		numpy array, with first axis being image number {N,Z,Y,X} | {N,Y,X} | {N,X}
+		numpy array (including np.memmap), with first axis being image number {N,Z,Y,X} | {N,Y,X} | {N,X}
 		Tensor, with first axis being image number {N,Z,Y,X} ...
 		"""
 		self._data=None	# representation in whatever the current format is
@@ -189,6 +181,38 @@ class EMStack():
 		if self._npy_list is not None: return
 		self._npy_list=[i.numpy() for i in self._data]
 
+	@property
+	def is_memmap(self):
+		"""True if the stack is backed by a memory mapped file"""
+		return isinstance(self._data,np.memmap)
+
+	def chunks(self,n=1000):
+		"""Iterates over the stack as new stacks of (at most) n images each, sharing the current representation. For a memory
+		mapped stack, nothing is read until a chunk is used, so this permits coercing/processing one chunk at a time.
+		Orientations (for EMStack2D) are kept with their images."""
+		xforms=getattr(self,"_xforms",None)
+		for i in range(0,len(self),n):
+			ret=self.__class__(self._data[i:i+n])
+			if xforms is not None: ret._xforms=xforms[i:i+n]
+			yield ret
+
+	def to_memmap(self,fsp,chunk=1000):
+		"""Moves the stack into a memory mapped .npy file fsp (float32 or complex64), replacing the current representation.
+		The data is converted chunk images at a time, so there is never a second full copy in RAM. Returns self."""
+		if isinstance(self._data,list): dtype=np.float32
+		elif isinstance(self._data,tf.Tensor): dtype=self._data.dtype.as_numpy_dtype
+		else: dtype=self._data.dtype
+		ary=np.lib.format.open_memmap(fsp,mode="w+",dtype=dtype,shape=tuple(int(i) for i in self.shape))
+		for i in range(0,len(self),chunk):
+			part=self._data[i:i+chunk]
+			if isinstance(part,list): part=np.stack([im.numpy() for im in part])
+			elif isinstance(part,tf.Tensor): part=part.numpy()
+			ary[i:i+len(part)]=part
+		ary.flush()
+		self._data=ary
+		self._npy_list=None
+		return self
+
 	def coerce_emdata(self):
 		"""Forces the current representation to EMData/NumPy"""
 		if isinstance(self._data,list): return
@@ -264,6 +288,10 @@ class EMStack3D(EMStack):
 			elif len(imgs.shape)!=4: raise Exception(f"EMStack3D only supports stacks of 3-D data, the provided images were {len(imgs.shape)}-D")
 			self._data=imgs
 			self._npy_list=None
+		elif isinstance(imgs,str) and imgs.endswith(".npy"):
+			self._data=np.load(imgs,mmap_mode="c")
+			if len(self._data.shape)!=4: raise Exception(f"EMStack3D only supports stacks of 3-D data. {imgs} is {len(self._data.shape)-1}-D")
+			self._npy_list=None
 		elif isinstance(imgs,str):
 			self._data=EMData.read_images(imgs)
 			if imgs[0].get_ndim()!=3: raise Exception(f"EMStack3D only supports stacks of 3-D data. {imgs} is {imgs[0].get_ndim()}-D")
@@ -354,6 +382,10 @@ class EMStack2D(EMStack):
 			if len(imgs.shape)!=3: raise Exception(f"EMStack2D only supports stacks of 2-D data, the provided images were {len(imgs.shape)}-D")
 			self._data=imgs
 			self._npy_list=None
+		elif isinstance(imgs,str) and imgs.endswith(".npy"):
+			self._data=np.load(imgs,mmap_mode="c")
+			if len(self._data.shape)!=3: raise Exception(f"EMStack2D only supports stacks of 2-D data. {imgs} is {len(self._data.shape)-1}-D")
+			self._npy_list=None
 		elif isinstance(imgs,str):
 			self._data=EMData.read_images(imgs)
 			try: self._xforms=[im["xform.projection"] for im in self._data]
@@ -657,75 +689,93 @@ stddev=0.01"""
 		thr=tf.math.reduce_mean(self._data[:,3])+sig*tf.math.reduce_std(self._data[:,3])
 		self._data=tf.boolean_mask(self._data,self._data[:,3]>thr)					# remove any gaussians with amplitude below threshold
 
-	def project_simple(self,orts,boxsize,tytx=None):
+	def project_simple(self,orts,boxsize,tytx=None,chunk=None):
 		"""Generates a tensor containing a simple 2-D projection (interpolated delta functions) of the set of Gaussians for each of N Orientations in orts.
 		orts - must be an Orientations object
 		tytx =  is an (optional) N x 2+ vector containing an in-plane translation in unit (-0.5 - 0.5) coordinates to be applied to the set of Gaussians for each Orientation.
 		boxsize in pixels. Scaling factor is equal to boxsize, such that -0.5 to 0.5 range covers the box.
+		chunk - (optional) maximum number of orientations to project in a single batch. All N projections are otherwise computed with
+			a single einsum and scatter, which requires intermediate tensors of size N x 4 x len(Gaussians). Set this to bound memory use.
 
 		With these definitions, Gaussian coordinates are sampling-independent as long as no box size alterations are performed. That is, raw projection data
 		used for comparisons should be resampled without any "clip" operations.
 		"""
 		self.coerce_tensor()
 
-#		proj=tf.zeros((len(orts),boxsize,boxsize))		# projections
-		proj=tf.zeros((boxsize,boxsize))		# projections
-		proj2=[]
 		mx=orts.to_mx2d(swapxy=True)
+		n=mx.shape[2]
+		if chunk is None or chunk<=0 or chunk>=n: return EMStack2D(self.project_batch(mx,boxsize,tytx))
 
-		# iterate over projections
-		# TODO - at some point this outer loop should be converted to a tensor axis for better performance
-		for j in range(len(orts)):
-			xfgauss=tf.einsum("ij,kj->ki",mx[:,:,j],self._data[:,:3])	# changed to ik instead of ki due to y,x ordering in tensorflow
-			if tytx is not None:
-				#print(xfgauss.shape,tytx.shape)
-				xfgauss+=tytx[j,:2]	# translation, ignore z or any other variables which might be used for per particle defocus, etc
-			xfgauss=(xfgauss+0.5)*boxsize		# shift and scale both x and y the same
-
-			xfgaussf=tf.floor(xfgauss)
-			xfgaussi=tf.cast(xfgaussf,tf.int32)	# integer index
-			xfgaussf=xfgauss-xfgaussf				# remainder used for bilinear interpolation
-
-			# print(xfgaussf,xfgaussi)
-			# print(xfgaussf.shape,xfgaussi.shape,self._data.shape,self._data[:,3].shape)
-			# messy tensor math here to implement bilinear interpolation
-			bamp0=self._data[:,3]*(1.0-xfgaussf[:,0])*(1.0-xfgaussf[:,1])	#0,0
-			bamp1=self._data[:,3]*(xfgaussf[:,0])*(1.0-xfgaussf[:,1])		#1,0
-			bamp2=self._data[:,3]*(xfgaussf[:,0])*(xfgaussf[:,1])			#1,1
-			bamp3=self._data[:,3]*(1.0-xfgaussf[:,0])*(xfgaussf[:,1])		#0,1
-			bampall=tf.concat([bamp0,bamp1,bamp2,bamp3],0)  # TODO: this would be ,1 with the loop subsumed
-			bposall=tf.concat([xfgaussi,xfgaussi+(1,0),xfgaussi+(1,1),xfgaussi+(0,1)],0) # TODO: this too
-			proj2.append(tf.tensor_scatter_nd_add(proj,bposall,bampall))
-
-		return EMStack2D(tf.stack(proj2))
-		#proj=tf.stack([tf.tensor_scatter_nd_add(proj[i],bposall[i],bampall[i]) for i in range(proj.shape[0])])
+		projs=[self.project_batch(mx[:,:,i:i+chunk],boxsize,None if tytx is None else tytx[i:i+chunk]) for i in range(0,n,chunk)]
+		return EMStack2D(tf.concat(projs,0))
 
-	def volume(self,boxsize):
+	def project_batch(self,mx,boxsize,tytx=None):
+		"""Computes projections for a 2 x 3 x N stack of projection matrices (from Orientations.to_mx2d(swapxy=True)) in a single operation.
+		Returns an N x boxsize x boxsize tensor. Normally called via project_simple()."""
 		self.coerce_tensor()
+		n=mx.shape[2]
+		ng=self._data.shape[0]
 
-		vol=tf.zeros((boxsize,boxsize,boxsize))		# projections
+		xfgauss=tf.einsum("ijn,kj->nki",mx,self._data[:,:3])	# N x ng x 2, output is y,x due to swapxy
+		if tytx is not None:
+			xfgauss+=tytx[:,None,:2]	# translation, ignore z or any other variables which might be used for per particle defocus, etc
+		xfgauss=(xfgauss+0.5)*boxsize		# shift and scale both x and y the same
 
-		xfgauss=tf.reverse((self._data[:,:3]+0.5)*boxsize,[-1])		# shift and scale both x and y the same, reverse handles the XYZ -> ZYX EMData->Tensorflow issue
+		xfgaussf=tf.floor(xfgauss)
+		xfgaussi=tf.cast(xfgaussf,tf.int32)	# integer index
+		xfgaussf=xfgauss-xfgaussf				# remainder used for bilinear interpolation
+
+		# bilinear interpolation, each term is N x ng
+		amp=self._data[:,3]
+		bamp0=amp*(1.0-xfgaussf[:,:,0])*(1.0-xfgaussf[:,:,1])	#0,0
+		bamp1=amp*(xfgaussf[:,:,0])*(1.0-xfgaussf[:,:,1])		#1,0
+		bamp2=amp*(xfgaussf[:,:,0])*(xfgaussf[:,:,1])			#1,1
+		bamp3=amp*(1.0-xfgaussf[:,:,0])*(xfgaussf[:,:,1])		#0,1
+		bampall=tf.concat([bamp0,bamp1,bamp2,bamp3],1)		# N x 4ng
+		bposall=tf.concat([xfgaussi,xfgaussi+(1,0),xfgaussi+(1,1),xfgaussi+(0,1)],1)	# N x 4ng x 2
+
+		# prepend the projection number to each y,x index so all N projections are filled by a single scatter
+		bidx=tf.broadcast_to(tf.reshape(tf.range(n,dtype=tf.int32),(n,1,1)),(n,4*ng,1))
+		bposall=tf.concat([bidx,bposall],2)
+
+		return tf.tensor_scatter_nd_add(tf.zeros((n,boxsize,boxsize)),bposall,bampall)
+
+	def volume(self,boxsize):
+		"""Generates a single boxsize^3 volume (as a 1 element EMStack3D) from the current set of Gaussians by trilinear interpolation"""
+		return Gaussians.volumes((self,),boxsize)
+
+	@staticmethod
+	def volumes(gaussets,boxsize):
+		"""Generates an EMStack3D containing one boxsize^3 volume for each element of gaussets with a single scatter operation.
+		gaussets - list of Gaussians objects or N x 4 arrays/tensors. Each set may contain a different number of Gaussians."""
+		datas=[g.tensor if isinstance(g,Gaussians) else Gaussians(g).tensor for g in gaussets]
+		data=tf.concat(datas,0)
+		nv=len(datas)
+		vidx=tf.concat([tf.fill((d.shape[0],1),i) for i,d in enumerate(datas)],0)	# volume number for each Gaussian
+
+		vol=tf.zeros((nv,boxsize,boxsize,boxsize))		# volumes
+
+		xfgauss=tf.reverse((data[:,:3]+0.5)*boxsize,[-1])		# shift and scale both x and y the same, reverse handles the XYZ -> ZYX EMData->Tensorflow issue
 
 		xfgaussf=tf.floor(xfgauss)
 		xfgaussi=tf.cast(xfgaussf,tf.int32)	# integer index
 		xfgaussf=xfgauss-xfgaussf				# remainder used for bilinear interpolation
 
 		# messy trilinear interpolation
-		bamp000=self._data[:,3]*(1.0-xfgaussf[:,0])*(1.0-xfgaussf[:,1])*(1.0-xfgaussf[:,2])
-		bamp001=self._data[:,3]*(1.0-xfgaussf[:,0])*(1.0-xfgaussf[:,1])*(    xfgaussf[:,2])
-		bamp010=self._data[:,3]*(1.0-xfgaussf[:,0])*(    xfgaussf[:,1])*(1.0-xfgaussf[:,2])
-		bamp011=self._data[:,3]*(1.0-xfgaussf[:,0])*(    xfgaussf[:,1])*(    xfgaussf[:,2])
-		bamp100=self._data[:,3]*(    xfgaussf[:,0])*(1.0-xfgaussf[:,1])*(1.0-xfgaussf[:,2])
-		bamp101=self._data[:,3]*(    xfgaussf[:,0])*(1.0-xfgaussf[:,1])*(    xfgaussf[:,2])
-		bamp110=self._data[:,3]*(    xfgaussf[:,0])*(    xfgaussf[:,1])*(1.0-xfgaussf[:,2])
-		bamp111=self._data[:,3]*(    xfgaussf[:,0])*(    xfgaussf[:,1])*(    xfgaussf[:,2])
+		bamp000=data[:,3]*(1.0-xfgaussf[:,0])*(1.0-xfgaussf[:,1])*(1.0-xfgaussf[:,2])
+		bamp001=data[:,3]*(1.0-xfgaussf[:,0])*(1.0-xfgaussf[:,1])*(    xfgaussf[:,2])
+		bamp010=data[:,3]*(1.0-xfgaussf[:,0])*(    xfgaussf[:,1])*(1.0-xfgaussf[:,2])
+		bamp011=data[:,3]*(1.0-xfgaussf[:,0])*(    xfgaussf[:,1])*(    xfgaussf[:,2])
+		bamp100=data[:,3]*(    xfgaussf[:,0])*(1.0-xfgaussf[:,1])*(1.0-xfgaussf[:,2])
+		bamp101=data[:,3]*(    xfgaussf[:,0])*(1.0-xfgaussf[:,1])*(    xfgaussf[:,2])
+		bamp110=data[:,3]*(    xfgaussf[:,0])*(    xfgaussf[:,1])*(1.0-xfgaussf[:,2])
+		bamp111=data[:,3]*(    xfgaussf[:,0])*(    xfgaussf[:,1])*(    xfgaussf[:,2])
 		bampall=tf.concat([bamp000,bamp001,bamp010,bamp011,bamp100,bamp101,bamp110,bamp111],0)
-		bposall=tf.concat([xfgaussi,xfgaussi+(0,0,1),xfgaussi+(0,1,0),xfgaussi+(0,1,1),xfgaussi+(1,0,0),xfgaussi+(1,0,1),xfgaussi+(1,1,0),xfgaussi+(1,1,1)],0)
+		xfgaussi=tf.concat([vidx,xfgaussi],1)
+		bposall=tf.concat([xfgaussi,xfgaussi+(0,0,0,1),xfgaussi+(0,0,1,0),xfgaussi+(0,0,1,1),xfgaussi+(0,1,0,0),xfgaussi+(0,1,0,1),xfgaussi+(0,1,1,0),xfgaussi+(0,1,1,1)],0)
 		vol=tf.tensor_scatter_nd_add(vol,bposall,bampall)
 
 		return EMStack3D(vol)
-		#proj=tf.stack([tf.tensor_scatter_nd_add(proj[i],bposall[i],bampall[i]) for i in range(proj.shape[0])])
 
 
 def tf_set_device(dev=0,maxmem=4096):
@@ -754,6 +804,20 @@ def from_tf(tftensor,stack=False):
 		return [EMNumPy.numpy2em(tftensor[i].numpy()) for i in range(tftensor.shape[0])]
 	return EMNumPy.numpy2em(tftensor.numpy())
 
+def images_to_memmap(fsp,npyfsp,chunk=1000):
+	"""Reads the image stack in fsp, chunk images at a time, into a float32 .npy file {N,Y,X} or {N,Z,Y,X}, which may then be
+	opened as a memory mapped EMStack2D/3D without ever holding the full stack in RAM. Returns the memory mapped array."""
+	n=EMUtil.get_image_count(fsp)
+	hdr=EMData(fsp,0,True)
+	if hdr["nz"]>1: shape=(n,hdr["nz"],hdr["ny"],hdr["nx"])
+	else: shape=(n,hdr["ny"],hdr["nx"])
+	ary=np.lib.format.open_memmap(npyfsp,mode="w+",dtype=np.float32,shape=shape)
+	for i in range(0,n,chunk):
+		imgs=EMData.read_images(fsp,range(i,min(i+chunk,n)))
+		ary[i:i+len(imgs)]=np.stack([im.numpy() for im in imgs])
+	ary.flush()
+	return ary
+
 def to_tfvar(emdata):
 	"""Convert a specified EMData object or list of EMData objects into a TensorFlow Variable. WARNING many tensorflow operations are very inefficient with Variable tensors!"""
 	if isinstance(emdata,EMData):
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+#
+# Author: Steven Ludtke (sludtke@bcm.edu)
+# Copyright (c) 2000-2006 Baylor College of Medicine
+#
+# This software is issued under a joint BSD/GNU license. You may use the
+# source code in this file under either license. However, note that the
+# complete EMAN2 and SPARX software packages have some GPL dependencies,
+# so you are responsible for compliance with the licenses of these packages
+# if you opt to use BSD licensing. The warranty disclaimer below holds
+# in either instance.
+#
+# This complete copyright notice must be included in any revised version of the
+# source code. Additional authorship citations may be added, but existing
+# author citations must be preserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston MA 02111-1307 USA
+#
+#
+
+from builtins import range
+from builtins import object
+from collections import OrderedDict
+import threading
+import traceback
+import weakref
+
+# This module has no Qt/OpenGL dependencies, so the caching logic used by the image matrix viewer (emimagemx)
+# can be used and tested without a display
+
+def image_bytes(image):
+	"""Approximate memory used by an EMData object"""
+	return image.get_xsize()*image.get_ysize()*image.get_zsize()*4
+
+def image_thumbnail(image,shrink):
+	"""Default thumbnail generator for EMPrefetchCache"""
+	return image.process("math.meanshrink",{"n":shrink})
+
+class EMPrefetchCache(object):
+	'''
+	A thread-backed cache for browsing large numbers of images (0 to n-1) in order. The caller supplies a loader function
+	taking an index and returning an image. Images are retained in least recently used order up to a total of max_bytes,
+	and a background thread reads up to window images ahead of the visible region, in the direction the display is
+	being scrolled. Images in the visible region are never evicted.
+
+	If thumb_shrink>1, read-ahead images which don't fit in max_bytes are kept as downsampled thumbnails, made from the
+	image as it was read, so a much larger window fits in memory. get_display() will return a thumbnail, if available,
+	rather than waiting for the full image to be read again. There is no cheaper way to read a downsampled image, so
+	thumbnails don't make the first display of an image any faster.
+
+	Only one image is read at a time, whether by the background thread or by get().
+	'''
+
+	def __init__(self,n,loader,max_bytes=1024*1024*1024,window=256,thumb_shrink=0,thumbnailer=image_thumbnail,sizefn=image_bytes):
+		'''
+		@param n number of images
+		@param loader function taking an index and returning the corresponding image
+		@param max_bytes memory budget for cached images and thumbnails
+		@param window maximum number of images to read ahead of the visible region
+		@param thumb_shrink downsampling factor for thumbnails, 0 or 1 to disable
+		@param thumbnailer function taking an image and a shrink factor, returning a thumbnail
+		@param sizefn function returning the number of bytes used by an image
+		'''
+		self.n = n
+		self.loader = loader
+		self.max_bytes = max_bytes
+		self.window = window
+		self.thumb_shrink = thumb_shrink
+		self.thumbnailer = thumbnailer
+		self.sizefn = sizefn
+
+		self.cache = OrderedDict()	# keyed by (idx,shrink), shrink is 1 for full images. In least recently used order
+		self.nbytes = 0
+		self.visible = (0,0)		# first and last visible index
+		self.direction = 1			# 1 when scrolling forward, -1 backward
+		self.generation = 0			# incremented whenever the prefetch plan needs to be recomputed
+		self.epoch = 0				# incremented by clear(), images read before then are discarded rather than stored
+		self.changed = False		# set when a visible image or thumbnail has been loaded in the background
+
+		self.lock = threading.Condition()	# protects everything above
+		self.io_lock = threading.Lock()		# held while reading an image
+		self.thread = None
+		self.closed = False
+
+	def __del__(self):
+		try: self.close()
+		except: pass		# eg - at interpreter shutdown
+
+	def __len__(self): return self.n
+
+	def __contains__(self,idx):
+		with self.lock: return (idx,1) in self.cache
+
+	def clear(self,n=None):
+		'''
+		Empties the cache, eg - if the list of images has changed
+		@param n the new number of images, if changed
+		'''
+		with self.lock:
+			if n is not None: self.n = n
+			self.cache.clear()
+			self.nbytes = 0
+			self.generation += 1
+			self.epoch += 1
+			self.lock.notify()
+
+	def close(self):
+		'''
+		Stops the background thread
+		'''
+		with self.lock:
+			self.closed = True
+			self.lock.notify()
+
+	def peek(self,idx):
+		'''
+		Returns the full image if already cached, otherwise None. Does not read anything.
+		'''
+		with self.lock:
+			try:
+				img = self.cache[(idx,1)]
+				self.cache.move_to_end((idx,1))
+				return img
+			except KeyError: return None
+
+	def get(self,idx):
+		'''
+		Returns the full image, reading it if necessary
+		'''
+		img = self.peek(idx)
+		if img is not None: return img
+
+		with self.io_lock:
+			img = self.peek(idx)		# the background thread may have just read it
+			if img is not None: return img
+			epoch = self.epoch
+			img = self.loader(idx)
+
+		if img is not None: self.store(idx,img,epoch=epoch)
+		self.start()
+		return img
+
+	def get_display(self,idx):
+		'''
+		Returns (image,shrink). If the full image is not yet cached, but a thumbnail is, this will return the thumbnail
+		and its downsampling factor. Otherwise the full image is returned (and read if necessary) with shrink=1.
+		'''
+		img = self.peek(idx)
+		if img is not None: return img,1
+
+		if self.thumb_shrink > 1:
+			with self.lock:
+				try: return self.cache[(idx,self.thumb_shrink)],self.thumb_shrink
+				except KeyError: pass
+
+		return self.get(idx),1
+
+	def set_visible(self,first,last):
+		'''
+		Tells the cache which images are currently being displayed, which determines what is prefetched
+		'''
+		with self.lock:
+			if (first,last) == self.visible: return
+			if first > self.visible[0]: self.direction = 1
+			elif first < self.visible[0]: self.direction = -1
+			self.visible = (first,last)
+			self.generation += 1
+			self.lock.notify()
+		self.start()
+
+	def check_changed(self):
+		'''
+		Returns True (once) if images in the visible region were loaded in the background since the last call
+		'''
+		with self.lock:
+			ret = self.changed
+			self.changed = False
+		return ret
+
+	def store(self,idx,img,shrink=1,epoch=None):
+		'''
+		Adds an image (or thumbnail) to the cache, evicting least recently used images outside the visible region as
+		necessary to stay within max_bytes. Storing a full image discards its thumbnail.
+		@param epoch the value of self.epoch when the image was read. If clear() has been called since, the image may
+		belong to the old list of images, so it is discarded.
+		'''
+		with self.lock:
+			if epoch is not None and epoch != self.epoch: return
+			key = (idx,shrink)
+			if key in self.cache: self.nbytes -= self.sizefn(self.cache[key])
+			self.cache[key] = img
+			self.cache.move_to_end(key)
+			self.nbytes += self.sizefn(img)
+
+			if shrink == 1 and (idx,self.thumb_shrink) in self.cache:
+				self.nbytes -= self.sizefn(self.cache.pop((idx,self.thumb_shrink)))
+
+			if self.visible[0] <= idx <= self.visible[1]: self.changed = True
+
+			if self.nbytes > self.max_bytes:
+				for k in list(self.cache.keys()):
+					if self.visible[0] <= k[0] <= self.visible[1] or k == key: continue
+					self.nbytes -= self.sizefn(self.cache.pop(k))
+					if self.nbytes <= self.max_bytes: break
+
+	def start(self):
+		'''
+		Starts the background thread if it isn't running
+		'''
+		with self.lock:
+			if self.thread is not None or self.closed: return
+			self.thread = threading.Thread(target=EMPrefetchCache.prefetch_thread,args=(weakref.ref(self),))
+			self.thread.daemon = True
+			self.thread.start()
+
+	def plan(self):
+		'''
+		Returns the list of indices to prefetch, in order of priority. Called with self.lock held.
+		'''
+		first,last = self.visible
+		last = min(last,self.n-1)
+		ret = list(range(first,last+1))
+		if self.direction > 0:
+			ret.extend(range(last+1,min(self.n,last+1+self.window)))
+			ret.extend(range(first-1,max(-1,first-1-self.window//4),-1))
+		else:
+			ret.extend(range(first-1,max(-1,first-1-self.window),-1))
+			ret.extend(range(last+1,min(self.n,last+1+self.window//4)))
+		return ret
+
+	@staticmethod
+	def prefetch_thread(ref):
+		'''
+		Background thread. Calls prefetch() each time the visible region changes, until the cache is closed. Between passes
+		only a weak reference to the cache is held, so a cache which is no longer used is still deleted (which closes it)
+		'''
+		done = -1
+		while 1:
+			cache = ref()
+			if cache is None: return
+			with cache.lock:
+				if done == cache.generation and not cache.closed: cache.lock.wait(1.0)
+				if cache.closed: return
+				idle = done == cache.generation
+			if not idle: done = cache.prefetch()
+			cache = None
+
+	def prefetch(self):
+		'''
+		Reads images according to plan() until the plan is complete, the memory budget is full or the visible region
+		changes. Each image is read once. It is kept in full if it is visible or fits in the budget, otherwise (with
+		thumb_shrink>1) only a thumbnail made from it is kept. Returns the generation the plan was made for.
+		'''
+		with self.lock:
+			gen = self.generation
+			epoch = self.epoch
+			todo = self.plan()
+
+		thumbs = self.thumb_shrink > 1
+		for idx in todo:
+			with self.lock:
+				if gen != self.generation or self.closed: break
+				visible = self.visible[0] <= idx <= self.visible[1]
+				if (idx,1) in self.cache: continue
+				# a thumbnail is only kept when the full image didn't fit, so reading it again won't help
+				if not visible and thumbs and (idx,self.thumb_shrink) in self.cache: continue
+				# once the budget is full we stop reading ahead rather than evicting images we just read
+				if not visible and self.nbytes >= self.max_bytes: break
+
+			try:
+				with self.io_lock:
+					if (idx,1) in self: continue
+					img = self.loader(idx)
+			except:
+				traceback.print_exc()
+				continue
+
+			if img is None: continue
+			with self.lock: full = visible or not thumbs or self.nbytes+self.sizefn(img) <= self.max_bytes
+			if full: self.store(idx,img,epoch=epoch)
+			else: self.store(idx,self.thumbnailer(img,self.thumb_shrink),self.thumb_shrink,epoch)
+
+		return gen
@@ -60,6 +60,7 @@ from .emanimationutil import LineAnimation
 import weakref
 
 from .emapplication import EMProgressDialog
+from .emimagecache import EMPrefetchCache
 
 
 class EMMatrixPanel(object):
@@ -298,6 +299,10 @@ class EMImageMXWidget(EMGLWidget, EMGLProjectionViewMatrices):
 
 		self.reroute_delete = False
 
+		self.updtimer = QtCore.QTimer()		# redraws when the data cache has read visible images in a background thread
+		self.updtimer.timeout.connect(self.check_data_changed)
+		self.updtimer.start(250)
+
 		if data:
 			self.set_data(data)
 
@@ -363,7 +368,9 @@ class EMImageMXWidget(EMGLWidget, EMGLProjectionViewMatrices):
 		return self.renderPixmap(0,0,True)
 
 	def closeEvent(self,event):
+		self.updtimer.stop()
 		self.clear_gl_memory()
+		if self.data != None: self.data.close()		# stops any background reading
 		EMGLWidget.closeEvent(self, event)
 
 	def set_current_set(self,name):
@@ -676,6 +683,12 @@ class EMImageMXWidget(EMGLWidget, EMGLProjectionViewMatrices):
 		self.display_states = []
 		self.update_inspector_texture()
 
+	def check_data_changed(self):
+		'''Called by a timer, redraws if images or thumbnails being displayed were read in the background'''
+		if self.data!=None and self.data.check_changed() :
+			self.force_display_update()
+			self.updateGL()
+
 	def set_img_num_offset(self,n):
 		self.img_num_offset = n
 		self.force_display_update() # empty display lists causes an automatic regeneration of the display list
@@ -773,10 +786,12 @@ class EMImageMXWidget(EMGLWidget, EMGLProjectionViewMatrices):
 			self.rzonce=True
 		else: needresize=False
 
+		olddata = self.data
 		if isinstance(obj, EMMXDataCache) :
 			self.data = obj
 		else :
 			self.data = self.__get_cache(obj, soft_delete)
+		if olddata != None and olddata is not self.data: olddata.close()
 
 		if self.data == None : 
 			return
@@ -1135,13 +1150,16 @@ class EMImageMXWidget(EMGLWidget, EMGLProjectionViewMatrices):
 			dpr=self.devicePixelRatio()
 
 			if self.matrix_panel.visiblerows:
+				self.data.set_visible(self.matrix_panel.ystart*self.matrix_panel.visiblecols,min(n,self.matrix_panel.visiblerows*self.matrix_panel.visiblecols)-1)
 				for row in range(self.matrix_panel.ystart,self.matrix_panel.visiblerows):
 					for col in range(0,self.matrix_panel.visiblecols):
 						i = int((row)*self.matrix_panel.visiblecols+col)
 
 						if i >= n:
 							break
-						if self.data[i]==None:
+						# the cache may give us a downsampled thumbnail if the full image hasn't been read yet
+						img,shrink=self.data.get_display_image(i)
+						if img==None:
 							print("Bad image in imagemx display: ",i)
 							continue
 
@@ -1195,10 +1213,10 @@ class EMImageMXWidget(EMGLWidget, EMGLProjectionViewMatrices):
 						if not excluded:
 							#print rx,ry,tw,th,self.width(),self.height(),self.origin
 							if self.usetexture and (not self.glflags.npt_textures_unsupported()):
-								a=GLUtil.render_amp8(self.data[i],rx,ry,tw,th,(tw-1)//4*4+4,self.scale*dpr,pixden[0],pixden[1],self.minden,self.maxden,self.gamma,2)
+								a=GLUtil.render_amp8(img,rx//shrink,ry//shrink,tw,th,(tw-1)//4*4+4,self.scale*dpr*shrink,pixden[0],pixden[1],self.minden,self.maxden,self.gamma,2)
 								self.texture(a,tx,ty,tw,th)
 							else:
-								a=GLUtil.render_amp8(self.data[i],rx,ry,tw,th,(tw-1)//4*4+4,self.scale*dpr,pixden[0],pixden[1],self.minden,self.maxden,self.gamma,6)
+								a=GLUtil.render_amp8(img,rx//shrink,ry//shrink,tw,th,(tw-1)//4*4+4,self.scale*dpr*shrink,pixden[0],pixden[1],self.minden,self.maxden,self.gamma,6)
 								glRasterPos(tx,ty)
 								glDrawPixels(tw,th,GL_LUMINANCE,GL_UNSIGNED_BYTE,a)
 
@@ -2760,6 +2778,11 @@ class EMMXDataCache(object):
 	def __init__(self):
 		self.excluded_list = [] # a list of excluded idxs, used when saving the data to disk
 
+	def close(self):
+		'''
+		Called when the data is no longer displayed, to release any resources such as background threads
+		'''
+		pass
 
 	def delete_box(self,idx):
 		'''
@@ -2838,6 +2861,24 @@ class EMMXDataCache(object):
 	def set_excluded_ptcls(self,excluded_list):
 		self.excluded_list = excluded_list
 
+	def get_display_image(self,idx):
+		'''
+		Returns (image,shrink) for display. Caches which can supply downsampled thumbnails may return one with shrink>1
+		'''
+		return self[idx],1
+
+	def set_visible(self,first,last):
+		'''
+		Called by the EMImageMXWidget with the range of image indices currently displayed, for caches which prefetch
+		'''
+		pass
+
+	def check_changed(self):
+		'''
+		Returns True if images have been loaded in the background and the display should be updated
+		'''
+		return False
+
 
 	def get_item_from_emsave(self,idx):
 		try:
@@ -2892,35 +2933,37 @@ class EMLightWeightParticleCache(EMMXDataCache):
 	the filename and idx variables should be obvious, however the extra list contains functions that take an EMData as the argument -
 	I used this, for example, for assigning attributes to images once they are in memory, and for transforming them, etc.
 
-	A big advantage of this cache is that it only displays the images that are asked for. Additionally, it has a maximum cache size,
-	and refocuses the cache when asked for an image outside its current index bounds. This makes this cache only suitable for linear access
-	schemes, not random.
+	A big advantage of this cache is that it only displays the images that are asked for. Images are held in an EMPrefetchCache,
+	which limits the memory used (in bytes) and reads ahead of the displayed images in a background thread, in the direction
+	the display is being scrolled. This makes this cache best suited to linear access schemes, not random.
 
 	'''
 	
-	def from_file(file_name):
+	def from_file(file_name,**kwargs):
 		'''
 		If this was C++ this would be the constructor for this class that took a single file name
 		@param file_name the name of a particle stack file
+		@param kwargs passed through to the constructor, eg - cache_bytes or thumb_shrink
 		'''
 
 		n = EMUtil.get_image_count(file_name)
 		data = [[file_name,i,[]] for i in range(n)]
 
-		return EMLightWeightParticleCache(data,len(data))
+		return EMLightWeightParticleCache(data,len(data),**kwargs)
 
 	from_file = staticmethod(from_file)
 
-	def __init__(self,data,cache_max=2048):
+	def __init__(self,data,cache_max=2048,cache_bytes=1024*1024*1024,thumb_shrink=0):
 		'''
 		@param data list of lists - lists in in the list are of the form [image_name, idx, [list of functions that take an EMData as the first argument]]
-		@param cache_max the maximum number of stored images - you might have to shorten this if you have very large images
+		@param cache_max the maximum number of images to read ahead of those being displayed
+		@param cache_bytes the maximum amount of memory to use for cached images
+		@param thumb_shrink if >1, read-ahead images which exceed cache_bytes are kept as downsampled thumbnails, displayed until the full image is read again
 		'''
 		EMMXDataCache.__init__(self)
 		self.data = data
-		self.cache_start = 0
 		self.cache_max = cache_max
-		self.reset_cache()
+		self.cache = EMPrefetchCache(len(data),self.__load_item,cache_bytes,cache_max,thumb_shrink)
 		self.xsize = None
 		self.ysize = None
 		self.zsize = None
@@ -2952,8 +2995,11 @@ class EMLightWeightParticleCache(EMMXDataCache):
 		self.reset_cache()
 	
 	def reset_cache(self):
-		self.cache = [None for i in range(self.cache_max)]
-		
+		self.cache.clear(len(self.data))
+
+	def close(self):
+		self.cache.close()
+
 	
 	def delete_box(self,idx):
 		'''
@@ -2967,7 +3013,7 @@ class EMLightWeightParticleCache(EMMXDataCache):
 		Get the get_xsize of the particles. Assumes all particle have the same size, which is potentially flawed
 		'''
 		if self.xsize == None:
-			image = self[self.cache_start]
+			image = self[0]
 			self.xsize = image.get_xsize()
 
 		return self.xsize
@@ -2977,7 +3023,7 @@ class EMLightWeightParticleCache(EMMXDataCache):
 		Get the get_ysize of the particles. Assumes all particle have the same size, which is potentially flawed
 		'''
 		if self.ysize == None:
-			image = self[self.cache_start]
+			image = self[0]
 			self.ysize = image.get_ysize()
 
 		return self.ysize
@@ -2987,7 +3033,7 @@ class EMLightWeightParticleCache(EMMXDataCache):
 		Get the get_ysize of the particles. Assumes all particle have the same size, which is potentially flawed
 		'''
 		if self.zsize == None:
-			image = self[self.cache_start]
+			image = self[0]
 			self.zsize = image.get_zsize()
 
 		return self.zsize
@@ -2999,8 +3045,7 @@ class EMLightWeightParticleCache(EMMXDataCache):
 		i.e. e2eulerxplor
 		'''
 #		return self[idx].get_attr_dict()
-		adj_idx = idx-self.cache_start
-		image = self.cache[adj_idx]
+		image = self.cache.peek(idx)
 		if image == None:
 			data = self.data[idx]
 			try: h = get_header(data[0],data[1])
@@ -3015,54 +3060,33 @@ class EMLightWeightParticleCache(EMMXDataCache):
 		Gets the keys in the header of the first image
 		'''
 		if self.header_keys == None:
-			self.header_keys = list(self.get_image_header(self.cache_start).keys())
+			self.header_keys = list(self.get_image_header(0).keys())
 		return self.header_keys
 
-	def refocus_cache(self,new_focus):
-		'''
-		Called internally to refocus the cache on a new focal point.
-		@param new_focus the value at which the current cache failed - i.e. the first value that was beyond the current cache limits
-		'''
-		new_cache_start = new_focus-self.cache_max//2
-		# Don't let cache start go negative; it will break.
-		if new_cache_start < 0:
-			new_cache_start = 0
-		if new_cache_start < self.cache_start and (new_cache_start + self.cache_max) > self.cache_start:
-			overlap = new_cache_start + self.cache_max - self.cache_start
-			cache = [None for i in range(0,self.cache_max-overlap)]
-			cache.extend(self.cache[0:overlap])
-			self.cache = cache
-		elif new_cache_start > self.cache_start and  new_cache_start < (self.cache_start + self.cache_max):
-			cache = self.cache[new_cache_start:self.cache_start+self.cache_max]
-			overlap =self.cache_max - ( new_cache_start - self.cache_start)
-			cache = [None for i in range(0,self.cache_max-overlap)]
-			cache.extend(self.cache[0:overlap])
-			self.cache = cache
-		else:
-			self.cache = [None for i in range(self.cache_max)]
-
-		self.cache_start = new_cache_start
-
-
 	def __getitem__(self,idx):
 		'''
 		operator[] support - the main interface
 		'''
-		if idx < self.cache_start or idx > self.cache_start+self.cache_max:
-			self.refocus_cache(idx)
+		try: return self.cache.get(idx)
+		except: return None
 
-		adj_idx = idx-self.cache_start
-		try: image = self.cache[adj_idx]
-		except: image=None
-		if image == None:
-			try: a = self.__load_item(idx,adj_idx)
-			except: a=None
-			return a
-		else: return image
+	def get_display_image(self,idx):
+		'''
+		Returns (image,shrink), where image may be a thumbnail downsampled by shrink if the full image isn't loaded yet
+		'''
+		try: return self.cache.get_display(idx)
+		except: return None,1
 
-	def __load_item(self,idx,adj_idx):
+	def set_visible(self,first,last):
+		self.cache.set_visible(first,last)
+
+	def check_changed(self):
+		return self.cache.check_changed()
+
+	def __load_item(self,idx):
 		'''
-		Work horse function for reading an image and applying any of the supplied functions
+		Work horse function for reading an image and applying any of the supplied functions. Called by self.cache,
+		possibly from its background thread.
 		'''
 		data = self.data[idx]
 
@@ -3079,19 +3103,13 @@ class EMLightWeightParticleCache(EMMXDataCache):
 			a.to_zero()
 
 		for func in data[2]: func(a)
-		self.cache[adj_idx] = a
 		return a
 
 	def on_idle(self):
 		'''
-		call this to load unloaded images in the cache
-		This needs to be rethought, maybe use a thread?
+		Images are now read ahead by a background thread in self.cache, so there is nothing to do here
 		'''
-		for idx,i in enumerate(self.cache):
-			if i == None:
-				# only does one at a time
-				self.__load_item(idx,idx+self.cache_start)
-				return
+		pass
 
 	def is_3d(self): return False
 
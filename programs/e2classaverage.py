@@ -45,6 +45,7 @@ import traceback
 READ_HEADER_ONLY = True
 
 from EMAN2jsondb import JSTask,jsonclasses
+from EMAN2PAR import EMStackCache
 
 def main():
 	progname = os.path.basename(sys.argv[0])
@@ -93,6 +94,7 @@ def main():
 	parser.add_argument("--odd", default=False, help="Used by EMAN2 when running eotests. Includes only odd numbered particles in class averages.", action="store_true")
 	parser.add_argument("--even", default=False, help="Used by EMAN2 when running eotests. Includes only even numbered particles in class averages.", action="store_true")
 	parser.add_argument("--parallel", default=None, help="parallelism argument")
+	parser.add_argument("--ptclcache",action="store_true",help="With --parallel, normalize the particles once into a memory mapped cache next to the output, rather than every time a task reads them",default=False)
 #	parser.add_argument("--force", "-f",dest="force",default=False, action="store_true",help="Force overwrite the output file if it exists.")
 	parser.add_argument("--saveali",action="store_true",help="Writes aligned particle images to aligned.hdf. Normally resultmx produces more useful information. This can be used for debugging.",default=False)
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n",type=int, default=0, help="verbose level [0-9], higher number means higher level of verboseness")
@@ -156,6 +158,17 @@ def main():
 		if options.usefilt: pclist.append(options.usefilt)
 		etc.precache(pclist)
 
+	# apply normproc to each particle once here, rather than in every task (and every iteration of every task)
+	caches=[]
+	cachepath=None
+	if options.parallel and options.ptclcache :
+		print("Preparing normalized particle caches")
+		cachepath=os.path.dirname(options.output)
+		for fsp in set([options.input,options.usefilt if options.usefilt else options.input]):
+			c=EMStackCache(fsp,[options.normproc],cachepath)
+			c.build()
+			caches.append(c)
+
 	if options.prefilt and options.prectf :
 		print("ERROR: only one of prefilt and prectf can be specified")
 		sys.exit(1)
@@ -177,7 +190,7 @@ def main():
 #			print(cl,ptcls[:10])
 			tasks.append(ClassAvTask(options.input,ptcls,options.usefilt,options.ref,options.focused,options.iter,options.normproc,options.prefilt,
 			  options.align,options.aligncmp,options.ralign,options.raligncmp,options.averager,options.cmp,options.keep,options.keepsig,
-			  options.automask,options.saveali,options.setsfref,options.verbose,cl,options.center))
+			  options.automask,options.saveali,options.setsfref,options.verbose,cl,options.center,cachepath))
 
 	else:
 		ptcls=list(range(nptcl))
@@ -186,7 +199,7 @@ def main():
 		if options.even: ptcls=[i for i in ptcls if i%2==0]
 		tasks.append(ClassAvTask(options.input,list(range(nptcl)),options.usefilt,options.ref,options.focused,options.iter,options.normproc,options.prefilt,
 			  options.align,options.aligncmp,options.ralign,options.raligncmp,options.averager,options.cmp,options.keep,options.keepsig,
-			  options.automask,options.saveali,options.setsfref,options.verbose,0,options.center))
+			  options.automask,options.saveali,options.setsfref,options.verbose,0,options.center,cachepath))
 
 	# execute task list
 	if options.parallel:				# run in parallel
@@ -257,6 +270,7 @@ def main():
 
 
 		if options.verbose : print("Completed all tasks")
+		for c in caches: c.remove()
 
 	# single thread
 	else:
@@ -327,7 +341,8 @@ class ClassAvTask(JSTask):
 	"""This task will create a single task-average"""
 
 	def __init__(self,imagefile,imagenums,usefilt=None,ref=None,focused=None,niter=1,normproc=("normalize.edgemean",{}),prefilt=0,align=("rotate_translate_flip",{}),
-		  aligncmp=("ccc",{}),ralign=None,raligncmp=None,averager=("mean",{}),scmp=("ccc",{}),keep=1.5,keepsig=1,automask=0,saveali=0,setsfref=0,verbose=0,n=0,center="xform.center"):
+		  aligncmp=("ccc",{}),ralign=None,raligncmp=None,averager=("mean",{}),scmp=("ccc",{}),keep=1.5,keepsig=1,automask=0,saveali=0,setsfref=0,verbose=0,n=0,center="xform.center",ptclcache=None):
+		"""ptclcache is the folder containing EMStackCache copies of imagefile and usefilt with normproc applied, if any"""
 		if usefilt==None : usefilt=imagefile
 		self.center=center
 		data={"images":["cache",imagefile,imagenums],"usefilt":["cache",usefilt,imagenums]}
@@ -337,7 +352,7 @@ class ClassAvTask(JSTask):
 
 		self.options={"niter":niter, "normproc":normproc, "prefilt":prefilt, "align":align, "aligncmp":aligncmp,
 			"ralign":ralign,"raligncmp":raligncmp,"averager":averager,"scmp":scmp,"keep":keep,"keepsig":keepsig,
-			"automask":automask,"saveali":saveali,"setsfref":setsfref,"verbose":verbose,"n":n}
+			"automask":automask,"saveali":saveali,"setsfref":setsfref,"verbose":verbose,"n":n,"ptclcache":ptclcache}
 
 	def execute(self,callback=None):
 		"""This does the actual class-averaging, and returns the result"""
@@ -352,10 +367,18 @@ class ClassAvTask(JSTask):
 		except: focused=None
 
 #		print [self.data["images"][1]]+self.data["images"][2]
+		images=[self.data["images"][1]]+self.data["images"][2]
+		usefilt=[self.data["usefilt"][1]]+self.data["usefilt"][2]
+		if options.get("ptclcache",None)!=None :
+			imc=EMStackCache(images[0],[options["normproc"]],options["ptclcache"])
+			ufc=EMStackCache(usefilt[0],[options["normproc"]],options["ptclcache"])
+			if imc.exists() and ufc.exists() :
+				images[0]=imc
+				usefilt[0]=ufc
 
 		# make the class-average
 		try:
-			avg,ptcl_info=class_average([self.data["usefilt"][1]]+self.data["usefilt"][2],ref,focused,options["niter"],options["normproc"],options["prefilt"],options["align"],
+			avg,ptcl_info=class_average(usefilt,ref,focused,options["niter"],options["normproc"],options["prefilt"],options["align"],
 				options["aligncmp"],options["ralign"],options["raligncmp"],options["averager"],options["scmp"],options["keep"],options["keepsig"],
 				options["automask"],options["saveali"],options["verbose"],callback,self.center)
 		except KeyboardInterrupt: return None
@@ -383,7 +406,7 @@ class ClassAvTask(JSTask):
 			if options["verbose"]>0 : print("Final realign:",fxf)
 #			avg=class_average_withali([self.data["images"][1]]+self.data["images"][2],ptcl_info,Transform(),options["averager"],options["normproc"],options["verbose"])
 #			avg.write_image("bdb:xf",-1)
-			avg=class_average_withali([self.data["images"][1]]+self.data["images"][2],ptcl_info,fxf,ref,focused,options["averager"],options["normproc"],options["setsfref"],options["verbose"])
+			avg=class_average_withali(images,ptcl_info,fxf,ref,focused,options["averager"],options["normproc"],options["setsfref"],options["verbose"])
 #			avg.write_image("bdb:xf",-1)
 
 			#self.data["ref"].write_image("tst.hdf",-1)
@@ -407,7 +430,7 @@ class ClassAvTask(JSTask):
 				
 			if options["verbose"]>0 : print("Final center ({}): {}".format(self.center,fxf.get_trans_2d()))
 			avg1=avg
-			avg=class_average_withali([self.data["images"][1]]+self.data["images"][2],ptcl_info,fxf,None,focused,options["averager"],options["normproc"],options["setsfref"],options["verbose"])
+			avg=class_average_withali(images,ptcl_info,fxf,None,focused,options["averager"],options["normproc"],options["setsfref"],options["verbose"])
 		try:
 			avg["class_ptcl_qual"]=avg1["class_ptcl_qual"]
 			avg["class_ptcl_qual_sigma"]=avg1["class_ptcl_qual_sigma"]
@@ -427,6 +450,7 @@ def get_image(images,n,normproc=("normalize.edgemean",{})):
 	"""used to get an image from a descriptor as provided to class_average function. Always a copy of the actual image."""
 	if isinstance(images[0],EMData) : ret=images[n].copy()
 	elif n>len(images)-2 : raise Exception("get_image() outside range")
+	elif isinstance(images[0],EMStackCache) : return images[0].get(images[n+1])		# normproc was applied when the cache was built
 	else: ret=EMData(images[0],images[n+1])
 
 	if normproc!=None : ret.process_inplace(normproc[0],normproc[1])
@@ -462,7 +486,7 @@ def class_average_withali(images,ptcl_info,xform,ref,focused,averager=("mean",{}
 	be modified in-place to contain the aggregate transformations, and the final aligned average will be returned"""
 
 	if isinstance(images[0],EMData) : nimg=len(images)
-	elif isinstance(images[0],str) and isinstance(images[1],int) : nimg=len(images)-1
+	elif isinstance(images[0],(str,EMStackCache)) and isinstance(images[1],int) : nimg=len(images)-1
 	else : raise Exception("Bad images list")
 	
 	if nimg==0: 
@@ -526,7 +550,7 @@ def class_average_withali(images,ptcl_info,xform,ref,focused,averager=("mean",{}
 def class_average(images,ref=None,focused=None,niter=1,normproc=("normalize.edgemean",{}),prefilt=0,align=("rotate_translate_flip",{}),
 		aligncmp=("ccc",{}),ralign=None,raligncmp=None,averager=("mean",{}),scmp=("ccc",{}),keep=1.5,keepsig=1,automask=0,saveali=0,verbose=0,callback=None,center="xform.center"):
 	"""Create a single class-average by iterative alignment and averaging.
-	images - may either be a list/tuple of images OR a tuple containing a filename followed by integer image numbers
+	images - may either be a list/tuple of images OR a tuple containing a filename (or EMStackCache) followed by integer image numbers
 	ref - optional reference image (EMData).
 	niter - Number of alignment/averaging iterations. If 0, will align to the reference with no further iterations.
 	normproc - a processor tuple, normalization applied to particles before alignments
@@ -548,7 +572,7 @@ def class_average(images,ref=None,focused=None,niter=1,normproc=("normalize.edge
 
 	# nimg is the number of particles we have to align/average
 	if isinstance(images[0],EMData) : nimg=len(images)
-	elif isinstance(images[0],str) and isinstance(images[1],int) : nimg=len(images)-1
+	elif isinstance(images[0],(str,EMStackCache)) and isinstance(images[1],int) : nimg=len(images)-1
 	else : raise Exception("Bad images list (%s)"%str(images))
 
 	if verbose>2 : print("Average %d images"%nimg)
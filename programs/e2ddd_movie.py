@@ -43,6 +43,8 @@ from sys import argv
 from time import sleep,time,ctime
 import threading
 import queue
+from concurrent.futures import ThreadPoolExecutor,as_completed,FIRST_COMPLETED
+from concurrent.futures import wait as futures_wait
 import numpy as np
 from sklearn import linear_model
 from scipy import optimize
@@ -115,6 +117,9 @@ def main():
 	parser.add_argument("--optbox", type=int,help="Box size to use during alignment optimization. Default is 512.",default=512, guitype='intbox', row=23, col=0, rowspan=1, colspan=1, mode="align,tomo")
 	parser.add_argument("--optstep", type=int,help="Step size to use during alignment optimization. Default is 448.",default=448,  guitype='intbox', row=23, col=1, rowspan=1, colspan=1, mode="align,tomo")
 	parser.add_argument("--optalpha", type=float,help="Penalization to apply during robust regression. Default is 0.1. If 0.0, unpenalized least squares will be performed (i.e., no trajectory smoothing).",default=0.1, guitype='floatbox', row=23, col=2, rowspan=1, colspan=1, mode="align,tomo")
+	parser.add_argument("--ccfengine",default="fit",type=str, choices=["fit","batch"],help="'fit' (default) computes each frame pair CCF with EMAN2 and locates its peak with --optccf. 'batch' sums the tile products of many pairs at once with NumPy and finds all of the peaks in a single vectorized step, ignoring --optccf. This is much faster for movies with many frames.")
+	parser.add_argument("--pairwindow",default=0,type=int,help="Only correlate frames which are within this many frames of each other, rather than all pairs of frames. Default is 0 (all pairs).")
+	parser.add_argument("--pairlong",default=0,type=int,help="With --pairwindow, also correlate all pairs among every Nth frame to constrain the long-range trajectory. Default is 0 (none).")
 	parser.add_argument("--optccf",default="robust",type=str, choices=["robust","centerofmass","ccfmax"],help="Use this approach to determine relative frame translations.\nNote: 'robust' utilizes a bimodal Gaussian to robustly determine CCF peaks between pairs of frames in the presence of a fixed background.", guitype='combobox', row=24, col=0, rowspan=1, colspan=2, mode='align["robust"],tomo["robust"]',choicelist='["robust","centerofmass","ccfmax"]')
 
 	parser.add_header(name="orblock5", help='Just a visual separation', title="Optional: ", row=25, col=0, rowspan=2, colspan=3, mode="align,tomo")
@@ -125,6 +130,9 @@ def main():
 
 	parser.add_argument("--threads", default=4,type=int,help="Number of threads to run in parallel. The default is 4, and our alignment routine requires 2+ threads. Using more threads will result in faster processing times.", guitype='intbox', row=28, col=0, rowspan=1, colspan=1, mode="align,tomo")
 
+	parser.add_argument("--stream", default=False, action="store_true", help="Read and correct frames in a background thread while tiles of earlier frames are FFT'd, rather than reading the whole movie first. With --align_frames (without --realign or --groupby), each frame is dropped once its tiles are FFT'd, and the movie is read a second time, one frame at a time, to shift and average the frames, so only the tiles and at most --prefetch frames are held in memory. Otherwise all frames are still held, and this only overlaps I/O with computation. The first --prefetch frames of the next movie are read while the current one is aligned.")
+	parser.add_argument("--prefetch", default=8, type=int, help="With --stream, the maximum number of frames read ahead of processing, or waiting for their tiles to be FFT'd. Default is 8.")
+
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=4, help="verbose level [0-9], higher number means higher level of verboseness",guitype="intbox",row=28,col=1,rowspan=1,colspan=1,mode="align,tomo")
 	parser.add_argument("--debug", default=False, action="store_true", help="run with debugging output")
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-2)
@@ -425,7 +433,9 @@ def main():
 		db.close()
 
 	# the user may provide multiple movies to process at once
-	for idx,fsp in enumerate(sorted(args)):
+	movies=sorted(args)
+	stream=None
+	for idx,fsp in enumerate(movies):
 		print("Processing {}".format(base_name(fsp,nodir=True)))
 
 		if options.tomo:
@@ -464,25 +474,112 @@ def main():
 			#	db["ddd_fixbadpixels"] = options.fixbadpixels
 		db.close()
 
-		hdr = EMData(fsp, 0, True)
-		try: n = EMUtil.get_image_count(fsp)
-		except: n = hdr["nz"]
+		n,flast = movie_range(fsp, last)
 		if n < 3 :
 			print("ERROR: {} has only {} images. Min 3 required.".format(fsp, n))
 			continue
 
-		if last <= 0 : flast = n
-		else : flast = last
+		cur=None
+		if options.stream:
+			if stream is not None and stream.fsp==fsp: cur=stream
+			else: cur=MovieStream(options, fsp, dark, gain, first, flast, step)
 
-		if flast > n : flast = n
+			# queue up the next movie, it begins reading as soon as this one has been read
+			stream=None
+			if idx+1<len(movies):
+				nn,nflast = movie_range(movies[idx+1], last)
+				if nn >= 3 : stream=MovieStream(options, movies[idx+1], dark, gain, first, nflast, step, cur)
 
-		process_movie(options, fsp, dark, gain, first, flast, step, idx)
+		process_movie(options, fsp, dark, gain, first, flast, step, idx, cur)
 
 	print("Done")
 	E2end(pid)
 
 
-def process_movie(options,fsp,dark,gain,first,flast,step,idx):
+def movie_range(fsp,last):
+	"""returns the number of frames in a movie and the (exclusive) last frame to process"""
+	hdr = EMData(fsp, 0, True)
+	try: n = EMUtil.get_image_count(fsp)
+	except: n = hdr["nz"]
+
+	if last <= 0 : flast = n
+	else : flast = last
+
+	if flast > n : flast = n
+
+	return n,flast
+
+def read_frame(options,fsp,ii,dark,gain,nx=0,ny=0):
+	"""reads frame ii of a movie and applies dark/gain and bad pixel corrections. nx,ny are required for .mrc files"""
+	if fsp[-4:].lower() in (".mrc") :
+	#if fsp[-4:].lower() in (".mrc") :
+		im=EMData(fsp,0,False,Region(0,0,ii,nx,ny,1))
+	else: im=EMData(fsp,ii)
+
+	if dark!=None : im.sub(dark)
+	if gain!=None : im.mult(gain)
+	#im.process_inplace("threshold.clampminmax",{"minval":0,"maxval":im["mean"]+im["sigma"]*3.5,"tozero":1})
+	if options.de64: im.process_inplace( "threshold.clampminmax", { "minval" : im[ 'minimum' ], "maxval" : im[ 'mean' ] + 8.0 * im[ 'sigma' ], "tomean" : True } )
+	#if options.fixbadpixels : im.process_inplace("threshold.outlier.localmean",{"sigma":3.5,"fix_zero":1}) # fixes clear outliers as well as values which were exactly zero
+
+	#im.process_inplace("threshold.clampminmax.nsigma",{"nsigma":3.0})
+#			im.mult(-1.0)
+	#if options.normalize: im.process_inplace("normalize.edgemean")
+
+	if options.bad_rows != [] or options.bad_columns != []:
+		im = im.process("math.xybadlines",{"rows":options.bad_rows,"cols":options.bad_columns})
+
+	return im
+
+class MovieStream(object):
+	"""Reads and corrects the frames of one movie in a background thread, reading at most options.prefetch
+	frames ahead of the consumer. If after is the MovieStream of the previous movie, reading doesn't begin
+	until that movie has been read (or closed), so the first frames of the next movie are ready as soon as
+	the current one has been aligned, and at most options.prefetch of them are held meanwhile. Iterating
+	over the stream returns the frames in order. Call close() when done with a stream, so a reader stopped
+	early doesn't hold up the next one."""
+	def __init__(self,options,fsp,dark,gain,first,flast,step,after=None):
+		self.fsp=fsp
+		self.frames=queue.Queue(max(1,options.prefetch))
+		self.stop=threading.Event()
+		self.thread=threading.Thread(target=self.read,args=(options,dark,gain,first,flast,step,after))
+		self.thread.daemon=True
+		self.thread.start()
+
+	def read(self,options,dark,gain,first,flast,step,after):
+		if after is not None: after.thread.join()
+		try:
+			nx,ny=0,0
+			if self.fsp[-4:].lower() in (".mrc"):
+				hdr=EMData(self.fsp,0,True)
+				nx,ny=hdr["nx"],hdr["ny"]
+			for ii in range(first,flast,step):
+				if not self.put(read_frame(options,self.fsp,ii,dark,gain,nx,ny)): return
+		except Exception as e:
+			self.put(e)
+		self.put(None)
+
+	def put(self,item):
+		"""waits for room in the queue, returns False if the stream was closed while waiting"""
+		while not self.stop.is_set():
+			try:
+				self.frames.put(item,timeout=0.5)
+				return True
+			except queue.Full: pass
+		return False
+
+	def close(self):
+		"""Stops reading and discards any frames not yet used. Safe to call on a stream which has been read completely."""
+		self.stop.set()
+
+	def __iter__(self):
+		while 1:
+			im=self.frames.get()
+			if im is None: return
+			if isinstance(im,Exception): raise im
+			yield im
+
+def process_movie(options,fsp,dark,gain,first,flast,step,idx,stream=None):
 	cwd = os.getcwd()
 
 	# format outname
@@ -495,43 +592,60 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 	else: outname = "{}.{}".format(outname,options.ext)
 
 	# prepare to read file
-	if fsp[-4:].lower() in (".mrc"):
+	nx,ny=0,0
+	if fsp[-4:].lower() in (".mrc") and stream is None:
 		hdr=EMData(fsp,0,True)			# read header
 		nx,ny=hdr["nx"],hdr["ny"]
 
 	# bgsub and gain correct the stack
 	outim=[]
+	immx=None
 	nfs = 0
 	t = time()
-	for ii in range(first,flast,step):
-		if options.verbose:
-			sys.stdout.write(" {}/{}   \r".format(ii-first+1,flast-first+1))
-			sys.stdout.flush()
-
-		if fsp[-4:].lower() in (".mrc") :
-		#if fsp[-4:].lower() in (".mrc") :
-			im=EMData(fsp,0,False,Region(0,0,ii,nx,ny,1))
-		else: im=EMData(fsp,ii)
-
-		if dark!=None : im.sub(dark)
-		if gain!=None : im.mult(gain)
-		#im.process_inplace("threshold.clampminmax",{"minval":0,"maxval":im["mean"]+im["sigma"]*3.5,"tozero":1})
-		if options.de64: im.process_inplace( "threshold.clampminmax", { "minval" : im[ 'minimum' ], "maxval" : im[ 'mean' ] + 8.0 * im[ 'sigma' ], "tomean" : True } )
-		#if options.fixbadpixels : im.process_inplace("threshold.outlier.localmean",{"sigma":3.5,"fix_zero":1}) # fixes clear outliers as well as values which were exactly zero
-
-		#im.process_inplace("threshold.clampminmax.nsigma",{"nsigma":3.0})
-#			im.mult(-1.0)
-		#if options.normalize: im.process_inplace("normalize.edgemean")
+	# when streaming frames for alignment, each frame is dropped once its tiles are FFT'd, rather than kept in outim
+	lowmem = stream is not None and options.align_frames and not options.realign and options.groupby == 1
+	nframes = 0
+	if stream is not None:
+		if lowmem:
+			pool=ThreadPoolExecutor(max(1,options.threads-1))
+			tiles=[]
+			noavg=Averagers.get("mean") if options.noali else None
 
-		if options.bad_rows != [] or options.bad_columns != []:
-			im = im.process("math.xybadlines",{"rows":options.bad_rows,"cols":options.bad_columns})
+		try:
+			for ii,im in zip(range(first,flast,step),stream):
+				if options.verbose:
+					sys.stdout.write(" {}/{}   \r".format(ii-first+1,flast-first+1))
+					sys.stdout.flush()
+				if not lowmem:
+					outim.append(im)
+					continue
+
+				if nframes==0: framesize=(im["nx"],im["ny"])
+				nframes+=1
+				if noavg is not None: noavg.add_image(im)
+				# at most prefetch frames wait for their tiles to be FFT'd, so reading can't get far ahead of the FFTs
+				pending=[f for f in tiles if not f.done()]
+				if len(pending)>=max(1,options.prefetch): futures_wait(pending,return_when=FIRST_COMPLETED)
+				tiles.append(pool.submit(split_tiles,options,im,options.optbox,options.optstep))
+				im=None
+
+			if lowmem: immx=[f.result() for f in tiles]
+		finally:
+			# lets the next movie's reader start even if we didn't get through this one
+			stream.close()
+			if lowmem: pool.shutdown()
+	else:
+		for ii in range(first,flast,step):
+			if options.verbose:
+				sys.stdout.write(" {}/{}   \r".format(ii-first+1,flast-first+1))
+				sys.stdout.flush()
 
-		outim.append(im)
+			outim.append(read_frame(options,fsp,ii,dark,gain,nx,ny))
 
-	nfs_read = len(outim)
+	nfs_read = nframes if lowmem else len(outim)
 
 	if options.noali:
-		out=qsum(outim)
+		out=noavg.finish() if lowmem else qsum(outim)
 		if options.tomo:
 			alioutname = os.path.join(".","tiltseries","{}__noali.hdf".format(base_name(options.tomo_name,nodir=True)))
 			out.write_image(alioutname,idx) #write out the unaligned average movie
@@ -573,9 +687,11 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 
 		start = time()
 
-		n=len(outim)
-		nx=outim[0]["nx"]
-		ny=outim[0]["ny"]
+		n=nfs_read
+		if lowmem: nx,ny=framesize
+		else:
+			nx=outim[0]["nx"]
+			ny=outim[0]["ny"]
 
 		md = min(nx,ny)
 		if md <= 2048:
@@ -585,71 +701,62 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 		print("{} frames read ({} x {}). Grouped by {}.".format(nfs_read,nx,ny,options.groupby,n))
 
 		ccfs=queue.Queue(0)
-
-		# prepare image data (outim) by clipping and FFT'ing all tiles (this is threaded as well)
-		immx=[0]*n
-		thds = []
-		for i in range(n):
-			thd = threading.Thread(target=split_fft,args=(options,outim[i],i,options.optbox,options.optstep,ccfs))
-			thds.append(thd)
-		sys.stdout.write("\rPrecompute  /{} FFTs".format(len(thds)))
 		t0=time()
 
-		thrtolaunch=0
-		while thrtolaunch<len(thds) or threading.active_count()>1 or not ccfs.empty():
-			if thrtolaunch<len(thds) :
-				while (threading.active_count()==options.threads ) : sleep(.01)
-				#if options.verbose :
-				#	sys.stdout.write("\rPrecompute {}/{} FFTs {}".format(thrtolaunch+1,len(thds),threading.active_count()))
-				#	sys.stdout.flush()
-				thds[thrtolaunch].start()
-				thrtolaunch+=1
-			else: sleep(0.5)
-
-			while not ccfs.empty():
-				i,d=ccfs.get()
-				immx[i]=d
-
-		for th in thds: th.join()
-		print()
-
-		# create threads
-		thds=[]
-		peak_locs=queue.Queue(0)
-		i=-1
-		for ima in range(n-1):
-			for imb in range(ima+1,n):
-				if options.verbose>3: i+=1		# if i>0 then it will write pre-processed CCF images to disk for debugging
-				thds.append(threading.Thread(target=calc_ccf_wrapper,args=(options,(ima,imb),options.optbox,options.optstep,immx[ima],immx[imb],ccfs,peak_locs,i,fsp)))
-
-		print("{:1.1f} s\nCompute {} ccfs".format(time()-t0,len(thds)))
+		# prepare image data (outim) by clipping and FFT'ing all tiles (this is threaded as well), unless it was done while streaming
+		if immx is None:
+			immx=[0]*n
+			thds = []
+			for i in range(n):
+				thd = threading.Thread(target=split_fft,args=(options,outim[i],i,options.optbox,options.optstep,ccfs))
+				thds.append(thd)
+			sys.stdout.write("\rPrecompute  /{} FFTs".format(len(thds)))
+
+			thrtolaunch=0
+			while thrtolaunch<len(thds) or nrunning(thds)>0 or not ccfs.empty():
+				if thrtolaunch<len(thds) :
+					while (nrunning(thds)>=max(1,options.threads-1)) : sleep(.01)
+					#if options.verbose :
+					#	sys.stdout.write("\rPrecompute {}/{} FFTs {}".format(thrtolaunch+1,len(thds),threading.active_count()))
+					#	sys.stdout.flush()
+					thds[thrtolaunch].start()
+					thrtolaunch+=1
+				else: sleep(0.5)
+
+				while not ccfs.empty():
+					i,d=ccfs.get()
+					immx[i]=d
+
+			for th in thds: th.join()
+			print()
+
+		pairs=frame_pairs(n,options.pairwindow,options.pairlong)
+
+		print("{:1.1f} s\nCompute {} ccfs".format(time()-t0,len(pairs)))
 		t0=time()
 
-		# here we run the threads and save the results, no actual alignment done here
+		# here we compute the CCFs and save the results, no actual alignment done here
 		csum2={}
-
-		thrtolaunch=0
-		while thrtolaunch<len(thds) or threading.active_count()>1:
-			# If we haven't launched all threads yet, then we wait for an empty slot, and launch another
-			# note that it's ok that we wait here forever, since there can't be new results if an existing
-			# thread hasn't finished.
-			if thrtolaunch<len(thds) :
-				while (threading.active_count()==options.threads ) : sleep(.01)
-				#if options.verbose : print "Starting thread {}/{}".format(thrtolaunch,len(thds))
-				thds[thrtolaunch].start()
-				thrtolaunch+=1
-			else:
-				sleep(0.5)
+		if options.ccfengine=="batch":
+			peak_locs={}
+			batch_ccfs(options,immx,pairs,csum2,peak_locs)
+		else:
+			# a fixed pool of threads works through the pairs, rather than one thread per pair
+			peak_locs=queue.Queue(0)
+			with ThreadPoolExecutor(max(1,options.threads-1)) as pool:
+				# if i>=0 then it will write pre-processed CCF images to disk for debugging
+				jobs=[pool.submit(calc_ccf_wrapper,options,(ima,imb),options.optbox,options.optstep,immx[ima],immx[imb],ccfs,peak_locs,i if options.verbose>3 else -1,fsp) for i,(ima,imb) in enumerate(pairs)]
+				for k,job in enumerate(as_completed(jobs)):
+					job.result()
+					if options.verbose:
+						sys.stdout.write("\r  {}/{}".format(k+1,len(jobs)))
+						sys.stdout.flush()
 
 			while not ccfs.empty():
 				i,d=ccfs.get()
 				csum2[i]=d
 
-			if options.verbose:
-				sys.stdout.write("\r  {}/{} ({})".format(thrtolaunch,len(thds),threading.active_count()))
-				sys.stdout.flush()
-
-		for th in thds: th.join()
+			peak_locs = {p[0]:p[1] for p in peak_locs.queue}
 		print()
 
 		avgr=Averagers.get("minmax",{"max":0})
@@ -666,8 +773,6 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 		print("{:1.1f} s\nAlign {} frames".format(time()-t0,n))
 		t0=time()
 
-		peak_locs = {p[0]:p[1] for p in peak_locs.queue}
-
 		if options.debug and options.verbose == 9:
 			print("PEAK LOCATIONS:")
 			for l in list(peak_locs.keys()):
@@ -721,12 +826,11 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 
 		locs = traj.ravel()
 		quals=[0]*n # quality of each frame based on its correlation peak summed over all images
-		cen=old_div(options.optbox,2) #csum2[(0,1)]["nx"]/2
-		for i in range(n-1):
-			for j in range(i+1,n):
-				val=csum2[(i,j)].sget_value_at_interp(int(cen+locs[j*2]-locs[i*2]),int(cen+locs[j*2+1]-locs[i*2+1]))*sqrt(old_div(float(n-fabs(i-j)),n))
-				quals[i]+=val
-				quals[j]+=val
+		for i,j in pairs:
+			cen=old_div(csum2[(i,j)]["nx"],2)		# the batch engine only keeps the center of each CCF
+			val=csum2[(i,j)].sget_value_at_interp(int(cen+locs[j*2]-locs[i*2]),int(cen+locs[j*2+1]-locs[i*2+1]))*sqrt(old_div(float(n-fabs(i-j)),n))
+			quals[i]+=val
+			quals[j]+=val
 
 		print("{:1.1f} s".format(time()-t0,n))
 
@@ -822,61 +926,65 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 				locs = db["ddd_alignment_trans"]
 				db.close()
 
-			# shift frames
+			# shift frames, accumulating the requested averages as we go
 			print("{:1.1f} s\nShift images".format(time()-t0))
 			alioutname = os.path.join(".","micrographs","{}__movieali.hdf".format(base_name(fsp,nodir=True)))
-			for im in range(len(outim)):
-				if options.round == "int":
-					dx = int(round(locs[im*2],0))
-					dy = int(round(locs[im*2+1],0))
-					outim[im].translate(dx,dy,0)
-				else: # float by default
-					dx = float(locs[im*2])
-					dy = float(locs[im*2+1])
-					from fundamentals import fshift
-					outim[im] = fshift(outim[im],dx,dy)
-					outim[im].write_image(alioutname,im) #write out the unaligned average movie
-					#im.translate(dx,dy,0)
-				if options.debug or options.verbose > 5:
-					print("{}\t{}\t{}".format(im,dx,dy))
+			avgs={}		# key is the output name suffix, value is (averager, function selecting the frames to include)
+			if options.allali: avgs["allali"]=(Averagers.get("mean"),lambda i:True)
+			if options.goodali:
+				goodthr=(max(quals[1:])-min(quals))*0.4+min(quals)	# max correlation cutoff for inclusion
+				avgs["goodali"]=(Averagers.get("mean"),lambda i:quals[i]>goodthr)
+			if options.bestali:
+				bestthr=(max(quals[1:])-min(quals))*0.6+min(quals)	# max correlation cutoff for inclusion
+				avgs["bestali"]=(Averagers.get("mean"),lambda i:quals[i]>bestthr)
+			if len(options.rangeali)>0:
+				rng=[int(i) for i in options.rangeali.split("-")]
+				avgs["-".join([str(i) for i in rng])]=(Averagers.get("mean"),lambda i:rng[0]<=i<=rng[1])
+			nkept=dict([(k,0) for k in avgs])
+
+			# the frames weren't kept when streaming, so they are read again, one at a time
+			if lowmem: frames=MovieStream(options,fsp,dark,gain,first,flast,step)
+			else: frames=outim
+			nshifted=0
+			try:
+				for im,frame in enumerate(frames):
+					nshifted+=1
+					if options.round == "int":
+						dx = int(round(locs[im*2],0))
+						dy = int(round(locs[im*2+1],0))
+						frame.translate(dx,dy,0)
+					else: # float by default
+						dx = float(locs[im*2])
+						dy = float(locs[im*2+1])
+						from fundamentals import fshift
+						frame = fshift(frame,dx,dy)
+						frame.write_image(alioutname,im) #write out the unaligned average movie
+						#im.translate(dx,dy,0)
+					if options.debug or options.verbose > 5:
+						print("{}\t{}\t{}".format(im,dx,dy))
+
+					for k,(avgr,keep) in avgs.items():
+						if keep(im):
+							avgr.add_image(frame)
+							nkept[k]+=1
+					if not lowmem: outim[im]=frame
+			finally:
+				if lowmem: frames.close()
 
 			#if options.normaxes:
 			#	for f in outim:
 			#		f.process_inplace("filter.xyaxes0",{"neighbor":1})
 				# or try padding before averaging and clip result to original box size?
 
-			if options.allali:
-				out=qsum(outim)
-				if options.tomo:
-					alioutname = os.path.join(".","tiltseries","{}__allali.hdf".format(base_name(options.tomo_name,nodir=True)))
-					out.write_image(alioutname,idx) #write out the unaligned average movie
-				else:
-					alioutname = os.path.join(".","micrographs","{}__allali.hdf".format(base_name(fsp,nodir=True)))
-					out.write_image(alioutname,0) #write out the unaligned average movie
-
-			if options.goodali:
-				thr=(max(quals[1:])-min(quals))*0.4+min(quals)	# max correlation cutoff for inclusion
-				best=[im for i,im in enumerate(outim) if quals[i]>thr]
-				out=qsum(best)
-				print("Keeping {}/{} frames".format(len(best),len(outim)))
-				if options.tomo:
-					alioutname = os.path.join(".","tiltseries","{}__goodali.hdf".format(base_name(options.tomo_name,nodir=True)))
-					out.write_image(alioutname,idx) #write out the unaligned average movie
-				else:
-					alioutname = os.path.join(".","micrographs","{}__goodali.hdf".format(base_name(fsp,nodir=True)))
-					out.write_image(alioutname,0) #write out the unaligned average movie
-
-			if options.bestali:
-				thr=(max(quals[1:])-min(quals))*0.6+min(quals)	# max correlation cutoff for inclusion
-				best=[im for i,im in enumerate(outim) if quals[i]>thr]
-				out=qsum(best)
-				print("Keeping {}/{} frames".format(len(best),len(outim)))
+			for k,(avgr,keep) in avgs.items():
+				out=avgr.finish()
+				if k in ("goodali","bestali"): print("Keeping {}/{} frames".format(nkept[k],nshifted))
 				if options.tomo:
-					alioutname = os.path.join(".","tiltseries","{}__bestali.hdf".format(base_name(options.tomo_name,nodir=True)))
-					out.write_image(alioutname,idx) #write out the unaligned average movie
+					alioutname = os.path.join(".","tiltseries","{}__{}.hdf".format(base_name(options.tomo_name,nodir=True),k))
+					out.write_image(alioutname,idx) #write out the aligned average movie
 				else:
-					alioutname = os.path.join(".","micrographs","{}__bestali.hdf".format(base_name(fsp,nodir=True)))
-					out.write_image(alioutname,0) #write out the unaligned average movie
+					alioutname = os.path.join(".","micrographs","{}__{}.hdf".format(base_name(fsp,nodir=True),k))
+					out.write_image(alioutname,0) #write out the aligned average movie
 
 			# if options.ali4to14:
 			# 	out=qsum(outim[4:14]) # skip the first 4 frames then keep 10
@@ -887,16 +995,6 @@ def process_movie(options,fsp,dark,gain,first,flast,step,idx):
 			# 		alioutname = os.path.join(".","micrographs","{}__4-14.hdf".format(base_name(fsp)))
 			# 		out.write_image(alioutname,0) #write out the unaligned average movie
 
-			if len(options.rangeali)>0:
-				rng=[int(i) for i in options.rangeali.split("-")]
-				out=qsum(outim[rng[0]:rng[1]+1])
-				if options.tomo:
-					alioutname = os.path.join(".","tiltseries","{}__{}.hdf".format(base_name(options.tomo_name,nodir=True),"-".join(rng)))
-					out.write_image(alioutname,idx) #write out the unaligned average movie
-				else:
-					alioutname = os.path.join(".","micrographs","{}__{}.hdf".format(base_name(fsp,nodir=True),"-".join(rng)))
-					out.write_image(alioutname,0) #write out the unaligned average movie
-
 		except:
 			print("Error: Could not find prior alignment for {}. Exiting".format(fsp,nodir=True))
 
@@ -951,8 +1049,86 @@ def calc_ccf_wrapper(options,N,box,step,dataa,datab,out,locs,ii,fsp):
 			fff = "{}-ccf_models.hdf".format(fsp.replace(".tif",""))
 		csum.process("normalize.edgemean").write_image(fff,ii)
 
+def frame_pairs(n,window=0,longstride=0):
+	"""returns the sorted list of (i,j), i<j, frame pairs to correlate among n frames. By default this is all n*(n-1)/2
+	pairs. If window>0, only frames within window frames of each other are paired, and if longstride>0 all pairs among
+	every longstride'th frame are added as well, so the ends of the trajectory are still directly related."""
+	if window<=0 : return [(i,j) for i in range(n-1) for j in range(i+1,n)]
+
+	pairs=set((i,j) for i in range(n-1) for j in range(i+1,min(i+window+1,n)))
+	if longstride>0:
+		lng=list(range(0,n,longstride))
+		pairs.update((i,j) for ii,i in enumerate(lng) for j in lng[ii+1:])
+	return sorted(pairs)
+
+def batch_ccfs(options,immx,pairs,csum2,peak_locs,batch=16):
+	"""Computes the CCF for each frame pair in pairs with NumPy. Rather than computing and summing one CCF per tile, the
+	tile products are summed in Fourier space, and the CCFs of a batch of pairs are inverse transformed together. The peaks
+	of the whole batch are then located at once (see ccf_peaks). Batches are processed by a pool of options.threads-1
+	threads. For each pair, csum2 receives the (origin suppressed) central optbox/4 of the CCF as an EMData, and
+	peak_locs receives [x,y,peak value], with x,y in the same full-box coordinates as bimodal_peak_model"""
+	box=options.optbox
+
+	# complex views of the tile FFTs, a (ntile,box,box/2+1) array for each frame
+	stacks=[np.stack([t.numpy().view(np.complex64) for t in tiles]) for tiles in immx]
+
+	def run(chunk):
+		prod=np.stack([(stacks[a]*np.conj(stacks[b])).sum(0) for a,b in chunk])	# same as EMData.calc_ccf, a*conj(b)
+		ccf=np.fft.fftshift(np.fft.irfft2(prod,s=(box,box)),axes=(1,2))			# origin at box/2, as with the center flag
+		return (chunk,)+ccf_peaks(ccf)
+
+	chunks=[pairs[i:i+batch] for i in range(0,len(pairs),batch)]
+	ndone=0
+	with ThreadPoolExecutor(max(1,options.threads-1)) as pool:
+		for chunk,locs,vals,regs in pool.map(run,chunks):
+			for k,pair in enumerate(chunk):
+				peak_locs[pair]=[locs[k,0],locs[k,1],vals[k]]
+				csum2[pair]=from_numpy(regs[k])
+			ndone+=len(chunk)
+			if options.verbose:
+				sys.stdout.write("\r  {}/{}".format(ndone,len(pairs)))
+				sys.stdout.flush()
+
+def ccf_peaks(ccfs):
+	"""Locates the peak in each of a (N,box,box) stack of CCFs with the origin at box/2. The central 2x2 pixels, which are
+	dominated by fixed pattern noise, are replaced by the mean of the surrounding 12 (as in neighbormean_origin). The
+	maximum within the central box/4 is then refined with a 3 point parabolic fit along each axis.
+	Returns (N,2) x,y peak locations in box coordinates, (N,) peak values and the (N,box/4,box/4) central regions."""
+	nccf,ny,nx=ccfs.shape
+	bs=old_div(nx,4)
+	r0=old_div(nx,2)-old_div(bs,2)
+	regs=np.ascontiguousarray(ccfs[:,r0:r0+bs,r0:r0+bs],dtype=np.float32)
+
+	rc=old_div(bs,2)
+	ring=regs[:,rc-2:rc+2,rc-2:rc+2].sum(axis=(1,2))
+	orig=regs[:,rc-1:rc+1,rc-1:rc+1].sum(axis=(1,2))
+	regs[:,rc-1:rc+1,rc-1:rc+1]=((ring-orig)/12.0)[:,None,None]
+
+	idx=np.argmax(regs.reshape(nccf,-1),axis=1)
+	iy,ix=np.divmod(idx,bs)
+	iy=np.clip(iy,1,bs-2)
+	ix=np.clip(ix,1,bs-2)
+	n=np.arange(nccf)
+	vals=regs[n,iy,ix]
+
+	def refine(lo,hi):
+		den=lo-2.0*vals+hi
+		with np.errstate(divide="ignore",invalid="ignore"):
+			d=np.where(den<0,0.5*(lo-hi)/den,0.0)
+		return np.clip(d,-0.5,0.5)
+
+	dx=refine(regs[n,iy,ix-1],regs[n,iy,ix+1])
+	dy=refine(regs[n,iy-1,ix],regs[n,iy+1,ix])
+
+	locs=np.stack((ix+dx+r0,iy+dy+r0),axis=1)
+	return locs,vals,regs
+
 # preprocess regions by normalizing and doing FFT
 def split_fft(options,img,i,box,step,out):
+	out.put((i,split_tiles(options,img,box,step)))
+
+def split_tiles(options,img,box,step):
+	"""returns a list of normalized, FFT'd box x box tiles from img"""
 	lst=[]
 	# if min(img["nx"],img["ny"]) > 6000:
 	# 	img.process_inplace("math.fft.resample",{"n":1.5})
@@ -999,7 +1175,7 @@ def split_fft(options,img,i,box,step,out):
 			#patchid += 1
 			clp.do_fft_inplace()
 			lst.append(clp)
-	out.put((i,lst))
+	return lst
 
 def correlation_peak_model(x_y, xo, yo, sigma, amp):
 	x, y = x_y
@@ -1147,6 +1323,11 @@ def bimodal_peak_model(options,ccf):
 	# 	popt.extend([s2,a2])
 	# 	return popt,ccf.sget_value_at_interp(popt[0],popt[1])
 
+def nrunning(thds):
+	"""number of threads in the list which are currently running. Unlike threading.active_count(), this ignores
+	other threads such as MovieStream readers"""
+	return sum([th.is_alive() for th in thds])
+
 def qsum(imlist):
 	avg=Averagers.get("mean")
 	avg.add_image_list(imlist)
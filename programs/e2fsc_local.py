@@ -43,6 +43,8 @@ def main():
 	parser.add_argument("--sym", type=str,help="", default="c1")	
 	parser.add_argument("--overwrite", action="store_true", default=False ,help="overwrite even/odd input")
 	parser.add_argument("--gauss", action="store_true", default=False ,help="gauss instead of tophat")
+	parser.add_argument("--locres", action="store_true", default=False ,help="compute the local resolution with the real-space local FSC used by sp_locres.py (box size --winsize, FSC threshold --cut) instead of sampling local CCCs every --step voxels")
+	parser.add_argument("--threads", type=int,help="number of processes", default=20)
 	parser.add_argument("--ppid", type=int,help="", default=-1)
 
 	(options, args) = parser.parse_args()
@@ -65,49 +67,61 @@ def main():
 		mask.to_one()
 		
 	ny=em["ny"]
-	step=options.step
-	ns=ny//step-1
-	ind=np.indices((ns,ns,ns)).reshape((3,-1)).T+1
-	ind=ind*step
-	# print(ind)
-	lnx=options.winsize
-	msk=EMData(lnx, lnx, lnx)
-	msk.to_one()
-	msk.process_inplace("mask.gaussian",{"inner_radius":lnx//6,"outer_radius":lnx//6})
-	# vout=EMData(ny,ny,ny)
 	cs=(np.arange(20)*.025+.0125)#.tolist()
-	pl=Pool(20)
-	scrs=pl.map(local_ccc, cs)
-	pl.close()
+	pl=None
+	if options.locres:
+		# local FSC over all voxels, computed by the shared memory version of the SPHIRE local resolution code (no MPI needed)
+		from EMAN2locres import locres_shared
+		m=mask.process("threshold.binary",{"value":0.5})
+		f,resolut=locres_shared(em,om,m,options.winsize,options.cut,1.0,options.threads)
+		fa=f.numpy()
+		fa[fa<=0]=cs[-1]		# never dropped below the threshold
+		np.clip(fa,cs[0],cs[-1],out=fa)
+		f.update()
+	else:
+		step=options.step
+		ns=ny//step-1
+		ind=np.indices((ns,ns,ns)).reshape((3,-1)).T+1
+		ind=ind*step
+		# print(ind)
+		lnx=options.winsize
+		msk=EMData(lnx, lnx, lnx)
+		msk.to_one()
+		msk.process_inplace("mask.gaussian",{"inner_radius":lnx//6,"outer_radius":lnx//6})
+		# vout=EMData(ny,ny,ny)
+		pl=Pool(options.threads)
+		scrs=pl.map(local_ccc, cs)
+		pl.close()
 	
-	#jsd=queue.Queue(0)
-	#thrds=[threading.Thread(target=local_ccc,args=(c, jsd)) for c in cs]
-	#for t in thrds:
-		#t.start()
+		#jsd=queue.Queue(0)
+		#thrds=[threading.Thread(target=local_ccc,args=(c, jsd)) for c in cs]
+		#for t in thrds:
+			#t.start()
 	
-	#scrs=[0]*len(cs)
-	#while threading.active_count()>1 or not jsd.empty():
-		#time.sleep(1)
-		#while not jsd.empty():
-			#c,s=jsd.get()
-			#i=cs.index(c)
-			#scrs[i]=s
-	#for t in thrds:
-		#t.join()
+		#scrs=[0]*len(cs)
+		#while threading.active_count()>1 or not jsd.empty():
+			#time.sleep(1)
+			#while not jsd.empty():
+				#c,s=jsd.get()
+				#i=cs.index(c)
+				#scrs[i]=s
+		#for t in thrds:
+			#t.join()
 	
-	scrs=np.array(scrs)
-	cut=options.cut
-	res=np.sum(np.cumsum(scrs<cut, axis=0)==0, axis=0)#-1
-	res[res==len(cs)]=len(cs)-1
-	res=cs[res]
-	ii=np.indices((ns,ns,ns)).reshape((3,-1))
-	fvol=np.zeros((ns,ns,ns))
-	fvol[ii[0], ii[1], ii[2]]=np.array(res)
-	f=from_numpy(fvol.T.copy())
-	f.clip_inplace(Region((ns-ny)//2,(ns-ny)//2,(ns-ny)//2, ny, ny, ny))
-	f.scale(step)
-	#tx=lnx//4
-	#f.translate(tx,tx,tx)
+		scrs=np.array(scrs)
+		cut=options.cut
+		res=np.sum(np.cumsum(scrs<cut, axis=0)==0, axis=0)#-1
+		res[res==len(cs)]=len(cs)-1
+		res=cs[res]
+		ii=np.indices((ns,ns,ns)).reshape((3,-1))
+		fvol=np.zeros((ns,ns,ns))
+		fvol[ii[0], ii[1], ii[2]]=np.array(res)
+		f=from_numpy(fvol.T.copy())
+		f.clip_inplace(Region((ns-ny)//2,(ns-ny)//2,(ns-ny)//2, ny, ny, ny))
+		f.scale(step)
+		#tx=lnx//4
+		#f.translate(tx,tx,tx)
+
 	f.process_inplace("filter.lowpass.gauss",{"cutoff_abs":.3})
 	f.process_inplace("xform.applysym",{"sym":options.sym})
 	f.mult(mask)
@@ -157,7 +171,7 @@ def main():
 	f.mult(1./mp["apix_x"])
 	f.write_image(options.output.replace("threed","fscvol"))
 	E2end(logid)
-	pl.join()
+	if pl!=None: pl.join()
 	
 def run(cmd):
 	print(cmd)
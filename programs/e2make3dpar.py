@@ -257,7 +257,7 @@ def main():
 		if par[0].startswith("thread"):
 			#options.parallel=None
 			options.threads=int(par[1])
-		elif par[0]=="mpi":
+		elif par[0] in ("mpi","pool"):
 			nthr=int(par[1])
 			ppt=len(data)/nthr
 			if ppt>16:
@@ -302,7 +302,7 @@ def main():
 			if it>0:
 				seed=output
 		
-			from EMAN2PAR import EMTaskCustomer
+			from EMAN2PAR import EMTaskCustomer, EMSharedImage
 			etc=EMTaskCustomer(options.parallel, module="e2make3dpar.Make3dTask")
 			num_cpus = etc.cpu_est()
 			
@@ -314,34 +314,53 @@ def main():
 			
 			print("{} jobs".format(len(tasks)))
 
-			tids=[]
-			for t in tasks:
-				task = Make3dTask(t, seed, refmap, options)
-				tid=etc.send_task(task)
-				tids.append(tid)
-
-			while 1:
-				st_vals = etc.check_task(tids)
-				E2progress(logger, np.mean(st_vals)/100.)
-				#print("{:.1f}/{} finished".format(np.mean(st_vals), 100))
-				#print(tids)
-				if np.min(st_vals) == 100: break
-				time.sleep(5)
-
-			#dics=[0]*nptcl
-			
+			### on a single node, volumes go through shared memory rather than being pickled for every task
+			options.sharedmem=options.parallel.startswith("pool")
+			shared=[]
+			tseed,tref=seed,refmap
+			try:
+				if options.sharedmem:
+					if seed is not None:
+						tseed=EMSharedImage(seed)
+						shared.append(tseed)
+					if refmap is not None:
+						tref=EMSharedImage(refmap)
+						shared.append(tref)
+
+				tids=[]
+				for t in tasks:
+					task = Make3dTask(t, tseed, tref, options)
+					tid=etc.send_task(task)
+					tids.append(tid)
+
+				if options.sharedmem:
+					### partial volumes are summed pairwise by the workers in shared memory as they finish,
+					### so only handles pass through here and we only ever receive one
+					threed,norm=etc.tree_reduce(tids,Make3dMergeTask,lambda p:E2progress(logger,p),shared.extend)
+					shared.extend([threed,norm])
+					threed,norm=threed.get(copy=True),norm.get(copy=True)
+				else:
+					### otherwise each merge would ship two volumes back out and one back in again, so we
+					### just sum the partial volumes here as they arrive
+					threed,norm=None,None
+					for tid,task,(vol,nvol) in etc.as_completed(tids,lambda p:E2progress(logger,p)):
+						if threed is None:
+							threed,norm=vol,nvol
+						else:
+							threed.add(vol)
+							norm.add(nvol)
+			finally:
+				# blocks in /dev/shm outlive the process, so they must go even if we fail or are interrupted
+				for shm in shared:
+					try: shm.unlink()
+					except: pass
+
 			output=EMData(padvol[0], padvol[1], padvol[2])
-			normvol=EMData(padvol[0]//2+1, padvol[1], padvol[2])
 			output.to_zero()
 			output.do_fft_inplace()
+			output.add(threed)
+			normvol=norm
 			
-			normvol.to_zero()
-			for i in tids:
-				threed, norm=etc.get_results(i)[1]
-				threed.process_inplace("math.multamplitude", {"amp":norm})
-				output.add(threed)
-				normvol.add(norm)
-				
 			normvol.process_inplace("math.reciprocal")
 			output.process_inplace("math.multamplitude", {"amp":normvol})
 			
@@ -763,10 +782,11 @@ class Make3dTask(JSTask):
 	
 	def execute(self, callback):
 		
+		from EMAN2PAR import EMSharedImage, shared_get
 		callback(0)
 		data=self.data["data"]
-		seed=self.data["seed"]
-		ref=self.data["ref"]
+		seed=shared_get(self.data["seed"])
+		ref=shared_get(self.data["ref"])
 		options=self.options
 		
 		padvol=options.padvol3
@@ -818,8 +838,44 @@ class Make3dTask(JSTask):
 		
 		#callback(100)
 		
+		# weight now so partial volumes from different tasks can simply be summed
+		output.process_inplace("math.multamplitude", {"amp":normvol})
+		
+		if getattr(options,"sharedmem",False):
+			return (EMSharedImage(output), EMSharedImage(normvol))
+		
 		return (output, normvol)
 
 
+class Make3dMergeTask(JSTask):
+	"""Sums two weighted partial reconstructions from Make3dTask (or earlier merges), see EMTaskCustomer.tree_reduce()"""
+	
+	def __init__(self, a, b):
+		
+		data={"a":a, "b":b}
+		JSTask.__init__(self,"Make3dMerge",data,{},"")
+	
+	
+	def execute(self, callback):
+		
+		from EMAN2PAR import EMSharedImage
+		callback(0)
+		a=self.data["a"]
+		b=self.data["b"]
+		
+		if isinstance(a[0],EMSharedImage):
+			# sum in place in a's shared blocks, then b is no longer needed by anyone
+			for x,y in zip(a,b):
+				x.numpy()[...]+=y.numpy()
+				x.close()
+				y.unlink()
+			return a
+		
+		a[0].add(b[0])
+		a[1].add(b[1])
+		
+		return a
+
+
 if __name__=="__main__":
 	main()
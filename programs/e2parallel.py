@@ -42,19 +42,11 @@ import traceback
 
 import sys
 from EMAN2 import *
-from EMAN2PAR import EMMpiClient
+from EMAN2PAR import EMMpiClient, load_module
 
 debug=False
 logid=None
 
-
-def load_module(module):
-	fname, cls=module.split('.')
-	#print("import {} from {}".format(cls, fname))
-	sys.path.append(os.path.join(e2getinstalldir(),"bin"))
-	mod=__import__(fname, fromlist=[cls])
-	setattr(sys.modules["__main__"], cls, getattr(mod,cls))
-
 def main():
 	
 	usage=" "
@@ -66,6 +58,7 @@ def main():
 	parser.add_argument("--progress", type=str,help="Internal use only. For tracking job progress.")
 	parser.add_argument("--loadmodule", type=str,help="load module",default="")
 	parser.add_argument("--usethreads", type=int,help="max thread to use. only used for producing occupancy in mpi mode. default is the same as threads/mpi option given",default=-1)
+	parser.add_argument("--retries", type=int,help="Internal use only. Number of times a failed task is rerun in mpi mode. default is 0",default=0)
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higner number means higher level of verboseness")
 	
 	(options, args) = parser.parse_args()
@@ -75,7 +68,7 @@ def main():
 		if options.loadmodule!="":
 			load_module(options.loadmodule)
 		client.test(options.verbose)		# don't skip this. It's necessary to identify node names
-		client.run(options.verbose, usethreads=options.usethreads)
+		client.run(options.verbose, usethreads=options.usethreads, retries=options.retries)
 		
 	elif options.mode=="thread":
 		from pickle import load,dump
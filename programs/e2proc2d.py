@@ -40,6 +40,8 @@ import os
 import datetime
 import time
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # constants
 
@@ -51,6 +53,10 @@ xzplanes = ['xz', 'zx']
 yzplanes = ['yz', 'yz']
 threedplanes = xyplanes + xzplanes + yzplanes
 
+# options which act on each image independently, and may thus be run in parallel
+image_options = ["apix", "process", "addfile", "add", "mult", "multfile", "calccont", "rfp", "fp", "anisotropic", "scale",
+	"rotate", "translate", "clip", "randomize", "medianshrink", "meanshrink", "fouriershrink", "headertransform", "selfcl", "radon"]
+
 
 def changed_file_name(input_name, output_pattern, input_number, multiple_inputs):
 	# convert an input file name to an output file name
@@ -130,6 +136,370 @@ def image_from_formula(n_x, n_y, n_z, formula):
 	return EMNumPy.numpy2em(emdn)
 
 
+def apply_option(d, option1, index_d, options, first=False):
+	"""Applies a single per-image processing option (one of image_options) to d and returns the result, which
+	may or may not be the same object. index_d tracks how many times each option in append_options has been used.
+	Used by both the sequential and threaded (--threads) processing loops."""
+	nx = d.get_xsize()
+	ny = d.get_ysize()
+
+	if option1 == "apix":
+		apix = options.apix
+		d.set_attr('apix_x', apix)
+		d.set_attr('apix_y', apix)
+		d.set_attr('apix_z', apix)
+
+		try:
+			if first and d["ctf"].apix != apix:
+				if options.verbose > 0:
+					print("Warning: A/pix value in CTF was %1.2f, changing to %1.2f. May impact CTF parameters."%(d["ctf"].apix,apix))
+
+			d["ctf"].apix = apix
+		except: pass
+
+	if option1 == "process":
+		fi = index_d[option1]
+		(processorname, param_dict) = parsemodopt(options.process[fi])
+
+		if not param_dict : param_dict = {}
+
+		# Parse the options to convert the image file name to EMData object
+		# (for both plain image file and bdb file)
+		for key in list(param_dict.keys()):
+			#print str(param_dict[key])
+
+			if str(param_dict[key]).find('bdb:') != -1 or not str(param_dict[key]).isdigit():
+				try:
+					param_dict[key] = EMData(param_dict[key])
+				except:
+					pass
+
+		if processorname in outplaceprocs:
+			d = d.process(processorname, param_dict)
+		else: d.process_inplace(processorname, param_dict)
+		index_d[option1] += 1
+
+	elif option1 == "addfile":
+		af=EMData(options.addfile[index_d[option1]],0)
+		d.add(af)
+		af = None
+		index_d[option1] += 1
+
+	elif option1 == "add":
+		d.add(options.add[index_d[option1]])
+		af = None
+		index_d[option1] += 1
+
+	elif option1 == "mult":
+		d.mult(options.mult)
+
+	elif option1 == "multfile":
+		mf = EMData(options.multfile[index_d[option1]],0)
+		d.mult(mf)
+		mf = None
+		index_d[option1] += 1
+
+	elif option1 == "calccont":
+		dd = d.process("math.rotationalsubtract")
+		f = dd.do_fft()
+		#f = d.do_fft()
+
+		if d["apix_x"] <= 0: raise Exception("Error: 'calccont' requires an A/pix value, which is missing in the input images")
+
+		lopix = int(d["nx"]*d["apix_x"]/150.0)
+		hipix = int(d["nx"]*d["apix_x"]/25.0)
+		if hipix>old_div(d["ny"],2)-6: hipix=old_div(d["ny"],2)-6	# if A/pix is very large, this makes sure we get at least some info
+
+		if lopix == hipix: lopix,hipix = 3,old_div(d["nx"],5)	# in case the A/pix value is drastically out of range
+
+		r = f.calc_radial_dist(old_div(d["ny"],2),0,1.0,1)
+		lo = old_div(sum(r[lopix:hipix]),(hipix-lopix))
+		hi = old_div(sum(r[hipix+1:-1]),(len(r)-hipix-2))
+
+#					print lopix, hipix, lo, hi
+		d["eval_contrast_lowres"] = old_div(lo,hi)
+	#				print lopix,hipix,lo,hi,lo/hi
+
+	elif option1 == "rfp":
+		d = d.make_rotational_footprint()
+
+	elif option1 == "fp":
+		d = d.make_footprint(options.fp)
+
+	elif option1 == "anisotropic":
+		try:
+			amount,angle = (options.anisotropic[index_d[option1]]).split(",")
+			amount=float(amount)
+			angle=float(angle)
+		except:
+			traceback.print_exc()
+			print(options.anisotropic[index_d[option1]])
+			print("Error: --anisotropic specify amount,angle")
+			sys.exit(1)
+
+		rt=Transform({"type":"2d","alpha":angle})
+		xf=rt*Transform([amount,0,0,0,0,old_div(1,amount),0,0,0,0,1,0])*rt.inverse()
+		d.transform(xf)
+
+		index_d[option1] += 1
+
+	elif option1 == "scale":
+		scale_f = options.scale[index_d[option1]]
+
+		if scale_f != 1.0:
+			d.scale(scale_f)
+
+		index_d[option1] += 1
+
+	elif option1 == "rotate":
+		rotatef = options.rotate[index_d[option1]]
+
+		if rotatef != 0.0: d.rotate(rotatef,0,0)
+
+		index_d[option1] += 1
+
+	elif option1 == "translate":
+		tdx,tdy = options.translate[index_d[option1]].split(",")
+		tdx,tdy = float(tdx),float(tdy)
+
+		if tdx != 0.0 or tdy != 0.0:
+			d.translate(tdx,tdy,0.0)
+			#print(f"translate {tdx},{tdy}")
+
+		index_d[option1] += 1
+
+	elif option1 == "clip":
+		ci = index_d[option1]
+		clipcx = old_div(nx,2)
+		clipcy = old_div(ny,2)
+
+		try: clipx,clipy,clipcx,clipcy = options.clip[ci].split(",")
+		except: clipx, clipy = options.clip[ci].split(",")
+
+		clipx, clipy = int(clipx),int(clipy)
+		clipcx, clipcy = int(clipcx),int(clipcy)
+
+		e = d.get_clip(Region(clipcx-old_div(clipx,2), clipcy-old_div(clipy,2), clipx, clipy))
+
+		try: e.set_attr("avgnimg", d.get_attr("avgnimg"))
+		except: pass
+
+		d = e
+		index_d[option1] += 1
+
+	elif option1 == "randomize":
+		ci = index_d[option1]
+		rnd = options.randomize[ci].split(",")
+		rnd[0] = float(rnd[0])
+		rnd[1] = float(rnd[1])
+		rnd[2] = int(rnd[2])
+
+		t = Transform()
+		t.set_params({"type":"2d", "alpha":random.uniform(-rnd[0],rnd[0]),
+					  "mirror":random.randint(0,rnd[2]), "tx":random.uniform(-rnd[1],rnd[1]),
+					  "ty":random.uniform(-rnd[1],rnd[1])})
+		d.transform(t)
+
+	elif option1 == "medianshrink":
+		shrink_f = options.medianshrink[index_d[option1]]
+
+		if shrink_f > 1:
+			d.process_inplace("math.medianshrink",{"n":shrink_f})
+
+		index_d[option1] += 1
+
+	elif option1 == "meanshrink":
+		mshrink = options.meanshrink[index_d[option1]]
+
+		if mshrink > 1:
+			d.process_inplace("math.meanshrink",{"n":mshrink})
+
+		index_d[option1] += 1
+
+	elif option1 == "fouriershrink":
+		fshrink = options.fouriershrink[index_d[option1]]
+
+		if fshrink > 1:
+			d.process_inplace("math.fft.resample",{"n":fshrink})
+
+		index_d[option1] += 1
+
+	elif option1 == "headertransform":
+		xfmode = options.headertransform[index_d[option1]]
+
+		if xfmode not in (0,1):
+			print("Error: headertransform must be set to 0 or 1")
+			sys.exit(1)
+
+		try: xform=d["xform.align2d"]
+		except: print("Error: particle has no xform.align2d header value")
+
+		if xfmode == 1: xform.invert()
+
+		d.process_inplace("xform",{"transform":xform})
+
+	elif option1 == "selfcl":
+		scl = old_div(options.selfcl[0], 2)
+		sclmd = options.selfcl[1]
+		sc = EMData()
+
+		if sclmd == 0:
+			sc.common_lines_real(d, d, scl, true)
+		else:
+			e = d.copy()
+			e.process_inplace("xform.phaseorigin")
+
+			if sclmd == 1:
+				sc.common_lines(e, e, sclmd, scl, true)
+				sc.process_inplace("math.linear", Dict("shift", EMObject(-90.0), "scale", EMObject(-1.0)))
+			elif sclmd == 2:
+				sc.common_lines(e, e, sclmd, scl, true)
+			else:
+				if options.verbose > 0:
+					print("Error: invalid common-line mode '" + sclmd + "'")
+
+				sys.exit(1)
+
+	elif option1 == "radon":
+		r = d.do_radon()
+		d = r
+
+	return d
+
+
+def set_render_range(d, options):
+	"""Sets render_min/render_max on d as required by --outmode, --fixintscaling and --outnorescale before writing"""
+	dont_scale = (options.fixintscaling == "noscale")
+
+	if options.fixintscaling != None and not dont_scale:
+		if options.fixintscaling == "sane":
+			sca = 2.5
+			d["render_min"] = d["mean"] - d["sigma"]*sca
+			d["render_max"] = d["mean"] + d["sigma"]*sca
+		elif options.fixintscaling == "full" :
+			d["render_min"]=d["minimum"]*1.001
+			d["render_max"]=d["maximum"]*1.001
+		else:
+			try:
+				sca = float(options.fixintscaling)
+			except:
+				sca = 2.5
+
+				print("Warning: bad fixintscaling value - 2.5 used")
+
+			d["render_min"] = d["mean"] - d["sigma"]*sca
+			d["render_max"] = d["mean"] + d["sigma"]*sca
+
+		min_max_set = True
+	else:
+		min_max_set = False
+
+	if options.outmode != "float" or dont_scale:
+
+		if options.outnorescale or dont_scale:
+			# This sets the minimum and maximum values to the range
+			# for the specified type, which should result in no rescaling
+
+			outmode = file_mode_map[options.outmode]
+
+			d["render_min"] = file_mode_range[outmode][0]
+			d["render_max"] = file_mode_range[outmode][1]
+
+		else:
+			if not min_max_set:
+				d["render_min"] = d["minimum"]
+				d["render_max"] = d["maximum"]
+
+
+def write_stack_image(d, outfile, i, options):
+	"""Writes processed image number i to a 2-D stack (or single image) output file, applying --rotavg and the
+	--writejunk test. Returns False if the image was skipped."""
+	out_type = EMUtil.get_image_ext_type(options.outtype)
+	out_mode = file_mode_map[options.outmode]
+	not_swap = not(options.swap)
+
+	# optionally replace the output image with its rotational average
+	if options.rotavg:
+		rd = d.calc_radial_dist(d["nx"],0,0.5,0)
+		d = EMData(len(rd),1,1)
+
+		for x in range(len(rd)): d[x] = rd[x]
+
+	if d["sigma"] == 0:
+		if options.verbose > 0:
+			print("Warning: sigma = 0 for image ",i)
+
+		if options.writejunk == False:
+			if options.verbose > 0:
+				print("Use the writejunk option to force writing this image to disk")
+			return False
+
+	if outfile != None:
+		if options.inplace:
+			if options.compressbits>=0:
+				d.write_compressed(outfile,i,options.compressbits,nooutliers=True)
+			else: d.write_image(outfile, i, out_type, False, None, out_mode, not_swap)
+		else: # append the image
+			if options.compressbits>=0:
+				d.write_compressed(outfile,-1,options.compressbits,nooutliers=True)
+			else: d.write_image(outfile, -1, out_type, False, None, out_mode, not_swap)
+
+	return True
+
+
+def process_image(d, i, optionlist, options, first=False):
+	"""Applies the per-image options in optionlist to image i in order, as the sequential loop in main() would.
+	Used by the worker threads in process_stack_threaded()."""
+	index_d = dict.fromkeys(image_options, 0)
+
+	for option1 in optionlist:
+		if option1 in image_options:
+			d = apply_option(d, option1, index_d, options, first)
+		elif option1 == "outtype":
+			set_render_range(d, options)
+
+	return d
+
+
+def process_stack_threaded(infile, outfile, ilist, optionlist, options, n0):
+	"""Processes the images numbered in ilist from a 2-D stack using options.threads threads. One thread reads
+	chunks of images with EMData.read_images while the previous chunk is being processed, and the calling thread
+	writes the results in input order. Returns the number of images written."""
+	chunk = max(options.threads*8, 64)
+	chunks = [ilist[j:j+chunk] for j in range(0, len(ilist), chunk)]
+	if len(chunks) == 0: return 0
+
+	reader = ThreadPoolExecutor(1)
+	pool = ThreadPoolExecutor(options.threads)
+	pending = deque()
+	nwritten = 0
+	lasttime = time.time()
+
+	nextread = reader.submit(EMData.read_images, infile, chunks[0])
+	for ci, c in enumerate(chunks):
+		imgs = nextread.result()
+		if ci+1 < len(chunks): nextread = reader.submit(EMData.read_images, infile, chunks[ci+1])
+
+		for i, d in zip(c, imgs):
+			pending.append((i, pool.submit(process_image, d, i, optionlist, options, i == n0)))
+		imgs = None
+
+		# we keep one chunk queued so the workers aren't idle while we write
+		while len(pending) > chunk or (ci == len(chunks)-1 and len(pending) > 0):
+			i, job = pending.popleft()
+			if write_stack_image(job.result(), outfile, i, options): nwritten += 1
+
+			if options.verbose >= 1 and (time.time()-lasttime > 3 or options.verbose > 2):
+				sys.stdout.write(" %7d\r" %i)
+				sys.stdout.flush()
+				lasttime = time.time()
+
+	reader.shutdown()
+	pool.shutdown()
+
+	return nwritten
+
+
 def main():
 	progname = os.path.basename(sys.argv[0])
 	usage = progname + """ [options] <inputfile> ... <inputfile> <outputfile>
@@ -236,7 +606,8 @@ def main():
 	eer_input_group.add_argument("--eer4x", action="store_true", help="Render EER file on 16k grid.")
 
 	# Parallelism
-	parser.add_argument("--parallel","-P",type=str,help="Run in parallel, specify type:n=<proc>:option:option",default=None)
+	parser.add_argument("--parallel","-P",type=str,help="Run in parallel, only thread:<n> is supported, equivalent to --threads",default=None)
+	parser.add_argument("--threads", type=int, help="Process 2-D stacks using N threads. Images are read in chunks, processed in parallel and written in order. Options combining information from multiple images (--average, --avgseq, --fftavg, --calcsf, --setsfpairs, --interlv, --split, --extractboxes), --inplace, 3-D modes and single image per file outputs always run on a single thread.", default=1)
 
 	append_options = ["anisotropic","clip", "process", "meanshrink", "medianshrink", "fouriershrink", "scale", "randomize", "rotate", "translate", "multfile","addfile","add", "headertransform"]
 
@@ -278,6 +649,10 @@ def main():
 		print("Invalid output mode, please specify one of :\n",str(list(file_mode_map.keys())).translate(None,'"[]'))
 		sys.exit(1)
 
+	if options.parallel != None and options.parallel[:7] == "thread:":
+		options.threads = int(options.parallel[7:])
+		options.parallel = None
+
 	no_2d_3d_options = (not (options.threed2threed or options.threed2twod or options.twod2threed))
 
 	num_input_files = len(args) - 1
@@ -515,6 +890,28 @@ def main():
 
 			if options.verbose: print("inclusion list:", str(imagelist))
 
+		# options which act on each image independently can be processed in parallel for simple 2-D stacks
+		if options.threads > 1 and not isthreed and infile[0] != ":" and not (options.threed2threed or options.threed2twod
+				or options.twod2threed or options.unstacking or options.inplace or options.average or options.avgseq > 1
+				or options.fftavg or options.calcsf or options.setsfpairs or options.interlv or options.split or options.extractboxes
+				or options.eer2x or options.eer4x or options.outtype in ["mrc", "pif", "png", "pgm", "spidersingle"]):
+			if not options.outtype:
+				options.outtype = "unknown"
+
+			if not "outtype" in optionlist:
+				optionlist.append("outtype")
+
+			ilist = [i for i in range(n0, n1+1, options.step[1]) if i < len(imagelist) and imagelist[i]]
+			n_outimg = process_stack_threaded(infile, outfile, ilist, optionlist, options, n0)
+
+			if options.verbose > 0:
+				print(str(n_outimg) + " images")
+
+			options.threed2threed = opt3to3
+			options.threed2twod   = opt3to2
+			options.twod2threed   = opt2to3
+			continue
+
 		sfcurve1 = None
 
 		lasttime = time.time()
@@ -640,41 +1037,8 @@ def main():
 				nx = d.get_xsize()
 				ny = d.get_ysize()
 
-				if option1 == "apix":
-					apix = options.apix
-					d.set_attr('apix_x', apix)
-					d.set_attr('apix_y', apix)
-					d.set_attr('apix_z', apix)
-
-					try:
-						if i == n0 and d["ctf"].apix != apix:
-							if options.verbose > 0:
-								print("Warning: A/pix value in CTF was %1.2f, changing to %1.2f. May impact CTF parameters."%(d["ctf"].apix,apix))
-
-						d["ctf"].apix = apix
-					except: pass
-
-				if option1 == "process":
-					fi = index_d[option1]
-					(processorname, param_dict) = parsemodopt(options.process[fi])
-
-					if not param_dict : param_dict = {}
-
-					# Parse the options to convert the image file name to EMData object
-					# (for both plain image file and bdb file)
-					for key in list(param_dict.keys()):
-						#print str(param_dict[key])
-
-						if str(param_dict[key]).find('bdb:') != -1 or not str(param_dict[key]).isdigit():
-							try:
-								param_dict[key] = EMData(param_dict[key])
-							except:
-								pass
-
-					if processorname in outplaceprocs:
-						d = d.process(processorname, param_dict)
-					else: d.process_inplace(processorname, param_dict)
-					index_d[option1] += 1
+				if option1 in image_options:
+					d = apply_option(d, option1, index_d, options, i == n0)
 
 				elif option1 == "extractboxes":
 					try:
@@ -686,47 +1050,6 @@ def main():
 					except:
 						boxesbad += 1
 
-				elif option1 == "addfile":
-					af=EMData(options.addfile[index_d[option1]],0)
-					d.add(af)
-					af = None
-					index_d[option1] += 1
-
-				elif option1 == "add":
-					d.add(options.add[index_d[option1]])
-					af = None
-					index_d[option1] += 1
-
-				elif option1 == "mult":
-					d.mult(options.mult)
-
-				elif option1 == "multfile":
-					mf = EMData(options.multfile[index_d[option1]],0)
-					d.mult(mf)
-					mf = None
-					index_d[option1] += 1
-
-				elif option1 == "calccont":
-					dd = d.process("math.rotationalsubtract")
-					f = dd.do_fft()
-					#f = d.do_fft()
-
-					if d["apix_x"] <= 0: raise Exception("Error: 'calccont' requires an A/pix value, which is missing in the input images")
-
-					lopix = int(d["nx"]*d["apix_x"]/150.0)
-					hipix = int(d["nx"]*d["apix_x"]/25.0)
-					if hipix>old_div(d["ny"],2)-6: hipix=old_div(d["ny"],2)-6	# if A/pix is very large, this makes sure we get at least some info
-
-					if lopix == hipix: lopix,hipix = 3,old_div(d["nx"],5)	# in case the A/pix value is drastically out of range
-
-					r = f.calc_radial_dist(old_div(d["ny"],2),0,1.0,1)
-					lo = old_div(sum(r[lopix:hipix]),(hipix-lopix))
-					hi = old_div(sum(r[hipix+1:-1]),(len(r)-hipix-2))
-
-#					print lopix, hipix, lo, hi
-					d["eval_contrast_lowres"] = old_div(lo,hi)
-	#				print lopix,hipix,lo,hi,lo/hi
-
 				elif option1 == "norefs" and d["ptcl_repr"] <= 0:
 					continue
 
@@ -751,150 +1074,6 @@ def main():
 							d = dataf.do_ift()
 	#						dataf.gimme_fft();
 
-				elif option1 == "rfp":
-					d = d.make_rotational_footprint()
-
-				elif option1 == "fp":
-					d = d.make_footprint(options.fp)
-
-				elif option1 == "anisotropic":
-					try:
-						amount,angle = (options.anisotropic[index_d[option1]]).split(",")
-						amount=float(amount)
-						angle=float(angle)
-					except:
-						traceback.print_exc()
-						print(options.anisotropic[index_d[option1]])
-						print("Error: --anisotropic specify amount,angle")
-						sys.exit(1)
-
-					rt=Transform({"type":"2d","alpha":angle})
-					xf=rt*Transform([amount,0,0,0,0,old_div(1,amount),0,0,0,0,1,0])*rt.inverse()
-					d.transform(xf)
-
-					index_d[option1] += 1
-
-				elif option1 == "scale":
-					scale_f = options.scale[index_d[option1]]
-
-					if scale_f != 1.0:
-						d.scale(scale_f)
-
-					index_d[option1] += 1
-
-				elif option1 == "rotate":
-					rotatef = options.rotate[index_d[option1]]
-
-					if rotatef != 0.0: d.rotate(rotatef,0,0)
-
-					index_d[option1] += 1
-
-				elif option1 == "translate":
-					tdx,tdy = options.translate[index_d[option1]].split(",")
-					tdx,tdy = float(tdx),float(tdy)
-
-					if tdx != 0.0 or tdy != 0.0:
-						d.translate(tdx,tdy,0.0)
-						#print(f"translate {tdx},{tdy}")
-
-					index_d[option1] += 1
-
-				elif option1 == "clip":
-					ci = index_d[option1]
-					clipcx = old_div(nx,2)
-					clipcy = old_div(ny,2)
-
-					try: clipx,clipy,clipcx,clipcy = options.clip[ci].split(",")
-					except: clipx, clipy = options.clip[ci].split(",")
-
-					clipx, clipy = int(clipx),int(clipy)
-					clipcx, clipcy = int(clipcx),int(clipcy)
-
-					e = d.get_clip(Region(clipcx-old_div(clipx,2), clipcy-old_div(clipy,2), clipx, clipy))
-
-					try: e.set_attr("avgnimg", d.get_attr("avgnimg"))
-					except: pass
-
-					d = e
-					index_d[option1] += 1
-
-				elif option1 == "randomize":
-					ci = index_d[option1]
-					rnd = options.randomize[ci].split(",")
-					rnd[0] = float(rnd[0])
-					rnd[1] = float(rnd[1])
-					rnd[2] = int(rnd[2])
-
-					t = Transform()
-					t.set_params({"type":"2d", "alpha":random.uniform(-rnd[0],rnd[0]),
-								  "mirror":random.randint(0,rnd[2]), "tx":random.uniform(-rnd[1],rnd[1]),
-								  "ty":random.uniform(-rnd[1],rnd[1])})
-					d.transform(t)
-
-				elif option1 == "medianshrink":
-					shrink_f = options.medianshrink[index_d[option1]]
-
-					if shrink_f > 1:
-						d.process_inplace("math.medianshrink",{"n":shrink_f})
-
-					index_d[option1] += 1
-
-				elif option1 == "meanshrink":
-					mshrink = options.meanshrink[index_d[option1]]
-
-					if mshrink > 1:
-						d.process_inplace("math.meanshrink",{"n":mshrink})
-
-					index_d[option1] += 1
-
-				elif option1 == "fouriershrink":
-					fshrink = options.fouriershrink[index_d[option1]]
-
-					if fshrink > 1:
-						d.process_inplace("math.fft.resample",{"n":fshrink})
-
-					index_d[option1] += 1
-
-				elif option1 == "headertransform":
-					xfmode = options.headertransform[index_d[option1]]
-
-					if xfmode not in (0,1):
-						print("Error: headertransform must be set to 0 or 1")
-						sys.exit(1)
-
-					try: xform=d["xform.align2d"]
-					except: print("Error: particle has no xform.align2d header value")
-
-					if xfmode == 1: xform.invert()
-
-					d.process_inplace("xform",{"transform":xform})
-
-				elif option1 == "selfcl":
-					scl = old_div(options.selfcl[0], 2)
-					sclmd = options.selfcl[1]
-					sc = EMData()
-
-					if sclmd == 0:
-						sc.common_lines_real(d, d, scl, true)
-					else:
-						e = d.copy()
-						e.process_inplace("xform.phaseorigin")
-
-						if sclmd == 1:
-							sc.common_lines(e, e, sclmd, scl, true)
-							sc.process_inplace("math.linear", Dict("shift", EMObject(-90.0), "scale", EMObject(-1.0)))
-						elif sclmd == 2:
-							sc.common_lines(e, e, sclmd, scl, true)
-						else:
-							if options.verbose > 0:
-								print("Error: invalid common-line mode '" + sclmd + "'")
-
-							sys.exit(1)
-
-				elif option1 == "radon":
-					r = d.do_radon()
-					d = r
-
 				elif option1 == "average":
 					average.add_image(d)
 					continue
@@ -962,46 +1141,7 @@ def main():
 							#outfile = outfile + "%04d" % i + ".lst"
 							#options.outtype = "lst"
 
-					dont_scale = (options.fixintscaling == "noscale")
-
-					if options.fixintscaling != None and not dont_scale:
-						if options.fixintscaling == "sane":
-							sca = 2.5
-							d["render_min"] = d["mean"] - d["sigma"]*sca
-							d["render_max"] = d["mean"] + d["sigma"]*sca
-						elif options.fixintscaling == "full" :
-							d["render_min"]=d["minimum"]*1.001
-							d["render_max"]=d["maximum"]*1.001
-						else:
-							try:
-								sca = float(options.fixintscaling)
-							except:
-								sca = 2.5
-
-								print("Warning: bad fixintscaling value - 2.5 used")
-
-							d["render_min"] = d["mean"] - d["sigma"]*sca
-							d["render_max"] = d["mean"] + d["sigma"]*sca
-
-						min_max_set = True
-					else:
-						min_max_set = False
-
-					if options.outmode != "float" or dont_scale:
-
-						if options.outnorescale or dont_scale:
-							# This sets the minimum and maximum values to the range
-							# for the specified type, which should result in no rescaling
-
-							outmode = file_mode_map[options.outmode]
-
-							d["render_min"] = file_mode_range[outmode][0]
-							d["render_max"] = file_mode_range[outmode][1]
-
-						else:
-							if not min_max_set:
-								d["render_min"] = d["minimum"]
-								d["render_max"] = d["maximum"]
+					set_render_range(d, options)
 
 					if options.avgseq > 1:
 						average.add_image(d)
@@ -1092,32 +1232,7 @@ def main():
 							d.write_image(out_name, 0, out_type, False, None, out_mode, not_swap)
 
 						else:   # output a single 2D image or a 2D stack
-							# optionally replace the output image with its rotational average
-
-							if options.rotavg:
-								rd = d.calc_radial_dist(d["nx"],0,0.5,0)
-								d = EMData(len(rd),1,1)
-
-								for x in range(len(rd)): d[x] = rd[x]
-
-							if d["sigma"] == 0:
-								if options.verbose > 0:
-									print("Warning: sigma = 0 for image ",i)
-
-								if options.writejunk == False:
-									if options.verbose > 0:
-										print("Use the writejunk option to force writing this image to disk")
-									continue
-
-							if outfile != None:
-								if options.inplace:
-									if options.compressbits>=0:
-										d.write_compressed(outfile,i,options.compressbits,nooutliers=True)
-									else: d.write_image(outfile, i, out_type, False, None, out_mode, not_swap)
-								else: # append the image
-									if options.compressbits>=0:
-										d.write_compressed(outfile,-1,options.compressbits,nooutliers=True)
-									else: d.write_image(outfile, -1, out_type, False, None, out_mode, not_swap)
+							write_stack_image(d, outfile, i, options)
 
 		# end of image loop
 
@@ -1143,7 +1258,7 @@ def main():
 			curve = fftavg.calc_radial_dist(ny, 0, 0.5, 1)
 			outfile2 = options.fftavg+".txt"
 
-			sf_dx = 1.0 / (apix * 2.0 * ny)
+			sf_dx = 1.0 / (options.apix * 2.0 * ny)
 			Util.save_data(0, sf_dx, curve, outfile2)
 
 		try:
@@ -1167,7 +1282,7 @@ def main():
 	E2end(logid)
 
 def doparallel(argv,parallel,args):
-	print("Parallelism not supported. Please use e2proc2dpar.py")
+	print("Only thread:<n> parallelism is supported. Please use --threads, or e2proc2dpar.py")
 
 if __name__ == "__main__":
 	main()
@@ -55,6 +55,8 @@ def main():
 	Limited version of e2proc2d.py which can operate in parallel using threads. Works on a single input/output file, lacks wildcards and many other options.
 	
 	Note that --inplace is implied. Output image number is always the same as input image number!
+
+	e2proc2d.py --threads now supports most options in parallel, and is generally preferred.
 	"""
 
 	parser = EMArgumentParser(usage=usage,version=EMANVERSION)
@@ -107,11 +109,11 @@ def main():
 		sys.exit(1)
 	
 	N=EMUtil.get_image_count(args[0])
-	npt=max(min(100,old_div(N,(options.threads-2))+1),1)
+	npt=max(min(100,N//max(options.threads-2,1)+1),1)
 	
 	jsd=queue.Queue(0)
 	# these start as arguments, but get replaced with actual threads
-	thrds=[(jsd,args,options,i,i*npt,min(i*npt+npt,N)) for i in range(N//npt)+1]
+	thrds=[(jsd,args,options,i,i*npt,min(i*npt+npt,N)) for i in range((N+npt-1)//npt)]
 
 	#import pprint
 	#pprint.pprint(thrds)
@@ -164,7 +166,7 @@ def procfn(jsd,args,options,thrn,n0,n1):
 				d.set_attr('apix_z', apix)
 
 				try:
-					if i == n0 and d["ctf"].apix != apix :
+					if n == n0 and d["ctf"].apix != apix :
 						if options.verbose > 0:
 							print("Warning: A/pix value in CTF was %1.2f, changing to %1.2f. May impact CTF parameters."%(d["ctf"].apix,apix))
 
@@ -366,11 +368,11 @@ def writeimage(d,fsp,n,options):
 					
 			elif options.fixintscaling=="sane":
 				u=d["mean"]-d["sigma"]*2.5
-				v=d["mean"]-d["sigma"]*2.5
+				v=d["mean"]+d["sigma"]*2.5
 				
 			else:
 				u=d["mean"]-d["sigma"]*float(options.fixintscaling)
-				v=d["mean"]-d["sigma"]*float(options.fixintscaling)
+				v=d["mean"]+d["sigma"]*float(options.fixintscaling)
 		else:
 			u=d["minimum"]
 			v=d["maximum"]
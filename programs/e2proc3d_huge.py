@@ -35,16 +35,23 @@ from EMAN2 import *
 import sys
 from math import *
 import os.path
+from concurrent.futures import ThreadPoolExecutor
 
 def main():
 	progname = os.path.basename(sys.argv[0])
 	usage = progname + """ [options] <inputfile>
 	This is a specialized version of e2proc3d.py targeted at performing a limited set of operations on
 very large volumes in-place (such as tomograms) which may not readily fit into system memory. Operations are 
-performed by reading portions of the image, processing, then writing the portion back to disk. Unlike e2proc3d.py
-you may pass only a single operation to the program for each invocation, or behavior will be undefined. It will 
+performed by reading portions of the image, processing, then writing the portion back to disk. It will 
 process a single volume in a single file in-place.
 
+The volume is processed as slabs of --slab Z slices. Each slab is split into --bricksize X-Y bricks which are
+processed in parallel by --threads threads, while the next slab is being read. Operations are always applied in
+the order: --trans, --process (in the order specified), --multfile, --mult, --add. Processors which look at
+neighboring voxels (filters, etc) need --halo set to the distance they reach, so each brick is processed with
+enough surrounding context. Processors which depend on global statistics (normalization, etc) will not behave
+the same as on the full volume, as each brick is processed independently.
+
 """
 	parser = EMArgumentParser(usage=usage,version=EMANVERSION)
 	
@@ -64,24 +71,153 @@ process a single volume in a single file in-place.
 								help="Adds a constant 'f' to the densities")
 
 	parser.add_argument("--trans", metavar="dx,dy,dz", type=str, default=0, help="Translate map by dx,dy,dz ")
+	parser.add_argument("--slab", type=int, default=32, help="Number of Z slices read, processed and written at once. Default=32")
+	parser.add_argument("--bricksize", type=int, default=512, help="Slabs are split into bricks of this size in X and Y, which are processed in parallel. Default=512")
+	parser.add_argument("--halo", type=int, default=0, help="Each brick is processed with this many voxels of surrounding context, which are then discarded. Set to the reach of any --process filters. Default=0")
+	parser.add_argument("--threads", type=int, default=4, help="Number of bricks to process in parallel. Default=4")
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higher number means higher level of verboseness")
 		
 	(options, args) = parser.parse_args()
 
-	print("Sorry, this program still under development. Not functional yet.")
-	sys.exit(1)
+	if len(args)!=1:
+		parser.error("Please specify a single volume to process in-place")
+
+	if options.streaksubtract!=None :
+		print("ERROR: --streaksubtract is not yet implemented")
+		sys.exit(1)
 
 	try:
-		hdr=EMData(args[1],0,1)
+		hdr=EMData(args[0],0,1)
 	except:
 		print("ERROR: Can't read input file header")
 		sys.exit(1)
 
+	if options.process!=None:
+		try: options.process=[parsemodopt(p) for p in options.process]
+		except:
+			print("ERROR: Can't parse --process ",options.process)
+			sys.exit(1)
 
-	if options.mediansubtract!=None :
-		pass  # Added this to make python happy
-		
+	try: options.trans=parse_trans(options.trans)
+	except:
+		print("ERROR: --trans must be dx,dy,dz")
+		sys.exit(1)
+
+	for f in options.multfile if options.multfile!=None else []:
+		mhdr=EMData(f,0,1)
+		if (mhdr["nx"],mhdr["ny"],mhdr["nz"])!=(hdr["nx"],hdr["ny"],hdr["nz"]):
+			print("ERROR: {} is not the same size as {}".format(f,args[0]))
+			sys.exit(1)
+
+	logid=E2init(sys.argv,options.ppid)
+
+	process_huge(args[0],options)
+
+	E2end(logid)
+
+def parse_trans(trans):
+	"""--trans as a dx,dy,dz tuple of floats"""
+	if not trans: return (0.0,0.0,0.0)
+	dx,dy,dz=[float(i) for i in trans.split(",")]
+	return (dx,dy,dz)
+
+def process_huge(fsp,options):
+	"""Processes the volume in fsp in place, one Z slab at a time, as described in the usage message. Since each slab is
+	overwritten as soon as it is done, the original data of any slab which a later slab still needs (for --halo or
+	--trans) is kept in memory until it isn't needed any more, so memory use is a few slabs regardless of volume size.
+	Slabs are processed in the direction which keeps this to a minimum."""
+	hdr=EMData(fsp,0,1)
+	nx,ny,nz=hdr["nx"],hdr["ny"],hdr["nz"]
+
+	dx,dy,dz=options.trans
+	ix,iy,iz=int(floor(dx)),int(floor(dy)),int(floor(dz))		# integer shifts are done by reading a shifted region
+	frac=(dx-ix,dy-iy,dz-iz)									# only the remainder needs interpolation
+	h=max(0,options.halo)
+	if frac!=(0,0,0): h+=2
+
+	bz=max(1,options.slab)
+	bs=max(1,options.bricksize)
+	nslab=(nz+bz-1)//bz
+	order=list(range(nslab))
+	if iz>0: order.reverse()		# the data for each slab comes from below, so work down to read it before it is overwritten
+
+	def zrange(s):
+		"""Z range of slab s, and the Z range of the original data it depends on"""
+		z0=s*bz
+		z1=min(z0+bz,nz)
+		return z0,z1,max(0,z0-iz-h),min(nz,z1-iz+h)
+
+	def needs(s):
+		"""slabs whose original data slab s depends on"""
+		z0,z1,za,zb=zrange(s)
+		if za>=zb: return []
+		return list(range(za//bz,(zb-1)//bz+1))
+
+	def read_slab(t):
+		z0=t*bz
+		return EMData(fsp,0,False,Region(0,0,z0,nx,ny,min(bz,nz-z0)))
+
+	def do_brick(src,za,z0,z1,x0,y0):
+		bx,by=min(bs,nx-x0),min(bs,ny-y0)
+		img=src.get_clip(Region(x0-ix-h,y0-iy-h,z0-iz-h-za,bx+2*h,by+2*h,z1-z0+2*h))
+		if frac!=(0,0,0): img.translate(*frac)
+		if options.trans!=(0,0,0):
+			# context outside the volume would have been shifted in from inside it, so we clear it, as if the whole volume had been translated
+			xs,ys,zs=max(0,h-x0),max(0,h-y0),max(0,h-z0)
+			xe,ye,ze=min(bx+2*h,nx-x0+h),min(by+2*h,ny-y0+h),min(z1-z0+2*h,nz-z0+h)
+			img=img.get_clip(Region(xs,ys,zs,xe-xs,ye-ys,ze-zs)).get_clip(Region(-xs,-ys,-zs,bx+2*h,by+2*h,z1-z0+2*h))
+		if options.process!=None:
+			for name,parms in options.process: img.process_inplace(name,parms)
+		if h>0: img=img.get_clip(Region(h,h,h,bx,by,z1-z0))
+		if options.multfile!=None:
+			for f in options.multfile: img.mult(EMData(f,0,False,Region(x0,y0,z0,bx,by,z1-z0)))
+		if options.mult!=None: img.mult(options.mult)
+		if options.add!=None: img.add(options.add)
+		return img
+
+	orig={}			# original data of slabs, kept while unwritten slabs still depend on it
+	pending={}		# slabs being read in the background
+	written=set()
+	reader=ThreadPoolExecutor(1)
+	pool=ThreadPoolExecutor(max(1,options.threads))
+
+	for k,s in enumerate(order):
+		z0,z1,za,zb=zrange(s)
+		if options.verbose: print("Slab {}/{}: Z {}-{}".format(k+1,nslab,z0,z1-1))
+
+		# assemble the original data this slab depends on
+		src=EMData(nx,ny,max(1,zb-za))
+		src.to_zero()
+		for t in needs(s):
+			if t not in orig:
+				if t in pending: orig[t]=pending.pop(t).result()
+				else: orig[t]=read_slab(t)
+			src.insert_clip(orig[t],(0,0,t*bz-za))
+
+		# while we work on this slab, read whatever the next one will need, but nothing we are about to overwrite
+		remaining=order[k+1:]
+		if len(remaining)>0:
+			for t in needs(remaining[0]):
+				if t!=s and t not in orig and t not in pending and t not in written: pending[t]=reader.submit(read_slab,t)
+
+		# this slab's own original data must be kept if later slabs depend on it
+		future=set(t for u in remaining for t in needs(u))
+		if s in future and s not in orig: orig[s]=read_slab(s)
+
+		out=EMData(nx,ny,z1-z0)
+		bricks=[(x0,y0) for y0 in range(0,ny,bs) for x0 in range(0,nx,bs)]
+		for (x0,y0),img in zip(bricks,pool.map(lambda b:do_brick(src,za,z0,z1,b[0],b[1]),bricks)):
+			out.insert_clip(img,(x0,y0,0))
+
+		out.write_image(fsp,0,IMAGE_UNKNOWN,False,Region(0,0,z0,nx,ny,z1-z0))
+		written.add(s)
+
+		for t in list(orig.keys()):
+			if t not in future: del orig[t]
+
+	reader.shutdown()
+	pool.shutdown()
 
 def findmode(img) :
 	"""This computes something akin to the mode"""
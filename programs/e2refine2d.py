@@ -72,6 +72,7 @@ def main():
 	parser.add_argument("--automask",default=False, action="store_true",help="Automasking during class-averaging to help with centering when particle density is high",guitype="boolbox", row=2,col=2,rowspan=1,colspan=1,mode="spr")
 	parser.add_argument("--naliref", default=5, type=int, help="Number of alignment references to when determining particle orientations", guitype='intbox', row=3, col=0, rowspan=1, colspan=1, mode="spr")
 	parser.add_argument("--parallel","-P",type=str,help="Run in parallel, specify type:<option>=<value>:<option>:<value>",default=None, guitype='strbox', row=4, col=0, rowspan=1, colspan=3, mode="spr")
+	parser.add_argument("--ptclcache", default=False, action="store_true", help="With --parallel, shrink (classification) and normalize (class-averaging) the particles once into memory mapped caches in the output directory, rather than in every task")
 	parser.add_argument("--centeracf", default=False, action="store_true",help="This option has been removed in favor of a new centering algorithm")
 	parser.add_argument("--center",type=str,default="xform.center",help="If the default centering algorithm (xform.center) doesn't work well, you can specify one of the others here (e2help.py processor center)",guitype='comboparambox', choicelist='dict(list(re_filter_list(dump_processors_list(),"xform.center").items())+[("nocenter",["Do not center class averages. (similar to what relion does)"])])', row=3, col=1, rowspan=1, colspan=2, mode="spr")
 	parser.add_argument("--check", "-c",default=False, action="store_true",help="Checks the contents of the current directory to verify that e2refine2d.py command will work - checks for the existence of the necessary starting files and checks their dimensions. Performs no work ")
@@ -276,6 +277,7 @@ def main():
 		if options.simralign : e2simmxcmd += " --ralign=%s --raligncmp=%s" %(options.simralign,options.simraligncmp)
 		if options.parallel: e2simmxcmd += " --parallel=%s" %options.parallel
 		if options.shrink: e2simmxcmd += " --shrink=%d" %options.shrink
+		if options.ptclcache: e2simmxcmd += " --ptclcache"
 		run(e2simmxcmd)
 		proc_tally += 1.0
 		if logid : E2progress(logid,old_div(proc_tally,total_procs))
@@ -314,6 +316,7 @@ def get_classaverage_extras(options):
 		s += " --ralign=%s --raligncmp=%s" %(options.classralign,options.classraligncmp)
 	if options.parallel != None:
 		s += " --parallel=%s" %options.parallel
+		if options.ptclcache: s += " --ptclcache"
 
 	return s
 
@@ -189,6 +189,7 @@ not need to specify any of the following other than the ones already listed abov
 	parser.add_argument("--m3dpostprocess", type=str, default=None, help="Default=none. An arbitrary post-processor to run after all other automatic processing. Maps are autofiltered, so a low-pass filter should not normally be used here.", guitype='comboparambox', choicelist='re_filter_list(dump_processors_list(),"filter.lowpass|filter.highpass|mask")', row=26, col=0, rowspan=1, colspan=3, mode="refinement")
 	parser.add_argument("--parallel","-P",type=str,help="Run in parallel, specify type:<option>=<value>:<option>=<value>. See http://blake.bcm.edu/emanwiki/EMAN2/Parallel",default="thread:4", guitype='strbox', row=30, col=0, rowspan=1, colspan=2, mode="refinement[thread:4]")
 	parser.add_argument("--threads", default=4,type=int,help="Number of threads to run in parallel on a single computer when multi-computer parallelism isn't useful", guitype='intbox', row=30, col=2, rowspan=1, colspan=1, mode="refinement[4]")
+	parser.add_argument("--ptclcache", default=False, action="store_true", help="Shrink (classification) and normalize (class-averaging) the particles once per step into memory mapped caches in the refinement directory, rather than in every parallel task. Needs enough disk space for the preprocessed particles.")
 	parser.add_argument("--path", default=None, type=str,help="The name of a directory where results are placed. Default = create new refine_xx")
 	parser.add_argument("--compressbits",type=int,help="Bits of precision to keep in class-averages and 3-D volumes, 0->losless, default=10 (3 decimal digits of precision)", default=10)
 	parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level [0-9], higher number means higher level of verboseness")
@@ -667,6 +668,9 @@ are memory concerns, using a smaller pad option may be the only reasonable alter
 	elif options.threads>1: parallel="--parallel thread:{}".format(options.threads)
 	else: parallel=""
 
+	if options.ptclcache and parallel!="" : ptclcache="--ptclcache"
+	else: ptclcache=""
+
 	if options.prefilt : prefilt="--prefilt"
 	elif options.prectf : prefilt="--prectf"
 	else: prefilt=""
@@ -893,14 +897,14 @@ power spectrum of one of the maps to the other. For example <i>e2proc3d.py map_e
 
 			append_html("<p>* Computing similarity of each particle to the set of projections using a hierarchical scheme. This will be the basis for classification.</p>",True)
 			cmd = "e2simmx2stage.py {path}/projections_{itr:02d}_even.hdf {inputfile} {path}/simmx_{itr:02d}_even.hdf {path}/proj_simmx_{itr:02d}_even.hdf {path}/proj_stg1_{itr:02d}_even.hdf {path}/simmx_stg1_{itr:02d}_even.hdf --saveali --cmp {simcmp} \
-	--align {simalign} --aligncmp {simaligncmp} {simralign} {shrinks1} {shrink} {prefilt} {simmask} {verbose} {parallel}".format(
+	--align {simalign} --aligncmp {simaligncmp} {simralign} {shrinks1} {shrink} {prefilt} {simmask} {verbose} {parallel} {ptclcache}".format(
 				path=options.path,itr=it,inputfile=options.input[0],simcmp=options.simcmp,simalign=options.simalign,simaligncmp=options.simaligncmp,simralign=simralign,
-				shrinks1=shrinks1,shrink=shrink,prefilt=prefilt,simmask=simmask,verbose=verbose,parallel=parallel)
+				shrinks1=shrinks1,shrink=shrink,prefilt=prefilt,simmask=simmask,verbose=verbose,parallel=parallel,ptclcache=ptclcache)
 			run(cmd)
 			cmd = "e2simmx2stage.py {path}/projections_{itr:02d}_odd.hdf {inputfile} {path}/simmx_{itr:02d}_odd.hdf {path}/proj_simmx_{itr:02d}_odd.hdf {path}/proj_stg1_{itr:02d}_odd.hdf {path}/simmx_stg1_{itr:02d}_odd.hdf --saveali --cmp {simcmp} \
-	--align {simalign} --aligncmp {simaligncmp} {simralign} {shrinks1} {shrink} {prefilt} {simmask} {verbose} {parallel}".format(
+	--align {simalign} --aligncmp {simaligncmp} {simralign} {shrinks1} {shrink} {prefilt} {simmask} {verbose} {parallel} {ptclcache}".format(
 				path=options.path,itr=it,inputfile=options.input[1],simcmp=options.simcmp,simalign=options.simalign,simaligncmp=options.simaligncmp,simralign=simralign,
-				shrinks1=shrinks1,shrink=shrink,prefilt=prefilt,simmask=simmask,verbose=verbose,parallel=parallel)
+				shrinks1=shrinks1,shrink=shrink,prefilt=prefilt,simmask=simmask,verbose=verbose,parallel=parallel,ptclcache=ptclcache)
 			run(cmd)
 			progress += 1.0
 			E2progress(logid,old_div(progress,total_procs))
@@ -941,19 +945,19 @@ power spectrum of one of the maps to the other. For example <i>e2proc3d.py map_e
 			else: focused =""
 			cmd="e2classaverage.py {inputfile} --classmx {path}/classmx_{itr:02d}_even.hdf --decayedge --storebad --output {path}/classes_{itr:02d}_even.hdf --ref {path}/projections_{itr:02d}_even.hdf --iter {classiter} \
 	--resultmx {path}/cls_result_{itr:02d}_even.hdf --normproc {normproc} --averager {averager} {classrefsf} {classautomask} --keep {classkeep} {classkeepsig} --cmp {classcmp} \
-	--align {classalign} --aligncmp {classaligncmp} {classralign} {prefilt} {focused} {verbose} --compressbits {compressbits} {parallel}".format(
+	--align {classalign} --aligncmp {classaligncmp} {classralign} {prefilt} {focused} {verbose} --compressbits {compressbits} {parallel} {ptclcache}".format(
 				inputfile=cainput[0], path=options.path, itr=it, classiter=classiter, normproc=options.classnormproc, averager=options.classaverager, classrefsf=classrefsf,
 				classautomask=classautomask,classkeep=options.classkeep, classkeepsig=classkeepsig, classcmp=options.classcmp, classalign=options.classalign, classaligncmp=options.classaligncmp,
-				classralign=classralign, prefilt=prefilt,focused=focused, verbose=verbose, compressbits=options.compressbits, parallel=parallel)
+				classralign=classralign, prefilt=prefilt,focused=focused, verbose=verbose, compressbits=options.compressbits, parallel=parallel, ptclcache=ptclcache)
 			run(cmd)
 			
 			if options.focused : focused="--focused {path}/projections_odd_masked.hdf".format(path=options.path)
 			cmd="e2classaverage.py {inputfile} --classmx {path}/classmx_{itr:02d}_odd.hdf --decayedge --storebad --output {path}/classes_{itr:02d}_odd.hdf --ref {path}/projections_{itr:02d}_odd.hdf --iter {classiter} \
 	--resultmx {path}/cls_result_{itr:02d}_odd.hdf --normproc {normproc} --averager {averager} {classrefsf} {classautomask} --keep {classkeep} {classkeepsig} --cmp {classcmp} \
-	--align {classalign} --aligncmp {classaligncmp} {classralign} {prefilt} {focused} {verbose} --compressbits {compressbits} {parallel}".format(
+	--align {classalign} --aligncmp {classaligncmp} {classralign} {prefilt} {focused} {verbose} --compressbits {compressbits} {parallel} {ptclcache}".format(
 				inputfile=cainput[1], path=options.path, itr=it, classiter=classiter, normproc=options.classnormproc, averager=options.classaverager, classrefsf=classrefsf,
 				classautomask=classautomask,classkeep=options.classkeep, classkeepsig=classkeepsig, classcmp=options.classcmp, classalign=options.classalign, classaligncmp=options.classaligncmp,
-				classralign=classralign, prefilt=prefilt,focused=focused, verbose=verbose, compressbits=options.compressbits, parallel=parallel)
+				classralign=classralign, prefilt=prefilt,focused=focused, verbose=verbose, compressbits=options.compressbits, parallel=parallel, ptclcache=ptclcache)
 			run(cmd)
 		except:
 			print("classaverage error")
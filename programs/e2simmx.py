@@ -129,6 +129,9 @@ class EMParallelSimMX(object):
 
 			if hasattr(options,"shrink") and options.shrink != None: d["shrink"] = options.shrink
 			else: d["shrink"] = None
+			# folder containing the shrunken image caches, if any
+			if getattr(options,"ptclcache",False) and d["shrink"]!=None and d["shrink"]>1 : d["ptclcache"]=os.path.dirname(self.args[2])
+			else: d["ptclcache"]=None
 
 
 			self.__task_options = d
@@ -215,6 +218,16 @@ class EMParallelSimMX(object):
 		if len(self.options.parallel) > 1 :
 			self.__init_memory(self.options)
 			blocks = self.__get_blocks()
+
+			# shrink the references and particles once here, rather than in every task
+			caches=[]
+			if self.options.ptclcache and self.options.shrink!=None and self.options.shrink>1 :
+				from EMAN2PAR import EMStackCache
+				print("Preparing shrunken image caches")
+				for fsp in self.args[:2]:
+					c=EMStackCache(fsp,[("math.fft.resample",{"n":self.options.shrink})],os.path.dirname(self.args[2]))
+					c.build()
+					caches.append(c)
 #			print blocks
 
 #			self.check_blocks(blocks) # testing function can be removed at some point
@@ -300,6 +313,7 @@ class EMParallelSimMX(object):
 
 				time.sleep(10)
 			print("\nAll simmx tasks complete ")
+			for c in caches: c.remove()
 
 			# if using fillzero, we must fix the -1.0e38 values placed into empty cells
 			if self.options.fillzero :
@@ -382,6 +396,15 @@ class EMSimTaskDC(JSTask):
 
 		ref_data_name=self.data["references"][1]
 		ref_indices = image_range(*self.data["references"][2:])
+		ptcl_data_name=self.data["particles"][1]
+
+		# images already shrunken by the customer (--ptclcache)
+		refcache=ptclcache=None
+		if options.get("ptclcache",None)!=None and shrink!=None :
+			from EMAN2PAR import EMStackCache
+			refcache=EMStackCache(ref_data_name,[("math.fft.resample",{"n":shrink})],options["ptclcache"])
+			ptclcache=EMStackCache(ptcl_data_name,[("math.fft.resample",{"n":shrink})],options["ptclcache"])
+			if not (refcache.exists() and ptclcache.exists()) : refcache=ptclcache=None
 
 		if "colmasks" in self.data :
 			ref_masks_name=self.data["colmasks"][1]
@@ -395,6 +418,15 @@ class EMSimTaskDC(JSTask):
 #		print self.data["references"][2:]
 		refs = {}
 		for idx in ref_indices:
+			if refcache!=None :
+				image=refcache.get(idx)
+				if ref_masks_name==None : refs[idx] = [image,None]
+				else :
+					mask=EMData(ref_masks_name,idx)
+					if shrink != None : mask.process_inplace("math.fft.resample",{"n":shrink})
+					refs[idx] = [image,mask]
+				continue
+
 			datareaderror=True
 			for datareadid in range(20):
 				try: image = EMData(ref_data_name,idx)
@@ -419,11 +451,14 @@ class EMSimTaskDC(JSTask):
 					mask.process_inplace("math.fft.resample",{"n":shrink})
 				refs[idx] = [image,mask]
 
-		ptcl_data_name=self.data["particles"][1]
 		ptcl_indices = image_range(*self.data["particles"][2:])
 
 		ptcls = {}
 		for idx in ptcl_indices:
+			if ptclcache!=None :
+				ptcls[idx] = ptclcache.get(idx)
+				continue
+
 			datareaderror=True
 			for datareadid in range(20):
 				try: image = EMData(ptcl_data_name,idx)
@@ -641,6 +676,7 @@ def main():
 #	parser.add_argument("--force", "-f",dest="force",default=False, action="store_true",help="Force overwrite the output file if it exists")
 	parser.add_argument("--exclude", type=str,default=None,help="The named file should contain a set of integers, each representing an image from the input file to exclude. Matrix elements will still be created, but will be zeroed.")
 	parser.add_argument("--shrink", type=float,default=None,help="Optionally shrink the input particles by an integer amount prior to computing similarity scores. This will speed the process up.")
+	parser.add_argument("--ptclcache",action="store_true",help="With --parallel and --shrink, shrink the references and particles once into a memory mapped cache next to the output, rather than in every task",default=False)
 	parser.add_argument("--nofilecheck",action="store_true",help="Turns file checking off in the check functionality - used by e2refine.py.",default=False)
 	parser.add_argument("--check","-c",action="store_true",help="Performs a command line argument check only.",default=False)
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
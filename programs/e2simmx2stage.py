@@ -74,6 +74,7 @@ def main():
 	parser.add_argument("--finalstage",action="store_true",help="Assume that existing preliminary particle classifications are correct, and only recompute final local orientations",default=False)
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
 	parser.add_argument("--parallel",type=str,help="Parallelism string",default="thread:1")
+	parser.add_argument("--ptclcache",action="store_true",help="Passed to e2simmx, shrink the images once into a memory mapped cache rather than in every task",default=False)
 #	parser.add_argument("--force", "-f",dest="force",default=True, action="store_true",help="Deprecated. Value ignored")
 
 	(options, args) = parser.parse_args()
@@ -177,6 +178,7 @@ def main():
 		if options.prectf : cmd+=" --prectf"
 		if options.ralign!=None : cmd+=" --ralign=%s --raligncmp=%s"%(options.ralign,options.raligncmp)
 		if options.parallel!=None : cmd+=" --parallel="+options.parallel
+		if options.ptclcache : cmd+=" --ptclcache"
 		if options.exclude!=None : cmd+=" --exclude="+options.exclude
 		print("executing ",cmd)
 		launch_childprocess(cmd)
@@ -229,6 +231,7 @@ def main():
 	if options.prefilt : cmd+=" --prefilt"
 	if options.prectf : cmd+=" --prectf"
 	if options.parallel: cmd += " --parallel=%s" %options.parallel
+	if options.ptclcache : cmd += " --ptclcache"
 
 	#if (options.lowmem): e2simmxcmd += " --lowmem"
 
@@ -5,7 +5,7 @@ import numpy as np
 import queue
 import threading
 from EMAN2jsondb import JSTask
-from EMAN2PAR import EMTaskCustomer
+from EMAN2PAR import EMTaskCustomer, EMTaskJournal, prepared_images, clear_prepared_images
 from scipy.optimize import minimize
 
 def main():
@@ -17,6 +17,9 @@ def main():
 	parser.add_argument("--ptclout", type=str,help="particle output", default=None)
 	parser.add_argument("--ref", type=str,help="reference input", default=None)
 	parser.add_argument("--parallel", type=str,help="Thread/mpi parallelism to use. Default is thread:12", default="thread:12")
+	parser.add_argument("--minchunk", type=int,help="minimum number of particles per task. Default is 4", default=4)
+	parser.add_argument("--retries", type=int,help="number of times a failed task is rerun before giving up. Default is 0", default=0)
+	parser.add_argument("--resume", action="store_true", default=False ,help="reuse results of tasks completed by a previous, interrupted run with the same --ptclout")
 
 	parser.add_argument("--debug", action="store_true", default=False ,help="Turn on debug mode. This will only process a small subset of the data")
 	parser.add_argument("--curve", action="store_true", default=False ,help="curve mode")
@@ -50,7 +53,11 @@ def main():
 		#options.maxshift=bxsz//2
 	
 	print("Initializing parallelism...")
-	etc=EMTaskCustomer(options.parallel, module="e2spa_align.SpaAlignTask")	
+	### with --resume or --retries, completed tasks are journaled next to the output, so an interrupted run can be resumed
+	journal=None
+	if options.resume or options.retries>0:
+		journal=EMTaskJournal(os.path.splitext(options.ptclout)[0]+"_journal", options.resume)
+	etc=EMTaskCustomer(options.parallel, module="e2spa_align.SpaAlignTask", retries=options.retries, journal=journal)	
 	num_cpus = etc.cpu_est()
 	
 	print("{} particles".format(nptcl))
@@ -60,44 +67,31 @@ def main():
 		print("Debugging mode. running on one thread with 8 particles")
 		
 	
-	nbatch=min(nptcl, num_cpus)
-	
-	infos=[[] for i in range(nbatch)]
-	for i,info in enumerate(pinfo):
-		infos[i%nbatch].append([i, info])
-		
-	print("{} jobs, each with {:.1f} particles".format(len(infos), np.mean([len(i) for i in infos])))
-	
-	tids=[]
-	for info in infos:
-		task = SpaAlignTask(info, options)
-			
-		if options.debug:
-			task.execute(print)
-			return
-		tid=etc.send_task(task)
-		tids.append(tid)
-	
-	while 1:
-		st_vals = etc.check_task(tids)
-		if -100 in st_vals:
-			print("Error occurs in parallelism. Exit")
-			return
-		E2progress(logid, np.mean(st_vals)/100.)
-		
-		if np.min(st_vals) == 100: break
-		time.sleep(5)
+	infos=[[i, info] for i,info in enumerate(pinfo[:nptcl])]
+	if options.debug:
+		task=SpaAlignTask(infos[:max(1,nptcl//num_cpus)], options)
+		task.execute(print)
+		if journal is not None: journal.clear()
+		clear_prepared_images(os.path.dirname(options.ptclout) or ".")
+		return
 	
+	### particles are handed out in shrinking chunks as workers become free, so a few slow particles don't hold up the whole iteration
 	output=[None]*nptcl
-	for i in tids:
-		ret=etc.get_results(i)[1]
-		for r in ret:
-			output[r[0]]=r[1]
+	try:
+		for chunk,ret in etc.map_items(infos, lambda c: SpaAlignTask(c, options), minchunk=options.minchunk, progress=lambda p: E2progress(logid, p)):
+			for r in ret:
+				output[r[0]]=r[1]
+	except Exception as e:
+		print(e)
+		print("Error occurs in parallelism. Exit")
+		return
 	
 	del etc
 	
 	fm=options.ptclout
-	save_lst_params(output, fm)
+	save_lst_params(output, fm, sidecar=True)
+	if journal is not None: journal.clear()
+	clear_prepared_images(os.path.dirname(options.ptclout) or ".")
 	
 	E2end(logid)
 
@@ -106,6 +100,12 @@ def run(cmd):
 	launch_childprocess(cmd)
 	
 
+### Coarse search projections depend only on the reference, box size and orientation, not on the particle.
+### This is module level, so with persistent workers (--parallel pool:N) it is also reused across tasks,
+### and with thread_sm it is shared by concurrent tasks, hence the lock
+coarse_cache={}
+coarse_lock=threading.Lock()
+
 class SpaAlignTask(JSTask):
 	
 	
@@ -118,20 +118,26 @@ class SpaAlignTask(JSTask):
 	def execute(self, callback):
 		time0=time.time()
 		
-		def test_rot(x, returnxf=False):
-			if isinstance(x, Transform):
-				xf=x
+		def test_rot(x, returnxf=False, prj=None):
+			if prj is not None:
+				### precomputed (transform, projection, extrarot projection) from coarse_projections. The projections
+				### are on the exact grid, but each particle still gets its own jitter of the orientation. At the coarse
+				### box size the 0.1 degree jitter moves the projection by a small fraction of a pixel, so the score is
+				### unaffected, while the orientations passed on to refinement don't share a systematic grid bias.
+				xf=jitter(Transform(prj[0]))
+				pj=prj[1].copy()
+				
 			else:
-				x=list(x)
-				x.extend(curxf[len(x):])
-				xf=Transform({"type":"eman", "az":x[0], "alt":x[1], "phi":x[2],"tx":x[3], "ty":x[4]})
-			
-			v=np.random.randn(3)
-			v/=np.linalg.norm(v)
-			tiny=Transform({"type":"spin","omega":.1,"n1":v[0],"n2":v[1],"n3":v[2]})
-			xf=tiny*xf
-			
-			pj=refsmall.project('gauss_fft',{"transform":xf, "returnfft":1})
+				if isinstance(x, Transform):
+					xf=x
+				else:
+					x=list(x)
+					x.extend(curxf[len(x):])
+					xf=Transform({"type":"eman", "az":x[0], "alt":x[1], "phi":x[2],"tx":x[3], "ty":x[4]})
+				
+				xf=jitter(xf)
+				pj=refsmall.project('gauss_fft',{"transform":xf, "returnfft":1})
+				
 			x0=options.minrespx; x1=int(ss*.4)
 			xf2=Transform(xf)
 
@@ -152,7 +158,10 @@ class SpaAlignTask(JSTask):
 			
 			if options.extrarot:
 				
-				pj2=refrotsmall.project('gauss_fft',{"transform":xf2*r45, "returnfft":1})
+				if prj is not None:
+					pj2=prj[2].copy()
+				else:
+					pj2=refrotsmall.project('gauss_fft',{"transform":xf2*r45, "returnfft":1})
 				ccf=imgsmall.calc_ccf(pj2)
 				pos=ccf.calc_max_location_wrap(mxsft, mxsft, 0)
 				pj2.process_inplace("xform", {"tx":pos[0], "ty":pos[1]})
@@ -173,6 +182,31 @@ class SpaAlignTask(JSTask):
 			else:
 				return scr
 		
+		def jitter(xf):
+			v=np.random.randn(3)
+			v/=np.linalg.norm(v)
+			tiny=Transform({"type":"spin","omega":.1,"n1":v[0],"n2":v[1],"n3":v[2]})
+			return tiny*xf
+		
+		def coarse_projections(clsid, ss):
+			### project the reference in all coarse orientations once, then compare every particle against them
+			key=(refnames[clsid], os.path.getmtime(refnames[clsid]), ny, ss, options.sym, options.curve, options.extrarot)
+			### held while projecting too, so concurrent tasks wait for one copy rather than each making their own
+			with coarse_lock:
+				if key not in coarse_cache:
+					### only keep projections of the current version of the current references
+					for k in [k for k in coarse_cache if k[0] not in refnames or (k[0]==key[0] and k[1]!=key[1])]:
+						del coarse_cache[k]
+					prjs=[]
+					for xf in xfcrs:
+						pj=refsmall.project('gauss_fft',{"transform":xf, "returnfft":1})
+						if options.extrarot:
+							pj2=refrotsmall.project('gauss_fft',{"transform":xf*r45, "returnfft":1})
+						else:
+							pj2=None
+						prjs.append((xf, pj, pj2))
+					coarse_cache[key]=prjs
+				return coarse_cache[key]
 		
 		options=self.options
 		data=self.data
@@ -186,24 +220,30 @@ class SpaAlignTask(JSTask):
 		else:
 			refnames=[reffile, reffile]
 			
-		refs=[]
-		for r in refnames:
-			ref=EMData(r)
-			ref=ref.do_fft()
-			ref.process_inplace("xform.phaseorigin.tocenter")
-			ref.process_inplace("xform.fourierorigin.tocenter")
-			refs.append(ref)
-			
-		if options.extrarot:
-			refsrot=[]
-			r45=Transform({"type":"eman","alt":45,"az":45})
+		r45=Transform({"type":"eman","alt":45,"az":45})
+		def prep_refs():
+			refs=[]
 			for r in refnames:
 				ref=EMData(r)
-				ref.process("xform",{"transform":r45})
 				ref=ref.do_fft()
 				ref.process_inplace("xform.phaseorigin.tocenter")
 				ref.process_inplace("xform.fourierorigin.tocenter")
-				refsrot.append(ref)
+				refs.append(ref)
+				
+			if options.extrarot:
+				for r in refnames:
+					ref=EMData(r)
+					ref.process("xform",{"transform":r45})
+					ref=ref.do_fft()
+					ref.process_inplace("xform.phaseorigin.tocenter")
+					ref.process_inplace("xform.fourierorigin.tocenter")
+					refs.append(ref)
+			return refs
+		
+		### every task uses the same references, so they are only read and FFTed once per iteration
+		refs=prepared_images(refnames, ("spa", options.extrarot), prep_refs, os.path.dirname(options.ptclout) or ".")
+		refsrot=refs[len(refnames):]
+		refs=refs[:len(refnames)]
 			
 		
 		ref=EMData(refnames[0], 0, True)
@@ -318,8 +358,8 @@ class SpaAlignTask(JSTask):
 				if si==0:
 					
 					newxfs=[]
-					for xf in xfcrs:
-						scr, x=test_rot(xf, True)
+					for prj in coarse_projections(clsid, ss):
+						scr, x=test_rot(None, True, prj)
 						score.append(scr)
 						newxfs.append(x)
 				
@@ -97,6 +97,8 @@ If --goldstandard is specified, even and odd variants of the alignment reference
 	parser.add_argument("--maxang",type=float,help="Maximum angular difference for the refine mode. default is 30",default=30)
 	parser.add_argument("--maxshift",type=float,help="Maximum shift for the refine mode. default is 16",default=-1)
 	parser.add_argument("--scipytest",action="store_true",help="test scipy optimizer.",default=False)
+	parser.add_argument("--retries", type=int,help="number of times a failed task is rerun before giving up. default is 0",default=0)
+	parser.add_argument("--resume",action="store_true",help="reuse results of tasks completed by a previous, interrupted run of the same iteration",default=False)
 	parser.add_argument("--debug",action="store_true",help=".",default=False)
 
 
@@ -192,11 +194,15 @@ If --goldstandard is specified, even and odd variants of the alignment reference
 			
 
 
-	from EMAN2PAR import EMTaskCustomer
+	from EMAN2PAR import EMTaskCustomer, EMTaskJournal, clear_prepared_images
+	### with --resume or --retries, completed tasks are journaled in the refinement folder, so an interrupted iteration can be resumed
+	journal=None
+	if options.resume or options.retries>0:
+		journal=EMTaskJournal("{}/journal_{:02d}".format(options.path,options.iter), options.resume, ignore=("nowtime",))
 	if options.scipytest:
-		etc=EMTaskCustomer(options.parallel, module="e2spt_align.ScipySptAlignTask")
+		etc=EMTaskCustomer(options.parallel, module="e2spt_align.ScipySptAlignTask", retries=options.retries, journal=journal)
 	else:
-		etc=EMTaskCustomer(options.parallel, module="e2spt_align.SptAlignTask")
+		etc=EMTaskCustomer(options.parallel, module="e2spt_align.SptAlignTask", retries=options.retries, journal=journal)
 	num_cpus = etc.cpu_est()
 	options.nowtime=time.time()
 	print("{} jobs on {} CPUs".format(len(tasks), num_cpus))
@@ -212,36 +218,30 @@ If --goldstandard is specified, even and odd variants of the alignment reference
 		if options.debug:
 			ret=task.execute(print)
 			print(ret)
+			clear_prepared_images(options.path)
 			return 
 		tid=etc.send_task(task)
 		tids.append(tid)
 
-	while 1:
-		st_vals = etc.check_task(tids)
-		#print(st_vals)
-		if -100 in st_vals:
-			print("Error occurs in parallelism. Exit")
-			return
-		E2progress(logid, np.mean(st_vals)/100.)
-		
-		if np.min(st_vals) == 100: break
-		time.sleep(5)
-
 	#dics=[0]*nptcl
 	
 	angs={}
-	for i in tids:
-		rets=etc.get_results(i)[1]
-		for ret in rets:
-			fsp,n,dic=ret
-			if len(dic)==1:
-				dic=dic[0]
-				
-			if readjson:
-				k=str((fsp,n))
-				if "eo" in js[k]:
-					dic["eo"]=jsinput[k]["eo"]
-			angs[(fsp,n)]=dic
+	try:
+		for tid,task,rets in etc.as_completed(tids, lambda p: E2progress(logid, p)):
+			for ret in rets:
+				fsp,n,dic=ret
+				if len(dic)==1:
+					dic=dic[0]
+					
+				if readjson:
+					k=str((fsp,n))
+					if "eo" in js[k]:
+						dic["eo"]=jsinput[k]["eo"]
+				angs[(fsp,n)]=dic
+	except Exception as e:
+		print(e)
+		print("Error occurs in parallelism. Exit")
+		return
 		
 	out="{}/particle_parms_{:02d}.json".format(options.path,options.iter)
 	if os.path.isfile(out):
@@ -249,6 +249,8 @@ If --goldstandard is specified, even and odd variants of the alignment reference
 	js=js_open_dict(out)
 	js.update(angs)
 	js.close()
+	if journal is not None: journal.clear()
+	clear_prepared_images(options.path)
 
 	del etc
 
@@ -495,30 +497,37 @@ class SptAlignTask(JSTask):
 		#####[src, ii, refnames, ii%2, xf]
 		
 		refnames=self.data[0][2]
-		refs=[]
-		for r in refnames:
-			if options.mask==None :
-				# refs are FFT without a mask real with
-				ref=EMData(r,0).do_fft()
-				ref.process_inplace("xform.phaseorigin.tocorner")
-				refs.append(ref)
-				mask=None
-			else:
-				ref=EMData(r,0)
-				refs.append(ref)
-				mask=EMData(options.mask,0)
-			
 		if options.breaksym:
 			x=Transform()
 			nsym=x.get_nsym(options.breaksymsym)
-			refasym=[]
-			for r in refs:
-				rs=[]
+		else:
+			nsym=0
+		
+		def prep_refs():
+			refs=[]
+			for r in refnames:
+				if options.mask==None :
+					# refs are FFT without a mask real with
+					ref=EMData(r,0).do_fft()
+					ref.process_inplace("xform.phaseorigin.tocorner")
+				else:
+					ref=EMData(r,0)
+				refs.append(ref)
+			
+			# followed by the symmetry copies of each reference for breaksym
+			for r in refs[:len(refnames)]:
 				for i in range(nsym):
-					rt=r.process("xform",{"transform":x.get_sym(options.breaksymsym, i)})
-					rs.append(rt)
-				refasym.append(rs)
-				
+					refs.append(r.process("xform",{"transform":x.get_sym(options.breaksymsym, i)}))
+			return refs
+		
+		# every task of the iteration uses the same references, so they are only prepared once
+		from EMAN2PAR import prepared_images
+		refs=prepared_images(refnames, (options.mask==None, options.breaksym, options.breaksymsym), prep_refs, options.path)
+		refasym=[refs[len(refnames)+j*nsym:len(refnames)+(j+1)*nsym] for j in range(len(refnames))]
+		refs=refs[:len(refnames)]
+		if options.mask==None: mask=None
+		else: mask=EMData(options.mask,0)
+		
 			
 		rets=[]
 		
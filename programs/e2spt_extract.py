@@ -7,6 +7,7 @@ from EMAN2 import *
 import numpy as np
 import queue
 import threading
+import multiprocessing
 from EMAN2_utils import *
 from EMAN2jsondb import JSTask
 import os
@@ -93,6 +94,9 @@ def main():
 	parser.add_argument("--norewrite", action="store_true", default=False ,help="skip existing files. do not rewrite.")
 	parser.add_argument("--append", action="store_true", default=False ,help="append to existing files.")
 	parser.add_argument("--parallel", type=str,help="parallel", default="")
+	parser.add_argument("--batch", action="store_true", default=False ,help="Extract particles with a pool of --threads processes sharing the preprocessed tilt series. Particles are processed in order of depth, and CTF phase flipping is computed once per tilt and defocus band (see --dfband). Not available on Windows.")
+	parser.add_argument("--dfband", type=float,help="Width of the defocus bands in um for --batch. Defocus of each subtilt is rounded to the center of its band. 0 computes CTF flipping for every subtilt. default is 0.02", default=0.02)
+	parser.add_argument("--batchsize", type=int,help="Maximum number of particles sent to a worker at a time for --batch. default is 32", default=32)
 	parser.add_argument("--postxf", type=str,help="a file listing post transforms (see http://eman2.org/e2tomo_more), or for simple symmetry, <sym>,<cx>,<cy>,<cz> where the coordinates specify the center of a single subunit", default=None)
 	parser.add_argument("--ppid", type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-2)	
 	parser.add_argument("--skip3d", action="store_true", default=False ,help="do not make 3d particles. only generate 2d particles and 3d header. ")
@@ -509,70 +513,117 @@ as well as alignment parameters, so use of tomograms from other software is not
 		else:
 			ctf=[]
 		
-		#### do the actural reconstruction in threads
-		for tid in range(options.threads):
-			ids=list(range(tid, nptcl, options.threads))
-			jobs.append([jsd, ids, imgs, ttparams, pinfo, options, ctf, tltkeep, pmask])
-			
-		thrds=[threading.Thread(target=make3d,args=(i)) for i in jobs]
-		global thrdone
-		thrdone=0
+		#### write one particle returned by a worker. returns 1 if the particle is written
+		def write_ptcl(pid, threed, projs):
+			#### each worker returns the (particle id, 3d subtomogram, list of 2d subtilts)
+			##   write them to disk in main thread
+			if options.append:
+				pid=-1
+
+			#### we append the 2d particles to the end of particle stack file
+			##   only keep the index of 3d particles, and save the indices of 2d particle 
+			##   in the header of the corresponding 3d particle
+			try: pji=EMUtil.get_image_count(options.output2d)
+			except: pji=0
+			pjids=[]
+			for i,pj in enumerate(projs):
+				if options.compressbits<0 : pj.write_image(options.output2d, pji)
+				else: pj.write_compressed(options.output2d,pji,options.compressbits,nooutliers=True)
+				pjids.append(pji)
+				pji+=1
+				
+			threed["class_ptcl_src"]=options.output2d
+			if len(pjids)>1:
+				threed["class_ptcl_idxs"]=pjids
+			elif pid>=0:
+				print("Empty particle exist. Consider use the --append option. Exit.")
+				exit()
+			else:
+				print("Empty particle detected. Skipping particle.")
+				return 0
+
+			if options.compressbits<0: threed.write_image(options.output, pid)
+			else: threed.write_compressed(options.output, pid,options.compressbits,nooutliers=True)
+			return 1
+		
 		ndone=0
 		time0=time.time()
-		for t in thrds:
-			t.start()
+		if options.batch and get_platform()!="Windows":
+			#### particles are sorted by depth so neighboring particles in a chunk share the same defocus bands
+			##   the forked workers inherit the preprocessed tilt series, so it is never pickled
+			global batch_args
+			batch_args=(imgs, ttparams, pinfo, options, ctf, tltkeep, pmask)
+			order=np.lexsort(np.array([ptcl_depth(p) for p in ptclpos]).T[::-1]).tolist()
+			nchunk=max(1,min(options.batchsize, nptcl//options.threads+1))
+			chunks=[order[i:i+nchunk] for i in range(0, nptcl, nchunk)]
+			pool=multiprocessing.get_context("fork").Pool(options.threads)
+			for ret in pool.imap_unordered(make3d_batch, chunks):
+				for pid, threed, projs in ret:
+					ndone+=write_ptcl(pid, threed, projs)
+					if options.verbose>0:
+						sys.stdout.write("\r{}/{} finished.".format(ndone, nptcl))
+						sys.stdout.flush()
+			pool.close()
+			pool.join()
+			batch_args=None
 			
-		while thrdone<len(thrds) or not jsd.empty():
-			while not jsd.empty():
+		else:
+			#### do the actural reconstruction in threads
+			for tid in range(options.threads):
+				ids=list(range(tid, nptcl, options.threads))
+				jobs.append([jsd, ids, imgs, ttparams, pinfo, options, ctf, tltkeep, pmask])
 				
-				#### each worker returns the (particle id, 3d subtomogram, list of 2d subtilts)
-				##   write them to disk in main thread
-				pid, threed, projs=jsd.get()
-				if options.append:
-					pid=-1
-
-				#### we append the 2d particles to the end of particle stack file
-				##   only keep the index of 3d particles, and save the indices of 2d particle 
-				##   in the header of the corresponding 3d particle
-				try: pji=EMUtil.get_image_count(options.output2d)
-				except: pji=0
-				pjids=[]
-				for i,pj in enumerate(projs):
-					if options.compressbits<0 : pj.write_image(options.output2d, pji)
-					else: pj.write_compressed(options.output2d,pji,options.compressbits,nooutliers=True)
-					pjids.append(pji)
-					pji+=1
-					
-				threed["class_ptcl_src"]=options.output2d
-				if len(pjids)>1:
-					threed["class_ptcl_idxs"]=pjids
-				elif pid>=0:
-					print("Empty particle exist. Consider use the --append option. Exit.")
-					exit()
-				else:
-					print("Empty particle detected. Skipping particle.")
-					continue
-
-				if options.compressbits<0: threed.write_image(options.output, pid)
-				else: threed.write_compressed(options.output, pid,options.compressbits,nooutliers=True)
+			thrds=[threading.Thread(target=make3d,args=(i)) for i in jobs]
+			global thrdone
+			thrdone=0
+			for t in thrds:
+				t.start()
 				
-				ndone+=1
-				if options.verbose>0:
-					sys.stdout.write("\r{}/{} finished.".format(ndone, nptcl))
-					sys.stdout.flush()
-			time.sleep(.2)
+			while thrdone<len(thrds) or not jsd.empty():
+				while not jsd.empty():
+					pid, threed, projs=jsd.get()
+					ndone+=write_ptcl(pid, threed, projs)
+					if options.verbose>0:
+						sys.stdout.write("\r{}/{} finished.".format(ndone, nptcl))
+						sys.stdout.flush()
+				time.sleep(.2)
 
-		for t in thrds: t.join()
+			for t in thrds: t.join()
 			
 		print("Done. Particles written to {} ({:.1f} s)".format(options.output, time.time()-time0))
 	
 	
+#### inputs of make3d_batch, set by do_extraction right before the worker processes are forked
+batch_args=None
+#### CTF phase flipping images of each worker process, keyed by (tilt id, defocus band)
+batch_flips={}
+
+#### worker for --batch extraction. reconstructs a chunk of particles in a forked process 
+##   and returns the list of (particle id, 3d subtomogram, list of 2d subtilts)
+def make3d_batch(ids):
+	imgs, ttparams, pinfo, options, ctfinfo, tltkeep, mask=batch_args
+	jsd=queue.Queue(0)
+	if options.dfband>0: flipcache=batch_flips
+	else: flipcache=None
+	make3d(jsd, ids, imgs, ttparams, pinfo, options, ctfinfo, tltkeep, mask, flipcache)
+	ret=[]
+	while not jsd.empty():
+		ret.append(jsd.get())
+	return ret
+
+#### (z, x) of a particle in the tomogram, used to sort particles by depth for --batch
+def ptcl_depth(pos):
+	if type(pos)==type(Transform()):
+		pos=pos.get_trans()
+	return [float(pos[2]), float(pos[0])]
+
 #### the actual worker function to extract 2d particles and reconstruct 3d particle
 ##   jsd: queue object for returning results from parallelism
 ##   imgs: tilt series input
 ##   ids: indices of particles to reconstruct
 ##   pinfo: particle info (coordinates, output name, box size/2, extra header info)
-def make3d(jsd, ids, imgs, ttparams, pinfo, options, ctfinfo=[], tltkeep=[], mask=None):
+##   flipcache: if provided, the CTF phase flipping image is computed once per tilt and defocus band (--dfband) and kept here
+def make3d(jsd, ids, imgs, ttparams, pinfo, options, ctfinfo=[], tltkeep=[], mask=None, flipcache=None):
 	ppos, outname, boxsz, info=pinfo
 	if len(info)!=len(ppos):
 		info=[]
@@ -708,12 +759,26 @@ def make3d(jsd, ids, imgs, ttparams, pinfo, options, ctfinfo=[], tltkeep=[], mas
 			if len(ctfinfo)>0:
 				## phase flipping
 				df=defocus[nid]-dz
+				if flipcache!=None:
+					## round defocus to the band so the flipping image can be shared with other particles
+					band=int(np.round(df/options.dfband))
+					df=band*options.dfband
 				ctf.set_phase(phase[nid]*np.pi/180.)
 				ctf.defocus=df
 				e["ctf"]=ctf
 				fft1=e.do_fft()
-				flipim=fft1.copy()
-				ctf.compute_2d_complex(flipim,Ctf.CtfType.CTF_SIGN)
+				if flipcache==None:
+					flipim=fft1.copy()
+					ctf.compute_2d_complex(flipim,Ctf.CtfType.CTF_SIGN)
+				else:
+					key=(nid, band)
+					if key not in flipcache:
+						## particles come in depth order, so old bands are rarely needed again
+						if len(flipcache)>=len(imgs)*8: flipcache.clear()
+						flipim=fft1.copy()
+						ctf.compute_2d_complex(flipim,Ctf.CtfType.CTF_SIGN)
+						flipcache[key]=flipim
+					flipim=flipcache[key]
 				fft1.mult(flipim)
 				
 				if options.wiener:
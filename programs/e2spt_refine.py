@@ -53,7 +53,8 @@ def main():
 	parser.add_argument("--randphi",action="store_true",help="randomize phi for refine search",default=False)
 	parser.add_argument("--rand180",action="store_true",help="include 180 degree rotation for refine search",default=False)
 	parser.add_argument("--test180",action="store_true",help="Test for improved alignment with 180 degree rotations even during refine alignment",default=False)
-	parser.add_argument("--resume",action="store_true",help="resume from previous run",default=False)
+	parser.add_argument("--resume",action="store_true",help="resume from previous run. Alignment tasks already completed in the interrupted iteration are not rerun.",default=False)
+	parser.add_argument("--retries", type=int,help="number of times a failed alignment task is rerun before giving up. default is 0",default=0)
 	parser.add_argument("--scipy",action="store_true",help="test scipy refinement",default=False)
 	parser.add_argument("--breaksym",action="store_true",help="break symmetry",default=False)
 	parser.add_argument("--breaksymsym", type=str,help="Specify a different symmetry for breaksym.", default=None)
@@ -228,6 +229,11 @@ def main():
 		if options.maskalign!=None:
 			gd+=f" --mask {options.maskalign}" 
 
+		if options.retries>0:
+			gd+=f" --retries {options.retries}"
+		if options.resume and itr==startitr:
+			gd+=" --resume"
+
 		cmd="e2spt_align.py {} {}/alignref.hdf --parallel {} --path {} --iter {} --sym {} --minres {} --maxres {} {}".format(ptcls, options.path,  options.parallel, options.path, itr, options.sym, options.minres, curres*.75, gd)
 		
 		if options.scipy:
@@ -45,6 +45,7 @@ def main():
 
 
 	parser.add_argument("--shrink", type=int,help="binning factor. Default (-1) will downsample the tomograms to ~500px for template matching", default=-1)
+	parser.add_argument("--tilesize", type=int,help="Match the (shrunken) tomogram as overlapping cubic tiles of this size rather than all at once, to limit memory use. Must be larger than the reference box size. Default (0) matches the whole tomogram at once.", default=0)
 	parser.add_argument("--ppid", type=int,help="ppid", default=-2)
 
 	(options, args) = parser.parse_args()
@@ -59,12 +60,6 @@ def main():
 	oris=sym.gen_orientations("eman",{"delta":dt, "phitoo":dt,"inc_mirror":1})
 	print("Testing {} orientations...".format(len(oris)))
 	
-	def do_match(jsd, xfs):
-		for xf in xfs:
-			r=ref.process("xform", {"transform":xf})
-			cf=tomo.calc_ccf(r)
-			jsd.put(cf)
-
 	for filenum,imgname in enumerate(args):
 		
 		print("Locating reference-like particles in {} (File {}/{})".format(imgname,filenum+1,len(args)))
@@ -95,34 +90,12 @@ def main():
 		tomo.process_inplace('threshold.clampminmax.nsigma', {"nsigma":3})
 		
 		
-		nthrds=options.threads
-		rg=np.arange(len(oris))
-		tasks=[oris[i::nthrds] for i in range(nthrds)]
-
-		ccc=tomo.copy()*0-65535
-
-		jsd=queue.Queue(0)
-		thrds=[threading.Thread(target=do_match,args=(jsd, o)) for o in tasks]
-		thrtolaunch=0
-		tsleep=threading.active_count()
-
-		ndone=0
-		for t in thrds:
-			t.start()
-		
-		while threading.active_count()>tsleep or not jsd.empty():
+		best=match_template(tomo, ref, oris, options.threads, options.tilesize)
+		ccc=tomo.copy()
+		ccc.numpy()[...]=best
+		ccc.update()
+		del best
 		
-			while not jsd.empty():
-				cf=jsd.get()
-				ccc.process_inplace("math.max", {"with":cf})
-				ndone+=1
-				sys.stdout.write("\r{}/{} finished.".format(ndone, len(oris)))
-				sys.stdout.flush()
-			
-			time.sleep(.5)
-		print("")
-		
-		ccc.process_inplace("xform.phaseorigin.tocenter")
 		ccc.process_inplace("filter.lowpass.gauss",{"cutoff_abs":.3})
 		ccc.process_inplace("filter.highpass.gauss",{"cutoff_pixels":24})
 		ccc.process_inplace("normalize.edgemean")
@@ -270,6 +243,76 @@ def main():
 
 	E2end(logid)
 	
+def match_tile(tomof, ref, xfs, size, results, prog, thread):
+	"""Correlates tomof, an FFT'd tomogram (or tile) of real-space size (nx,ny,nz), with ref in each orientation in xfs.
+	Keeps a running maximum over orientations, which is appended to results when done. prog[thread] counts completed
+	orientations."""
+	nx,ny,nz=size
+	best=np.zeros((nz,ny,nx),dtype=np.float32)-65535
+	for xf in xfs:
+		r=ref.process("xform", {"transform":xf})
+		# calc_ccf would do the same clip for a real-space reference
+		r.clip_inplace(Region(int((r["nx"]-nx)/2),int((r["ny"]-ny)/2),int((r["nz"]-nz)/2),nx,ny,nz))
+		r.do_fft_inplace()
+		cf=tomof.calc_ccf(r)
+		c=cf.numpy()
+		np.maximum(best,c,out=best)
+		prog[thread]+=1
+	results.append(best)
+
+def match_template(tomo, ref, oris, nthreads=1, tilesize=0):
+	"""Computes the maximum over all orientations (a list of Transforms) of the CCF between tomo and ref. The FFT of the
+	tomogram is computed only once and reused for every orientation. Each thread keeps its own running maximum for a
+	subset of the orientations, and these are merged when the threads finish. If tilesize>0 the tomogram is processed as overlapping cubic tiles of this size
+	instead, sharing a margin of half of the reference box, so no wrapped-around correlation reaches the kept region.
+	Returns ccc as an (nz,ny,nx) numpy array, with the CCF origin at the center (as xform.phaseorigin.tocenter)."""
+	nx,ny,nz=tomo["nx"],tomo["ny"],tomo["nz"]
+	ccc=np.zeros((nz,ny,nx),dtype=np.float32)
+
+	# for each axis, a list of (tile start, kept region start, kept region end) and the tile size
+	halo=max(ref["nx"],ref["ny"],ref["nz"])//2
+	if tilesize>0 and tilesize<=2*halo:
+		raise Exception("--tilesize must be larger than the reference box size")
+	tiles=[]
+	for n in (nx,ny,nz):
+		if tilesize<=0 or n<=tilesize:
+			tiles.append(([(0,0,n)],n))
+		else:
+			step=tilesize-2*halo
+			tiles.append(([(c-halo,c,min(c+step,n)) for c in range(0,n,step)],tilesize))
+
+	ntile=len(tiles[0][0])*len(tiles[1][0])*len(tiles[2][0])
+	(xt,tx),(yt,ty),(zt,tz)=tiles
+	nthreads=max(1,min(nthreads,len(oris)))
+	ndone=0
+	for z0,zc0,zc1 in zt:
+		for y0,yc0,yc1 in yt:
+			for x0,xc0,xc1 in xt:
+				tile=tomo.get_clip(Region(x0,y0,z0,tx,ty,tz))
+				tile.do_fft_inplace()
+
+				results=[]
+				prog=[0]*nthreads
+				thrds=[threading.Thread(target=match_tile,args=(tile, ref, oris[i::nthreads], (tx,ty,tz), results, prog, i)) for i in range(nthreads)]
+				for t in thrds: t.start()
+				while any(t.is_alive() for t in thrds):
+					sys.stdout.write("\r{}/{} finished.".format(ndone*len(oris)+sum(prog), ntile*len(oris)))
+					sys.stdout.flush()
+					time.sleep(.5)
+				for t in thrds: t.join()
+				if len(results)<nthreads: raise Exception("Template matching failed")
+				ndone+=1
+
+				best=results[0]
+				for b in results[1:]: np.maximum(best,b,out=best)
+
+				# move the origin to the center, then keep the region this tile is responsible for
+				best=np.roll(best,(tz//2,ty//2,tx//2),axis=(0,1,2))
+				ccc[zc0:zc1,yc0:yc1,xc0:xc1]=best[zc0-z0:zc1-z0,yc0-y0:yc1-y0,xc0-x0:xc1-x0]
+
+	sys.stdout.write("\r{}/{} finished.\n".format(ntile*len(oris), ntile*len(oris)))
+	return ccc
+
 def run(cmd):
 	print(cmd)
 	launch_childprocess(cmd)
@@ -72,6 +72,7 @@ def main():
 
 	parser.add_argument("--extrapad", action="store_true",help="Use extra padding for tilted reconstruction. slower and cost more memory, but reduce boundary artifacts when the sample is thick", default=False,guitype='boolbox',row=15, col=0, rowspan=1, colspan=1,mode="easy")
 	parser.add_argument("--moretile", action="store_true",help="Sample more tiles during reconstruction. Slower, but reduce boundary artifacts when the sample is thick", default=False,guitype='boolbox',row=15, col=1, rowspan=1, colspan=1,mode="easy")
+	parser.add_argument("--tilestream", action="store_true",help="With --bytile, reconstruct tiles as threads become free and sum them directly into a memory mapped tomogram on disk (in --tmppath or the current folder). Uses much less memory for large tomograms.", default=False)
 
 	parser.add_argument("--rmbeadthr", type=float, help="Density value threshold (of sigma) for removing beads. high contrast objects beyond this value will be removed. default is -1 for not removing. try 10 for removing fiducials", default=-1,guitype='floatbox',row=14, col=1, rowspan=1, colspan=1,mode="easy")
 	
@@ -1524,6 +1525,13 @@ def calc_tltax_rot(imgs, options):
 #### subthread for making tomogram by tiles. similar to make_tomogram, just for small cubes
 def make_tile(args):
 	jsd, imgs, tpm, sz, pad, stepx, stepy, outz,options=args
+	threed=reconstruct_tile(imgs, tpm, sz, pad, outz, options)
+	jsd.put( [stepx, stepy, threed])
+	
+	return
+
+#### reconstruct a single sz x sz x outz cube from the padded clips of the tilt images
+def reconstruct_tile(imgs, tpm, sz, pad, outz, options):
 	recon=Reconstructors.get("fourier", {"sym":'c1',"size":[pad,pad,pad], "mode":options.reconmode})
 	recon.setup()
 
@@ -1564,13 +1572,11 @@ def make_tile(args):
 	threed.clip_inplace(Region((pad-sz)//2, (pad-sz)//2, (pad-outz)//2, sz, sz, outz))
 	threed.process_inplace("filter.lowpass.gauss",{"cutoff_abs":options.filterto})
 	#threed.process_inplace("filter.highpass.gauss",{"cutoff_pixels":2})
-	jsd.put( [stepx, stepy, threed])
-	
-	return
+	return threed
 
 
 #### make tomogram by tiles
-#### this is faster and has less artifacts. but takes a lot of memory (~4x the tomogram)
+#### this is faster and has less artifacts. but takes a lot of memory (~4x the tomogram), unless --tilestream is used
 def make_tomogram_tile(imgs, tltpm, options, errtlt=[], clipz=-1):
 	time0=time.time()
 	num=len(imgs)
@@ -1633,7 +1639,12 @@ def make_tomogram_tile(imgs, tltpm, options, errtlt=[], clipz=-1):
 	
 	
 	#options.moretile=True
-	if options.moretile:
+	if options.tilestream:
+		mem=((pad*pad*pad+sz*sz*outz+len(nrange)*pad*pad)*options.threads*4)
+		print("Streaming tiles into a memory mapped {}x{}x{} tomogram on disk. This will take ~{:.1f} GB of memory...".format(outx, outy, outz, mem/1024**3))
+		if options.moretile: wtcon=1
+		else: wtcon=2.5
+	elif options.moretile:
 		full3d=EMData(outx, outy, outz)
 		mem=(outx*outy*outz*4+pad*pad*pad*options.threads*4)
 		print("This will take {}x{}x{}x4 + {}x{}x{}x{}x4 = {:.1f} GB of memory...".format(outx, outy, outz, pad, pad, pad,options.threads, mem/1024**3))
@@ -1645,17 +1656,38 @@ def make_tomogram_tile(imgs, tltpm, options, errtlt=[], clipz=-1):
 		wtcon=2.5
 	
 	
-	jsd=queue.Queue(0)
-	jobs=[]
 	nstepx=int(outx/step/2)
 	nstepy=int(outy/step/2)
 	
-	if options.ctf!=None:
-		ctf=EMAN2Ctf()
-		ctf.from_dict({
-			"defocus":1.0, "voltage":options.ctf["voltage"], "bfactor":0., "cs":options.ctf["cs"],"ampcont":0, "apix":imgs[0]["apix_x"]})
-		dfs=[]
-		
+	dfs=[]
+	#### clip the region of each tilt covering one tile. 
+	def tile_input(stepx, stepy):
+		tiles=[]
+		for i in range(num):
+			if i in nrange:
+				t=tpm[i]
+				pos=[stepx*step,stepy*step,0]
+				pxf=get_xf_pos(t, pos)
+				img=imgs[i]
+				m=img.get_clip(Region(img["nx"]//2-pad//2+pxf[0],img["ny"]//2-pad//2+pxf[1], pad, pad), fill=0)
+				if options.ctf!=None:
+					ctf=EMAN2Ctf()
+					ctf.from_dict({
+						"defocus":1.0, "voltage":options.ctf["voltage"], "bfactor":0., "cs":options.ctf["cs"],"ampcont":0, "apix":imgs[0]["apix_x"]})
+					rot=Transform({"type":"xyz","xtilt":float(t[4]),"ytilt":float(t[3])})
+					p1=rot.transform(pos)
+					pz=p1[2]*img["apix_x"]/10000.
+					ctf.defocus=options.ctf["defocus"][i]-pz
+					ctf.set_phase(options.ctf["phase"][i]*np.pi/180.)
+					dfs.append(ctf.defocus)
+					m["ctf"]=ctf
+					
+				tiles.append(m)
+			else:
+				tiles.append(EMData(1,1))
+		return tiles
+	
+	tilepos=[]
 	for stepx in range(-nstepx,nstepx+1):
 		#### shift y by half a tile
 		if options.moretile:
@@ -1663,37 +1695,7 @@ def make_tomogram_tile(imgs, tltpm, options, errtlt=[], clipz=-1):
 		else: 
 			yrange=range(-nstepy+stepx%2,nstepy+1,2)
 		for stepy in yrange:
-			tiles=[]
-			for i in range(num):
-				if i in nrange:
-					t=tpm[i]
-					pos=[stepx*step,stepy*step,0]
-					pxf=get_xf_pos(t, pos)
-					img=imgs[i]
-					m=img.get_clip(Region(img["nx"]//2-pad//2+pxf[0],img["ny"]//2-pad//2+pxf[1], pad, pad), fill=0)
-					if options.ctf!=None:
-						rot=Transform({"type":"xyz","xtilt":float(t[4]),"ytilt":float(t[3])})
-						p1=rot.transform(pos)
-						pz=p1[2]*img["apix_x"]/10000.
-						ctf.defocus=options.ctf["defocus"][i]-pz
-						ctf.set_phase(options.ctf["phase"][i]*np.pi/180.)
-						dfs.append(ctf.defocus)
-						m["ctf"]=ctf
-						
-					tiles.append(m)
-				else:
-					tiles.append(EMData(1,1))
-
-			jobs.append((jsd, tiles, tpm, sz, pad, stepx, stepy, outz, options))
-	
-	if options.ctf!=None:
-		print("Doing Ctf correction. Average defocus {:.2f}".format(np.mean(dfs)))
-		
-		
-	thrds=[threading.Thread(target=make_tile,args=([i])) for i in jobs]
-	print("now start threads...")
-	thrtolaunch=0
-	tsleep=threading.active_count()
+			tilepos.append((stepx, stepy))
 	
 	#### non-round fall off. this is mathematically correct but seem to have grid artifacts
 	#f=np.zeros((sz,sz))
@@ -1701,39 +1703,54 @@ def make_tomogram_tile(imgs, tltpm, options, errtlt=[], clipz=-1):
 	#f=.25-(x**2+y**2)/2 + ((abs(x)-0.5)**2+(abs(y)-0.5)**2)/2
 	f=wtcon+np.exp(-(x**2+y**2)/0.1) - np.exp(-((abs(x)-0.5)**2+(abs(y)-0.5)**2)/0.1)
 	f3=np.repeat(f[None, :,:], outz, axis=0)
-	msk=from_numpy(f3).copy()
 	#####
-
 	
-	while thrtolaunch<len(thrds) or threading.active_count()>tsleep or not jsd.empty():
-		if thrtolaunch<len(thrds) :
-			while (threading.active_count()==options.threads ) : time.sleep(.1)
-			thrds[thrtolaunch].start()
-			thrtolaunch+=1
-		else: time.sleep(.1)
-		
-		if not jsd.empty():
-			stepx, stepy, threed=jsd.get()
-			#threed["pos"]=[stepx, stepy]
-			#threed.write_image("alltiles.hdf", -1)
-			threed.mult(msk)
-			#### insert the cubes to corresponding tomograms
-			if options.moretile:
-				full3d.insert_scaled_sum(
-					threed,(int(stepx*step+outx//2),int(stepy*step+outy//2), outz//2))
-			else:
-				full3d[stepx%2].insert_clip(
-				threed,
-				(int(stepx*step+outx//2-sz//2),
-				int(stepy*step+outy//2-sz//2), 
-				outz//2-threed["nz"]//2))
-				
-				
-	for t in thrds: t.join()
-	
-	if not options.moretile:
-		full3d=full3d[0]+full3d[1]
-	full3d.process_inplace("normalize")
+	if options.tilestream:
+		full3d=stream_tiles(tilepos, tile_input, tpm, sz, pad, step, outx, outy, outz, f3, options)
+		if options.ctf!=None:
+			print("Doing Ctf correction. Average defocus {:.2f}".format(np.mean(dfs)))
+	else:
+		jsd=queue.Queue(0)
+		jobs=[(jsd, tile_input(stepx, stepy), tpm, sz, pad, stepx, stepy, outz, options) for stepx, stepy in tilepos]
+		
+		if options.ctf!=None:
+			print("Doing Ctf correction. Average defocus {:.2f}".format(np.mean(dfs)))
+			
+		msk=from_numpy(f3).copy()
+		thrds=[threading.Thread(target=make_tile,args=([i])) for i in jobs]
+		print("now start threads...")
+		thrtolaunch=0
+		tsleep=threading.active_count()
+		
+		while thrtolaunch<len(thrds) or threading.active_count()>tsleep or not jsd.empty():
+			if thrtolaunch<len(thrds) :
+				while (threading.active_count()==options.threads ) : time.sleep(.1)
+				thrds[thrtolaunch].start()
+				thrtolaunch+=1
+			else: time.sleep(.1)
+			
+			if not jsd.empty():
+				stepx, stepy, threed=jsd.get()
+				#threed["pos"]=[stepx, stepy]
+				#threed.write_image("alltiles.hdf", -1)
+				threed.mult(msk)
+				#### insert the cubes to corresponding tomograms
+				if options.moretile:
+					full3d.insert_scaled_sum(
+						threed,(int(stepx*step+outx//2),int(stepy*step+outy//2), outz//2))
+				else:
+					full3d[stepx%2].insert_clip(
+					threed,
+					(int(stepx*step+outx//2-sz//2),
+					int(stepy*step+outy//2-sz//2), 
+					outz//2-threed["nz"]//2))
+					
+					
+		for t in thrds: t.join()
+		
+		if not options.moretile:
+			full3d=full3d[0]+full3d[1]
+		full3d.process_inplace("normalize")
 	
 	#### skip the tomogram positioning step because there is some contrast difference at the boundary that sometimes breaks the algorithm...
 	full3d["zshift"]=0
@@ -1746,6 +1763,74 @@ def make_tomogram_tile(imgs, tltpm, options, errtlt=[], clipz=-1):
 	print("Reconstruction done ({:.1f} s). Now writting tomogram to disk...".format(time.time()-time0))
 	return full3d
 
+#### memory mapped volumes returned by stream_tiles. kept here so the mapping outlives the EMData pointing to it
+tomo_mmaps=[]
+
+#### streaming tile loop for make_tomogram_tile. each worker clips and reconstructs one tile at a time and adds it 
+#### directly to a memory mapped tomogram on disk, so only the tiles in flight are kept in memory
+def stream_tiles(tilepos, tile_input, tpm, sz, pad, step, outx, outy, outz, wt, options):
+	if options.tmppath: path=options.tmppath
+	else: path="."
+	fname=os.path.join(path, "tomo_tiles_{}.tmp".format(os.getpid()))
+	vol=np.memmap(fname, dtype=np.float32, mode="w+", shape=(outz, outy, outx))
+	#### the space on disk is freed once the mapping is closed
+	try: os.unlink(fname)
+	except: pass
+	
+	todo=queue.Queue(0)
+	for p in tilepos: todo.put(p)
+	lock=threading.Lock()
+	err=[]
+	ndone=[0]
+	
+	def worker():
+		while len(err)==0:
+			try: stepx, stepy=todo.get_nowait()
+			except queue.Empty: return
+			try:
+				threed=reconstruct_tile(tile_input(stepx, stepy), tpm, sz, pad, outz, options)
+				t=threed.numpy()*wt
+			except Exception as e:
+				err.append(e)
+				return
+			
+			#### same position as insert_clip/insert_scaled_sum in make_tomogram_tile, cropped to the tomogram
+			x0=int(stepx*step+outx//2-sz//2)
+			y0=int(stepy*step+outy//2-sz//2)
+			xa, xb=max(x0, 0), min(x0+sz, outx)
+			ya, yb=max(y0, 0), min(y0+sz, outy)
+			with lock:
+				if xb>xa and yb>ya:
+					vol[:, ya:yb, xa:xb]+=t[:, ya-y0:yb-y0, xa-x0:xb-x0]
+				ndone[0]+=1
+				if options.verbose>0:
+					print("  tile {}/{} done".format(ndone[0], len(tilepos)))
+	
+	print("now start threads...")
+	thrds=[threading.Thread(target=worker) for i in range(max(1,min(options.threads, len(tilepos))))]
+	for t in thrds: t.start()
+	for t in thrds: t.join()
+	if len(err)>0: raise err[0]
+	
+	#### normalize slice by slice so the whole tomogram never needs to be in memory
+	s=s2=0.
+	for z in range(outz):
+		v=vol[z].astype(np.float64)
+		s+=np.sum(v)
+		s2+=np.sum(v*v)
+	n=float(outx*outy*outz)
+	mean=s/n
+	sig=np.sqrt(max(s2/n-mean**2, 0))
+	if sig==0: sig=1.
+	for z in range(outz):
+		vol[z]=(vol[z]-mean)/sig
+	
+	vol=np.asarray(vol)
+	emn=EMNumPy()
+	full3d=emn.register_numpy_to_emdata(vol)
+	tomo_mmaps.append((emn, vol))
+	return full3d
+
 #### reconstruct tomogram...
 def make_tomogram(imgs, tltpm, options, outname=None, padr=1.2,  errtlt=[], clipz=-1, doclip=True):
 	num=len(imgs)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2000-2006 Baylor College of Medicine
+#
+# This software is issued under a joint BSD/GNU license. You may use the
+# source code in this file under either license. However, note that the
+# complete EMAN2 and SPARX software packages have some GPL dependencies,
+# so you are responsible for compliance with the licenses of these packages
+# if you opt to use BSD licensing. The warranty disclaimer below holds
+# in either instance.
+#
+# This complete copyright notice must be included in any revised version of the
+# source code. Additional authorship citations may be added, but existing
+# author citations must be preserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  2111-1307 USA
+#
+#
+
+from EMAN3 import *
+from EMAN3tensor import *
+import unittest
+import testlib
+import numpy as np
+from optparse import OptionParser
+
+IS_TEST_EXCEPTION = False
+
+class TestEMStackMemmap(unittest.TestCase):
+    """this is the unit test for memory mapped EMStack2D and StackCache"""
+
+    def setUp(self):
+        self.npyfile = "test_eman3tensor.npy"
+        self.imgfile = "test_eman3tensor.hdf"
+        self.cachefile = "test_eman3tensor.cache"
+        self.ary = np.random.normal(size=(10,16,16)).astype(np.float32)
+
+    def tearDown(self):
+        testlib.safe_unlink(self.npyfile)
+        testlib.safe_unlink(self.imgfile)
+        testlib.safe_unlink(self.cachefile)
+
+    def test_to_memmap(self):
+        """test EMStack2D.to_memmap ........................."""
+        stack = EMStack2D(self.ary.copy())
+        self.assertFalse(stack.is_memmap)
+        stack.to_memmap(self.npyfile, chunk=3)
+        self.assertTrue(stack.is_memmap)
+        self.assertTrue(np.array_equal(self.ary, stack.numpy))
+
+        # reopening the .npy file maps it copy-on-write, so changes never reach the file
+        stack = EMStack2D(self.npyfile)
+        self.assertTrue(stack.is_memmap)
+        stack.numpy[0] += 1.0
+        self.assertTrue(np.array_equal(self.ary, np.load(self.npyfile)))
+
+    def test_chunks(self):
+        """test EMStack2D.chunks ............................"""
+        imgs = []
+        for i in range(10):
+            im = from_numpy(self.ary[i])
+            im["xform.projection"] = Transform({"type":"eman", "az":i*10.0, "alt":20.0, "phi":0.0, "tx":float(i)})
+            imgs.append(im)
+        stack = EMStack2D(imgs)
+        stack.to_memmap(self.npyfile)		# orientations must survive the change of representation
+        chunks = list(stack.chunks(4))
+        self.assertEqual([4,4,2], [len(c) for c in chunks])
+        for j, c in enumerate(chunks):
+            orts, tytx = c.orientations
+            self.assertEqual(len(c), len(tytx))
+            for k in range(len(c)):
+                self.assertAlmostEqual(float(j*4+k), float(tytx[k][1]), 4)
+                self.assertTrue(np.allclose(self.ary[j*4+k], c.numpy[k]))
+
+    def test_images_to_memmap(self):
+        """test images_to_memmap ............................"""
+        for i in range(10): from_numpy(self.ary[i]).write_image(self.imgfile, i)
+        ary = images_to_memmap(self.imgfile, self.npyfile, chunk=3)
+        self.assertEqual((10,16,16), ary.shape)
+        self.assertTrue(np.allclose(self.ary, ary))
+        self.assertTrue(np.allclose(self.ary, EMStack2D(self.npyfile).numpy))
+
+    def test_stackcache(self):
+        """test StackCache write/read ......................."""
+        cache = StackCache(self.cachefile, 10)
+        self.assertRaises(Exception, cache.read, [0])
+        cache.write(EMStack2D(self.ary[:6]), 0)
+        cache.write(EMStack2D(self.ary[6:]), 6)
+        stack, orts, tytx = cache.read([7,2,2])
+        self.assertTrue(np.array_equal(self.ary[[7,2,2]], stack.numpy))
+        self.assertRaises(Exception, cache.write, EMStack2D(self.ary[:2,:8,:8]), 0)
+
+def test_main():
+    p = OptionParser()
+    p.add_option('--t', action='store_true', help='test exception', default=False )
+    global IS_TEST_EXCEPTION
+    opt, args = p.parse_args()
+    if opt.t:
+        IS_TEST_EXCEPTION = True
+    Log.logger().set_level(-1)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestEMStackMemmap)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+    test_main()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2000-2006 Baylor College of Medicine
+#
+# This software is issued under a joint BSD/GNU license. You may use the
+# source code in this file under either license. However, note that the
+# complete EMAN2 and SPARX software packages have some GPL dependencies,
+# so you are responsible for compliance with the licenses of these packages
+# if you opt to use BSD licensing. The warranty disclaimer below holds
+# in either instance.
+#
+# This complete copyright notice must be included in any revised version of the
+# source code. Additional authorship citations may be added, but existing
+# author citations must be preserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  2111-1307 USA
+#
+#
+
+
+from EMAN2 import *
+from EMAN2PAR import EMTaskCustomer,EMTaskJournal,EMSharedImage,shared_get
+from EMAN2jsondb import JSTask
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+IS_TEST_EXCEPTION = False
+
+# Trivial tasks. Each execution appends a line to data["log"] (when given), so the tests can count
+# how many times tasks really ran, across processes.
+
+def log_run(data):
+    if "log" in data:
+        with open(data["log"],"a") as out: out.write("{}\n".format(data.get("id",0)))
+
+class TaskDouble(JSTask):
+    """doubles each of data["items"], sleeping data["delay"] seconds per item (longer for data["slow"])"""
+    def __init__(self,data,options=None):
+        JSTask.__init__(self,"test_double",data,options,"")
+
+    def execute(self,callback):
+        log_run(self.data)
+        for i in self.data["items"]:
+            time.sleep(self.data.get("slow",{}).get(i,self.data.get("delay",0.0)))
+        return [i*2 for i in self.data["items"]]
+
+class TaskScale(JSTask):
+    """returns data["id"]*options["scale"], for the journal tests"""
+    def __init__(self,data,options):
+        JSTask.__init__(self,"test_scale",data,options,"")
+
+    def execute(self,callback):
+        with open(self.options["log"],"a") as out: out.write("{}\n".format(self.data["id"]))
+        return self.data["id"]*self.options["scale"]
+
+class TaskFailOnce(JSTask):
+    """fails the first time it is run, by raising or by killing the process running it"""
+    def __init__(self,data):
+        JSTask.__init__(self,"test_failonce",data,None,"")
+
+    def execute(self,callback):
+        if not os.path.exists(self.data["flag"]):
+            open(self.data["flag"],"w").close()
+            if self.data["exit"] : os._exit(1)
+            raise Exception("test failure")
+        return self.data["value"]
+
+class TaskShared(JSTask):
+    """returns the pixel sum of a shared input image, and a new shared image with twice its values"""
+    def __init__(self,data):
+        JSTask.__init__(self,"test_shared",data,None,"")
+
+    def execute(self,callback):
+        img=shared_get(self.data["img"],True)
+        ret=EMSharedImage(img*2.0)
+        return (float(img.numpy().sum()),ret)
+
+def nlines(fsp):
+    try: return len(open(fsp).readlines())
+    except IOError: return 0
+
+def consume(fn,timeout=60):
+    """runs fn in a thread, returning its result, or None if it didn't finish in time"""
+    ret=[]
+    thr=threading.Thread(target=lambda: ret.append(fn()))
+    thr.daemon=True
+    thr.start()
+    thr.join(timeout)
+    if len(ret)==0 : return None
+    return ret[0]
+
+class TestTaskCustomer(object):
+    """tests common to all of the local task handlers, mixed into one TestCase per handler"""
+    target = None
+    module = ""
+    retries = 0
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp,"log.txt")
+        self.etc = EMTaskCustomer(self.target,self.module,self.retries)
+
+    def tearDown(self):
+        self.etc.handler.stop()
+        shutil.rmtree(self.tmp,True)
+
+    def test_as_completed(self):
+        """test as_completed ................................"""
+        tids = self.etc.send_tasks([TaskDouble({"items":[i],"delay":0.05*(5-i),"log":self.log}) for i in range(5)])
+        got = {}
+        for tid,task,results in self.etc.as_completed(tids):
+            got[tid] = results
+        self.assertEqual(sorted(got.keys()), sorted(tids))
+        for i,tid in enumerate(tids):
+            self.assertEqual([i*2], got[tid])
+        self.assertEqual(5, nlines(self.log))
+
+    def test_map_items(self):
+        """test map_items reports each item exactly once ...."""
+        items = list(range(40))
+        data = {"delay":0.01,"slow":{0:1.0}}		# a straggler, so idle workers steal its chunk
+        def run():
+            seen = []
+            for chunk,results in self.etc.map_items(items,lambda c: TaskDouble(dict(data,items=c)),minchunk=1):
+                self.assertEqual([i*2 for i in chunk], results)
+                seen.extend(chunk)
+            return seen
+        seen = consume(run)
+        self.assertTrue(seen is not None, "map_items did not complete")
+        self.assertEqual(items, sorted(seen))
+
+    def test_map_items_interleaved(self):
+        """test interleaved map_items submission ............"""
+        # each generator only submits its later chunks once the caller asks for more, so the handler
+        # must accept new tasks at any time, including after everything submitted so far has finished
+        def run():
+            gens = [self.etc.map_items(list(range(k*100,k*100+12)),lambda c: TaskDouble({"items":c}),minchunk=1) for k in range(2)]
+            seen = []
+            pause = 1.5
+            while len(gens)>0:
+                for g in list(gens):
+                    try: chunk,results = next(g)
+                    except StopIteration:
+                        gens.remove(g)
+                        continue
+                    seen.extend(chunk)
+                    time.sleep(pause)
+                    pause = 0.1
+            return seen
+        seen = consume(run)
+        self.assertTrue(seen is not None, "interleaved map_items did not complete")
+        self.assertEqual(list(range(12))+list(range(100,112)), sorted(seen))
+
+class TestPool(TestTaskCustomer,unittest.TestCase):
+    """this is the unit test for EMTaskCustomer with pool:N"""
+    target = "pool:3"
+
+    def failonce(self,exit,retries):
+        self.etc.handler.stop()
+        self.etc = EMTaskCustomer(self.target,self.module,retries)
+        tid = self.etc.send_task(TaskFailOnce({"flag":os.path.join(self.tmp,"flag"),"exit":exit,"value":17}))
+        return [results for tid,task,results in self.etc.as_completed([tid])]
+
+    def test_raise_retry(self):
+        """test a raising task with retries=1 ..............."""
+        self.assertEqual([17], self.failonce(False,1))
+
+    def test_raise_fail(self):
+        """test a raising task with retries=0 ..............."""
+        self.assertRaises(Exception, self.failonce, False, 0)
+
+    def test_worker_exit_retry(self):
+        """test a worker which exits, with retries=1 ........"""
+        self.assertEqual([17], self.failonce(True,1))
+        # the dead worker was replaced
+        self.assertTrue(all(w is not None and w[0].is_alive() for w in self.etc.handler.workers))
+
+    def test_worker_exit_fail(self):
+        """test a worker which exits, with retries=0 ........"""
+        self.assertRaises(Exception, self.failonce, True, 0)
+
+    def test_cancel_tasks(self):
+        """test cancel_tasks ................................"""
+        self.etc.handler.stop()
+        self.etc = EMTaskCustomer("pool:1")
+        tids = self.etc.send_tasks([TaskDouble({"items":[i],"delay":0.3,"id":i,"log":self.log}) for i in range(4)])
+        self.etc.cancel_tasks(tids[1:])
+        tid = self.etc.send_task(TaskDouble({"items":[9],"id":9,"log":self.log}))
+        got = dict([(t,r) for t,task,r in self.etc.as_completed([tids[0],tid])])
+        self.assertEqual({tids[0]:[0],tid:[18]}, got)
+        # the cancelled tasks were still queued, so they never ran
+        self.assertEqual(["0","9"], sorted(open(self.log).read().split()))
+        self.assertEqual([], self.etc.abandoned)
+
+    def test_journal(self):
+        """test EMTaskJournal resume and invalidation ......."""
+        jpath = os.path.join(self.tmp,"journal")
+        infile = os.path.join(self.tmp,"input.txt")
+        with open(infile,"w") as out: out.write("1")
+
+        def run(scale,resume=True):
+            etc = EMTaskCustomer(self.target,journal=EMTaskJournal(jpath,resume,ignore=("log",)))
+            try:
+                tids = etc.send_tasks([TaskScale({"id":i,"input":infile},{"scale":scale,"log":self.log}) for i in range(4)])
+                return sorted([r for t,task,r in etc.as_completed(tids)])
+            finally: etc.handler.stop()
+
+        self.assertEqual([0,2,4,6], run(2))
+        self.assertEqual(4, nlines(self.log))
+        # a rerun finds every result in the journal
+        self.assertEqual([0,2,4,6], run(2))
+        self.assertEqual(4, nlines(self.log))
+        # a changed option invalidates the journaled results
+        self.assertEqual([0,3,6,9], run(3))
+        self.assertEqual(8, nlines(self.log))
+        # as does a change to a file named by the task
+        time.sleep(0.01)
+        with open(infile,"w") as out: out.write("22")
+        self.assertEqual([0,3,6,9], run(3))
+        self.assertEqual(12, nlines(self.log))
+        # and resume=False discards the journal
+        self.assertEqual([0,3,6,9], run(3,False))
+        self.assertEqual(16, nlines(self.log))
+
+    def test_shared_image(self):
+        """test EMSharedImage through worker processes ......"""
+        img = test_image(0,(32,32))
+        shm = EMSharedImage(img)
+        tid = self.etc.send_task(TaskShared({"img":shm}))
+        for t,task,(total,ret) in self.etc.as_completed([tid]):
+            self.assertAlmostEqual(float(img.numpy().sum()), total, 2)
+            # the block created by the worker outlives it
+            out = ret.get(True)
+            self.assertAlmostEqual(2.0*total, float(out.numpy().sum()), 2)
+            self.assertEqual(img["nx"], out["nx"])
+            ret.unlink()
+        shm.unlink()
+
+class TestThreadSM(TestTaskCustomer,unittest.TestCase):
+    """this is the unit test for EMTaskCustomer with thread_sm:N"""
+    target = "thread_sm:3"
+
+    def test_raise_retry(self):
+        """test a raising task with retries=1 ..............."""
+        self.etc.handler.stop()
+        self.etc = EMTaskCustomer(self.target,retries=1)
+        tid = self.etc.send_task(TaskFailOnce({"flag":os.path.join(self.tmp,"flag"),"exit":False,"value":17}))
+        self.assertEqual([17], [r for t,task,r in self.etc.as_completed([tid])])
+
+    def test_raise_fail(self):
+        """test a raising task with retries=0 ..............."""
+        tid = self.etc.send_task(TaskFailOnce({"flag":os.path.join(self.tmp,"flag"),"exit":False,"value":17}))
+        self.assertRaises(Exception, list, self.etc.as_completed([tid]))
+
+    def test_get_results(self):
+        """test get_results returns the task ................"""
+        task = TaskDouble({"items":[3]})
+        tid = self.etc.send_task(task)
+        for t,rtask,results in self.etc.as_completed([tid]):
+            self.assertTrue(rtask is task)
+            self.assertEqual([6], results)
+
+    def test_cancel_tasks(self):
+        """test cancel_tasks ................................"""
+        tids = self.etc.send_tasks([TaskDouble({"items":[i],"delay":0.2}) for i in range(4)])
+        self.etc.cancel_tasks(tids[1:])
+        got = [r for t,task,r in self.etc.as_completed(tids[:1])]
+        self.assertEqual([[0]], got)
+        # tasks which can't be stopped are collected once they finish
+        self.etc.wait_tasks(tids[1:],5.0)
+        time.sleep(0.5)
+        self.etc.collect_abandoned()
+        self.assertEqual([], self.etc.abandoned)
+
+    def test_shared_image(self):
+        """test EMSharedImage in threads ...................."""
+        img = test_image(0,(32,32))
+        shm = EMSharedImage(img)
+        tid = self.etc.send_task(TaskShared({"img":shm}))
+        for t,task,(total,ret) in self.etc.as_completed([tid]):
+            self.assertAlmostEqual(float(img.numpy().sum()), total, 2)
+            self.assertAlmostEqual(2.0*total, float(ret.get(True).numpy().sum()), 2)
+            ret.unlink()
+        shm.unlink()
+
+class TestThread(TestTaskCustomer,unittest.TestCase):
+    """this is the unit test for EMTaskCustomer with thread:N, which runs each task in e2parallel.py"""
+    target = "thread:3"
+    module = "test_emanpar.TaskDouble"
+
+    def setUp(self):
+        # the tasks are unpickled in a separate e2parallel.py, which needs to find this file
+        here = os.path.dirname(os.path.abspath(__file__))
+        path = os.environ.get("PYTHONPATH","")
+        if here not in path.split(os.pathsep):
+            os.environ["PYTHONPATH"] = here+os.pathsep+path if path else here
+        TestTaskCustomer.setUp(self)
+
+def test_main():
+    p = OptionParser()
+    p.add_option('--t', action='store_true', help='test exception', default=False )
+    global IS_TEST_EXCEPTION
+    opt, args = p.parse_args()
+    if opt.t:
+        IS_TEST_EXCEPTION = True
+    Log.logger().set_level(-1)
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestPool)
+    unittest.TextTestRunner(verbosity=2).run(suite1)
+
+    suite2 = unittest.TestLoader().loadTestsFromTestCase(TestThreadSM)
+    unittest.TextTestRunner(verbosity=2).run(suite2)
+
+    suite3 = unittest.TestLoader().loadTestsFromTestCase(TestThread)
+    unittest.TextTestRunner(verbosity=2).run(suite3)
+
+if __name__ == '__main__':
+    test_main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2000-2006 Baylor College of Medicine
+#
+# This software is issued under a joint BSD/GNU license. You may use the
+# source code in this file under either license. However, note that the
+# complete EMAN2 and SPARX software packages have some GPL dependencies,
+# so you are responsible for compliance with the licenses of these packages
+# if you opt to use BSD licensing. The warranty disclaimer below holds
+# in either instance.
+#
+# This complete copyright notice must be included in any revised version of the
+# source code. Additional authorship citations may be added, but existing
+# author citations must be preserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  2111-1307 USA
+#
+#
+
+
+from eman2_gui.emimagecache import EMPrefetchCache
+import unittest
+import threading
+import time
+import gc
+from optparse import OptionParser
+
+IS_TEST_EXCEPTION = False
+
+class FakeImage(object):
+    """stands in for an EMData in the cache tests, so no display or image files are needed"""
+    def __init__(self, idx, nbytes=1000):
+        self.idx = idx
+        self.nbytes = nbytes
+
+def wait_for(cond, timeout=5.0):
+    t0 = time.time()
+    while not cond():
+        if time.time()-t0 > timeout: return False
+        time.sleep(0.01)
+    return True
+
+class TestPrefetchCache(unittest.TestCase):
+    """this is the unit test for the EMPrefetchCache used by the image matrix viewer"""
+
+    def setUp(self):
+        self.loaded = []
+        self.lock = threading.Lock()
+
+    def loader(self, idx):
+        with self.lock: self.loaded.append(idx)
+        return FakeImage(idx)
+
+    def make_cache(self, **kwargs):
+        cache = EMPrefetchCache(1000, self.loader, sizefn=lambda im:im.nbytes, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_get(self):
+        """test EMPrefetchCache.get ........................."""
+        cache = self.make_cache(max_bytes=100000, window=0)
+        self.assertEqual(5, cache.get(5).idx)
+        self.assertTrue(cache.get(5) is cache.get(5))
+        self.assertEqual(1, self.loaded.count(5))
+
+    def test_byte_budget(self):
+        """test eviction by memory budget ..................."""
+        cache = self.make_cache(max_bytes=10000, window=0)
+        cache.set_visible(0, 1)
+        for i in range(50): cache.get(i)
+        self.assertTrue(cache.nbytes <= 10000)
+        self.assertTrue(0 in cache and 1 in cache)		# visible images are never evicted
+        self.assertTrue(49 in cache and 20 not in cache)
+
+    def test_prefetch_direction(self):
+        """test read ahead in the scroll direction .........."""
+        cache = self.make_cache(max_bytes=1000000, window=20)
+        cache.set_visible(100, 109)
+        self.assertTrue(wait_for(lambda: 129 in cache))
+        self.assertTrue(all(i in cache for i in range(100, 130)))
+        self.assertFalse(140 in cache)
+
+        cache.set_visible(50, 59)		# scrolling backwards
+        self.assertTrue(wait_for(lambda: 30 in cache))
+        self.assertTrue(cache.check_changed())
+        self.assertFalse(cache.check_changed())
+
+    def test_thumbnails(self):
+        """test thumbnails kept for images over the budget .."""
+        cache = EMPrefetchCache(100, self.loader, max_bytes=6500, window=10, thumb_shrink=2,
+            thumbnailer=lambda im, s: FakeImage(im.idx, im.nbytes//(s*s)), sizefn=lambda im:im.nbytes)
+        self.addCleanup(cache.close)
+        cache.set_visible(0, 3)
+        self.assertTrue(wait_for(lambda: (7, 2) in cache.cache))
+        time.sleep(0.1)
+        # full images while they fit, then thumbnails made from the same read, until the budget is full
+        self.assertTrue(all(i in cache for i in range(6)))
+        self.assertTrue((6, 2) in cache.cache and 6 not in cache and 7 not in cache)
+        self.assertFalse((8, 2) in cache.cache)
+        self.assertEqual(list(range(8)), sorted(self.loaded))
+        img, shrink = cache.get_display(6)
+        self.assertEqual((6, 2, 250), (img.idx, shrink, img.nbytes))
+
+        # once visible, the full image is read again
+        cache.set_visible(6, 9)
+        self.assertTrue(wait_for(lambda: 6 in cache))
+        img, shrink = cache.get_display(6)
+        self.assertEqual((6, 1, 1000), (img.idx, shrink, img.nbytes))
+        self.assertFalse((6, 2) in cache.cache)
+
+    def test_clear_discards_stale(self):
+        """test images read before clear() are discarded ...."""
+        started = threading.Event()
+        release = threading.Event()
+        version = [1]
+        def slowloader(idx):
+            v = version[0]
+            if idx == 5 and v == 1:
+                started.set()
+                release.wait()
+            img = FakeImage(idx)
+            img.version = v
+            return img
+        cache = EMPrefetchCache(10, slowloader, max_bytes=1000000, window=0, sizefn=lambda im:im.nbytes)
+        self.addCleanup(cache.close)
+        self.addCleanup(release.set)
+        cache.set_visible(0, 9)
+        self.assertTrue(started.wait(5))
+        cache.clear()
+        version[0] = 2
+        release.set()
+        self.assertTrue(wait_for(lambda: 5 in cache and 9 in cache))
+        self.assertEqual(2, cache.peek(5).version)
+
+    def test_del(self):
+        """test an abandoned cache stops its thread ........."""
+        cache = EMPrefetchCache(100, self.loader, max_bytes=1000000, window=10, sizefn=lambda im:im.nbytes)
+        cache.set_visible(0, 9)
+        self.assertTrue(wait_for(lambda: 19 in cache))
+        thread = cache.thread
+        del cache
+        gc.collect()
+        self.assertTrue(wait_for(lambda: not thread.is_alive()))
+
+def test_main():
+    p = OptionParser()
+    p.add_option('--t', action='store_true', help='test exception', default=False )
+    global IS_TEST_EXCEPTION
+    opt, args = p.parse_args()
+    if opt.t:
+        IS_TEST_EXCEPTION = True
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestPrefetchCache)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+    test_main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2000-2006 Baylor College of Medicine
+#
+# This software is issued under a joint BSD/GNU license. You may use the
+# source code in this file under either license. However, note that the
+# complete EMAN2 and SPARX software packages have some GPL dependencies,
+# so you are responsible for compliance with the licenses of these packages
+# if you opt to use BSD licensing. The warranty disclaimer below holds
+# in either instance.
+#
+# This complete copyright notice must be included in any revised version of the
+# source code. Additional authorship citations may be added, but existing
+# author citations must be preserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  2111-1307 USA
+#
+#
+
+from EMAN2 import *
+import unittest
+import testlib
+import time
+from optparse import OptionParser
+
+IS_TEST_EXCEPTION = False
+
+class TestLSXFile(unittest.TestCase):
+    """this is the unit test for the LSXFile class"""
+
+    def setUp(self):
+        self.lstfile = "test_lsx.lst"
+        testlib.safe_unlink(self.lstfile)
+        self.params = [{"src":"ptcls.hdf", "idx":i, "score":-i*0.5, "class":i%2} for i in range(100)]
+
+    def tearDown(self):
+        testlib.safe_unlink(self.lstfile)
+
+    def test_save_load(self):
+        """test save_lst_params/load_lst_params ............."""
+        save_lst_params(self.params, self.lstfile)
+        self.assertEqual(self.params, load_lst_params(self.lstfile))
+        self.assertEqual(self.params[10:20], load_lst_params(self.lstfile, range(10,20)))
+
+    def test_size_from_file(self):
+        """test record count from file size ................."""
+        save_lst_params(self.params, self.lstfile)
+        lsx = LSXFile(self.lstfile, True)
+        self.assertEqual(100, lsx.n)
+        lsx.write(-1, 5, "other.hdf", {"score":1.0})
+        lsx.write(3, 7, "other.hdf", {"a_much_longer_key_forcing_a_rewrite":12345678})
+        lsx = None
+        lsx = LSXFile(self.lstfile, True)
+        self.assertEqual(101, lsx.n)
+        self.assertEqual([7, "other.hdf", {"a_much_longer_key_forcing_a_rewrite":12345678}], lsx.read(3))
+
+    def test_cached(self):
+        """test LSXFile.cached .............................."""
+        save_lst_params(self.params, self.lstfile)
+        lsx = LSXFile.cached(self.lstfile)
+        self.assertTrue(lsx is LSXFile.cached(self.lstfile))
+        self.assertEqual([5, "ptcls.hdf", {"score":-2.5, "class":1}], lsx.read(5))
+
+        # modifying the file must invalidate the cached object
+        time.sleep(0.01)
+        out = LSXFile(self.lstfile)
+        out.write(-1, 100, "ptcls.hdf")
+        out = None
+        lsx2 = LSXFile.cached(self.lstfile)
+        self.assertFalse(lsx is lsx2)
+        self.assertEqual(101, lsx2.n)
+
+    def test_cached_rewrite(self):
+        """test LSXFile.cached after a same-size rewrite ...."""
+        save_lst_params(self.params, self.lstfile)
+        lsx = LSXFile.cached(self.lstfile)
+        self.assertRaises(Exception, lsx.write, 0, 1, "ptcls.hdf")
+
+        # no sleep, so the modification time and size may be unchanged
+        out = LSXFile(self.lstfile)
+        out.write(5, 6, "ptcls.hdf", {"score":-2.5, "class":1})
+        out = None
+        self.assertEqual(6, LSXFile.cached(self.lstfile).read(5)[0])
+
+        with LSXWriter(self.lstfile) as out:
+            for d in self.params: out.write(d["idx"]+1, d["src"], {"score":d["score"], "class":d["class"]})
+        self.assertEqual(6, LSXFile.cached(self.lstfile).read(5)[0])
+
+    def test_sidecar(self):
+        """test binary metadata sidecar ...................."""
+        self.params[3]["xform.projection"] = Transform({"type":"eman", "az":10, "alt":20, "phi":30, "tx":1.5})
+        self.params[4]["comment"] = "some text"
+        save_lst_params(self.params, self.lstfile, sidecar=True)
+        self.assertTrue(os.path.isfile(lst_sidecar_path(self.lstfile)))
+
+        cols = load_lst_arrays(self.lstfile)
+        self.assertEqual(100, len(cols["idx"]))
+        self.assertAlmostEqual(-2.5, cols["score"][5], 5)
+        self.assertEqual(1, cols["class"][5])
+        self.assertTrue(cols["has:xform.projection"][3])
+        self.assertFalse(cols["has:xform.projection"][2])
+
+        params = load_lst_params(self.lstfile)
+        self.assertEqual(self.params[4], params[4])
+        self.assertEqual(self.params[3]["xform.projection"].get_matrix(), params[3]["xform.projection"].get_matrix())
+        self.assertFalse("xform.projection" in params[2])
+
+        # writing to the file removes the now stale sidecar
+        out = LSXFile(self.lstfile)
+        out.write(0, 12, "ptcls.hdf", {"score":3.0})
+        out = None
+        self.assertFalse(os.path.isfile(lst_sidecar_path(self.lstfile)))
+        self.assertEqual(12, load_lst_params(self.lstfile)[0]["idx"])
+        testlib.safe_unlink(lst_sidecar_path(self.lstfile))
+
+    def test_sidecar_append(self):
+        """test sidecar when appending to an existing file ."""
+        save_lst_params(self.params[:60], self.lstfile, sidecar=True)
+        save_lst_params(self.params[60:], self.lstfile, overwrite=False, sidecar=True)
+        self.assertTrue(os.path.isfile(lst_sidecar_path(self.lstfile)))
+        self.assertEqual(self.params, load_lst_params(self.lstfile))
+        self.assertEqual(100, len(load_lst_arrays(self.lstfile)["idx"]))
+        testlib.safe_unlink(lst_sidecar_path(self.lstfile))
+
+    def test_write_many(self):
+        """test LSXFile.write_many and LSXWriter ............"""
+        with LSXWriter(self.lstfile) as out:
+            for d in self.params[:50]:
+                out.write(d["idx"], d["src"], {"score":d["score"], "class":d["class"]})
+        self.assertEqual(self.params[:50], load_lst_params(self.lstfile))
+
+        lsx = LSXFile(self.lstfile)
+        lsx.write_many([(d["idx"], d["src"], {"score":d["score"], "class":d["class"]}) for d in self.params[50:]])
+        lsx.write_many([(7, "ptcls.hdf", {"a_much_longer_key_forcing_a_rewrite":1})])
+        lsx = None
+        params = load_lst_params(self.lstfile)
+        self.assertEqual(self.params, params[:100])
+        self.assertEqual({"src":"ptcls.hdf", "idx":7, "a_much_longer_key_forcing_a_rewrite":1}, params[100])
+
+def test_main():
+    p = OptionParser()
+    p.add_option('--t', action='store_true', help='test exception', default=False )
+    global IS_TEST_EXCEPTION
+    opt, args = p.parse_args()
+    if opt.t:
+        IS_TEST_EXCEPTION = True
+    Log.logger().set_level(-1)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestLSXFile)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+    test_main()
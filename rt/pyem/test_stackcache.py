@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2000-2006 Baylor College of Medicine
+#
+# This software is issued under a joint BSD/GNU license. You may use the
+# source code in this file under either license. However, note that the
+# complete EMAN2 and SPARX software packages have some GPL dependencies,
+# so you are responsible for compliance with the licenses of these packages
+# if you opt to use BSD licensing. The warranty disclaimer below holds
+# in either instance.
+#
+# This complete copyright notice must be included in any revised version of the
+# source code. Additional authorship citations may be added, but existing
+# author citations must be preserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  2111-1307 USA
+#
+#
+
+from EMAN2 import *
+from EMAN2PAR import EMStackCache
+import unittest
+import testlib
+import time
+import numpy as np
+from optparse import OptionParser
+
+IS_TEST_EXCEPTION = False
+
+class TestStackCache(unittest.TestCase):
+    """this is the unit test for the EMStackCache class"""
+
+    def setUp(self):
+        self.imgfile = "test_stackcache.hdf"
+        self.lstfile = "test_stackcache.lst"
+        self.procs = [("math.fft.resample", {"n":2})]
+        testlib.safe_unlink(self.imgfile)
+        for i in range(5):
+            e = test_image(0, (32,32))
+            e.mult(i+1.0)
+            e.write_image(self.imgfile, i)
+        save_lst_params([{"src":self.imgfile, "idx":i, "score":-i*0.5} for i in (4,3,2,1,0)], self.lstfile)
+
+    def tearDown(self):
+        EMStackCache(self.lstfile, self.procs, ".").remove()
+        EMStackCache(self.imgfile, self.procs, ".").remove()
+        testlib.safe_unlink(self.lstfile)
+        testlib.safe_unlink(self.imgfile)
+
+    def test_build_get(self):
+        """test EMStackCache build/get ......................"""
+        cache = EMStackCache(self.lstfile, self.procs, ".")
+        self.assertFalse(cache.exists())
+        cache.build()
+        self.assertTrue(cache.exists())
+        self.assertEqual(5, len(cache))
+        for i in range(5):
+            im = EMData(self.lstfile, i)
+            im.process_inplace(*self.procs[0])
+            c = cache.get(i)
+            self.assertEqual((16,16), (c["nx"], c["ny"]))
+            self.assertTrue(np.allclose(im.numpy(), c.numpy(), atol=1e-4))
+            self.assertAlmostEqual(-i*0.5, c["score"], 5)
+
+        # the header file stays open between calls, and is closed by remove()
+        hdrf = EMStackCache.open_caches[cache.base][2]
+        cache.get(0)
+        self.assertTrue(hdrf is EMStackCache.open_caches[cache.base][2])
+        cache.remove()
+        self.assertTrue(hdrf.closed)
+        self.assertFalse(cache.exists())
+
+    def test_stale_source(self):
+        """test rebuild when a referenced file changes ......"""
+        cache = EMStackCache(self.lstfile, self.procs, ".")
+        cache.build()
+        self.assertTrue(cache.get(4)["mean"] > 0)
+
+        # the .lst is unchanged, but the particles it refers to are not
+        time.sleep(0.01)
+        for i in range(5):
+            e = test_image(0, (32,32))
+            e.mult(-1.0)
+            e.write_image(self.imgfile, i)
+        cache = EMStackCache(self.lstfile, self.procs, ".")
+        cache.build()
+        self.assertTrue(cache.get(4)["mean"] < 0)
+
+    def test_empty(self):
+        """test EMStackCache of an empty stack .............."""
+        with LSXWriter(self.lstfile) as out: pass
+        cache = EMStackCache(self.lstfile, self.procs, ".")
+        cache.build()
+        self.assertTrue(cache.exists())
+        self.assertEqual(0, len(cache))
+
+def test_main():
+    p = OptionParser()
+    p.add_option('--t', action='store_true', help='test exception', default=False )
+    global IS_TEST_EXCEPTION
+    opt, args = p.parse_args()
+    if opt.t:
+        IS_TEST_EXCEPTION = True
+    Log.logger().set_level(-1)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestStackCache)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+    test_main()
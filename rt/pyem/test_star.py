@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2000-2006 Baylor College of Medicine
+#
+# This software is issued under a joint BSD/GNU license. You may use the
+# source code in this file under either license. However, note that the
+# complete EMAN2 and SPARX software packages have some GPL dependencies,
+# so you are responsible for compliance with the licenses of these packages
+# if you opt to use BSD licensing. The warranty disclaimer below holds
+# in either instance.
+#
+# This complete copyright notice must be included in any revised version of the
+# source code. Additional authorship citations may be added, but existing
+# author citations must be preserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  2111-1307 USA
+#
+#
+
+
+from EMAN2star import StarFile, StarFile3, iter_loop
+import numpy as np
+import os
+import unittest
+from optparse import OptionParser
+
+IS_TEST_EXCEPTION = False
+
+def safe_unlink(filename):
+    """the STAR modules don't need EMAN2, so neither should their tests (testlib imports it)"""
+    if os.path.exists(filename): os.unlink(filename)
+
+STARTXT = """
+data_optics
+
+loop_
+_rlnOpticsGroup #1
+_rlnOpticsGroupName #2
+_rlnVoltage #3
+1 opticsGroup1 300.0
+2 opticsGroup2 300.0
+
+data_particles
+
+_note 'two words'
+
+loop_
+_rlnImageName #1
+_rlnDefocusU #2
+_rlnOpticsGroup #3
+"""
+
+class TestStarFile(unittest.TestCase):
+    """this is the unit test for the STAR file readers and writers"""
+
+    def setUp(self):
+        self.starfile = "test_star.star"
+        self.outfile = "test_star_out.star"
+        with open(self.starfile, "w") as out:
+            out.write(STARTXT)
+            for i in range(1000):
+                out.write("%06d@Particles/a.mrcs %1.1f %d\n"%(i+1, 10000+i*0.5, i%2+1))
+
+    def tearDown(self):
+        safe_unlink(self.starfile)
+        safe_unlink(self.outfile)
+
+    def test_read(self):
+        """test StarFile read ..............................."""
+        star = StarFile(self.starfile, "data_particles")
+        self.assertEqual("two words", star["note"])
+        self.assertEqual(1000, len(star["rlnImageName"]))
+        self.assertEqual("000003@Particles/a.mrcs", star["rlnImageName"][2])
+        self.assertEqual(10001.0, star["rlnDefocusU"][2])
+        self.assertEqual([1, 2, 1], star["rlnOpticsGroup"][:3])
+
+    def test_read3(self):
+        """test StarFile3 typed columns ....................."""
+        star = StarFile3(self.starfile)
+        self.assertEqual(["optics", "particles"], sorted(star.keys()))
+        self.assertEqual(np.int64, star["particles"]["rlnOpticsGroup"].dtype)
+        self.assertEqual(np.float64, star["particles"]["rlnDefocusU"].dtype)
+        self.assertEqual(["opticsGroup1", "opticsGroup2"], star["optics"]["rlnOpticsGroupName"])
+
+    def test_write(self):
+        """test StarFile3 write/read round trip ............."""
+        star = StarFile3(self.starfile)
+        star.writefile(self.outfile)
+        star2 = StarFile3(self.outfile)
+        self.assertEqual(star.loops, star2.loops)
+        for blk in star:
+            for k in star[blk]:
+                self.assertTrue(np.array_equal(np.asarray(star[blk][k]), np.asarray(star2[blk][k])))
+
+        star = StarFile(self.starfile, "data_particles")
+        star.writefile(self.outfile)
+        self.assertEqual(star, StarFile(self.outfile))
+
+    def test_write_blocks(self):
+        """test StarFile write of merged data_ blocks ......."""
+        star = StarFile(self.starfile)
+        self.assertEqual(1000, len(star["rlnOpticsGroup"]))		# the particles loop replaces the optics column of the same name
+        star["rlnDefocusU"][0] = 12345.0
+        star.writefile(self.outfile)
+
+        # still separate optics and particles blocks, as Relion 3.1 requires
+        star3 = StarFile3(self.outfile)
+        self.assertEqual(["optics", "particles"], sorted(star3.keys()))
+        self.assertEqual([1, 2], star3["optics"]["rlnOpticsGroup"].tolist())
+        self.assertEqual(1000, len(star3["particles"]["rlnOpticsGroup"]))
+        self.assertEqual("two words", star3["particles"]["note"])
+        self.assertEqual(12345.0, star3["particles"]["rlnDefocusU"][0])
+        self.assertEqual(star, StarFile(self.outfile))
+
+    def test_iter_loop(self):
+        """test iter_loop streaming ........................."""
+        chunks = list(iter_loop(self.starfile, "rlnImageName", chunksize=300))
+        self.assertEqual([300, 300, 300, 100], [len(c["rlnDefocusU"]) for c in chunks])
+        self.assertEqual(10000.0 + 999*0.5, chunks[-1]["rlnDefocusU"][-1])
+        optics = list(iter_loop(self.starfile, dataname="optics"))
+        self.assertEqual([300.0, 300.0], optics[0]["rlnVoltage"].tolist())
+
+    def test_iter_loop_types(self):
+        """test iter_loop column types match between chunks ."""
+        with open(self.starfile, "w") as out:
+            out.write("data_\n\nloop_\n_rlnCoordinateX #1\n_rlnMicrographName #2\n")
+            for i in range(10): out.write("%d mic%d.mrc\n"%(i, i))
+            for i in range(10): out.write("%1.1f %d\n"%(i+0.5, i))
+        chunks = list(iter_loop(self.starfile, chunksize=10))
+        self.assertEqual(2, len(chunks))
+        for c in chunks:
+            self.assertEqual(np.float64, c["rlnCoordinateX"].dtype)
+            self.assertTrue(isinstance(c["rlnMicrographName"], list))
+        self.assertEqual("3", chunks[1]["rlnMicrographName"][3])
+        self.assertEqual(3.5, chunks[1]["rlnCoordinateX"][3])
+
+def test_main():
+    p = OptionParser()
+    p.add_option('--t', action='store_true', help='test exception', default=False )
+    global IS_TEST_EXCEPTION
+    opt, args = p.parse_args()
+    if opt.t:
+        IS_TEST_EXCEPTION = True
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestStarFile)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+    test_main()
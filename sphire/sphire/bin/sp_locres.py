@@ -126,7 +126,7 @@ def run():
     progname = optparse.os.path.basename(arglist[0])
     usage = (
         progname
-        + """ firstvolume  secondvolume  maskfile  directory  --prefix  --wn  --step  --cutoff  --radius  --fsc  --res_overall  --out_ang_res  --apix  --MPI
+        + """ firstvolume  secondvolume  maskfile  directory  --prefix  --wn  --step  --cutoff  --radius  --fsc  --res_overall  --out_ang_res  --apix  --MPI  --threads
 
 	Compute local resolution in real space within area outlined by the maskfile and within regions wn x wn x wn
 	"""
@@ -190,6 +190,12 @@ def run():
     parser.add_option(
         "--MPI", action="store_true", default=False, help="Use MPI version."
     )
+    parser.add_option(
+        "--threads",
+        type="int",
+        default=0,
+        help="Number of processes used by the non-MPI version, which share the volumes on a single computer. (default 0, one per core, limited by the available memory)",
+    )
 
     (options, args) = parser.parse_args(arglist[1:])
 
@@ -303,68 +309,10 @@ def run():
             optparse.os.makedirs(outdir)
         sp_global_def.write_command(outdir)
 
-        mc = sp_utilities.model_blank(nn, nn, nn, 1.0) - m
-
-        vf = sp_fundamentals.fft(vi)
-        uf = sp_fundamentals.fft(ui)
-        """Multiline Comment1"""
-        lp = int(old_div(old_div(nn, 2), options.step) + 0.5)
-        step = old_div(0.5, lp)
-
-        freqvol = sp_utilities.model_blank(nn, nn, nn)
-        resolut = []
-        for i in range(1, lp):
-            fl = step * i
-            fh = fl + step
-            # print(lp,i,step,fl,fh)
-            v = sp_fundamentals.fft(sp_filter.filt_tophatb(vf, fl, fh))
-            u = sp_fundamentals.fft(sp_filter.filt_tophatb(uf, fl, fh))
-            tmp1 = EMAN2_cppwrap.Util.muln_img(v, v)
-            tmp2 = EMAN2_cppwrap.Util.muln_img(u, u)
-
-            do = EMAN2_cppwrap.Util.infomask(
-                sp_morphology.square_root(
-                    sp_morphology.threshold(EMAN2_cppwrap.Util.muln_img(tmp1, tmp2))
-                ),
-                m,
-                True,
-            )[0]
-
-            tmp3 = EMAN2_cppwrap.Util.muln_img(u, v)
-            dp = EMAN2_cppwrap.Util.infomask(tmp3, m, True)[0]
-            resolut.append([i, old_div((fl + fh), 2.0), old_div(dp, do)])
-
-            tmp1 = EMAN2_cppwrap.Util.box_convolution(tmp1, nk)
-            tmp2 = EMAN2_cppwrap.Util.box_convolution(tmp2, nk)
-            tmp3 = EMAN2_cppwrap.Util.box_convolution(tmp3, nk)
-
-            EMAN2_cppwrap.Util.mul_img(tmp1, tmp2)
-
-            tmp1 = sp_morphology.square_root(sp_morphology.threshold(tmp1))
-
-            EMAN2_cppwrap.Util.mul_img(tmp1, m)
-            EMAN2_cppwrap.Util.add_img(tmp1, mc)
-
-            EMAN2_cppwrap.Util.mul_img(tmp3, m)
-            EMAN2_cppwrap.Util.add_img(tmp3, mc)
-
-            EMAN2_cppwrap.Util.div_img(tmp3, tmp1)
-
-            EMAN2_cppwrap.Util.mul_img(tmp3, m)
-            freq = old_div((fl + fh), 2.0)
-            bailout = True
-            for x in range(nn):
-                for y in range(nn):
-                    for z in range(nn):
-                        if m.get_value_at(x, y, z) > 0.5:
-                            if freqvol.get_value_at(x, y, z) == 0.0:
-                                if tmp3.get_value_at(x, y, z) < cutoff:
-                                    freqvol.set_value_at(x, y, z, freq)
-                                    bailout = False
-                                else:
-                                    bailout = False
-            if bailout:
-                break
+        freqvol, resolut = sp_statistics.locres_shared(
+            vi, ui, m, nk, cutoff, options.step, options.threads
+        )
+
         # print(len(resolut))
         # remove outliers
         output_volume(
@@ -49,6 +49,7 @@ from . import sp_fundamentals
 from . import sp_global_def
 from . import sp_morphology
 from . import sp_utilities
+from EMAN2locres import locres_shell, locres_shared
 import sys
 from itertools import zip_longest
 from future import standard_library
@@ -592,53 +593,7 @@ def locres(vi, ui, m, nk, cutoff, step, myid, main_node, number_of_proc):
     lp = (lt + 1) * number_of_proc
     bailout = 0
     for i in range(myid, lp, number_of_proc):
-        fl = step * i
-        fh = fl + step
-        freq = old_div((fl + fh), 2.0)
-        # print number_of_proc,myid,lp,i,step,fl,fh,freq
-
-        if i > 0:
-            v = sp_fundamentals.fft(sp_filter.filt_tophatb(vf, fl, fh))
-            u = sp_fundamentals.fft(sp_filter.filt_tophatb(uf, fl, fh))
-            tmp1 = EMAN2_cppwrap.Util.muln_img(v, v)
-            tmp2 = EMAN2_cppwrap.Util.muln_img(u, u)
-            tmp3 = EMAN2_cppwrap.Util.muln_img(u, v)
-            do = EMAN2_cppwrap.Util.infomask(
-                sp_morphology.square_root(
-                    sp_morphology.threshold(EMAN2_cppwrap.Util.muln_img(tmp1, tmp2))
-                ),
-                m,
-                True,
-            )[0]
-            dp = EMAN2_cppwrap.Util.infomask(tmp3, m, True)[0]
-            # print "dpdo   ",myid,dp,do
-            if do == 0.0:
-                dis = [freq, 0.0]
-            else:
-                dis = [freq, old_div(dp, do)]
-        else:
-            tmp1 = sp_utilities.model_blank(nx, ny, nz, 1.0)
-            tmp2 = sp_utilities.model_blank(nx, ny, nz, 1.0)
-            tmp3 = sp_utilities.model_blank(nx, ny, nz, 1.0)
-            dis = [freq, 1.0]
-
-        tmp1 = EMAN2_cppwrap.Util.box_convolution(tmp1, nk)
-        tmp2 = EMAN2_cppwrap.Util.box_convolution(tmp2, nk)
-        tmp3 = EMAN2_cppwrap.Util.box_convolution(tmp3, nk)
-
-        EMAN2_cppwrap.Util.mul_img(tmp1, tmp2)
-
-        tmp1 = sp_morphology.square_root(sp_morphology.threshold(tmp1))
-
-        EMAN2_cppwrap.Util.mul_img(tmp1, m)
-        EMAN2_cppwrap.Util.add_img(tmp1, mc)
-
-        EMAN2_cppwrap.Util.mul_img(tmp3, m)
-        EMAN2_cppwrap.Util.add_img(tmp3, mc)
-
-        EMAN2_cppwrap.Util.div_img(tmp3, tmp1)
-
-        EMAN2_cppwrap.Util.mul_img(tmp3, m)
+        tmp3, dis = locres_shell(vf, uf, m, mc, nk, i, step)
 
         mpi.mpi_barrier(mpi.MPI_COMM_WORLD)
 
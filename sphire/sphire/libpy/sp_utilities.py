@@ -3456,6 +3456,23 @@ def update_tag(
 
 # ===================================== WRAPPER FOR MPI
 
+# MPI counts are C ints; larger messages are split in pieces of this many bytes
+mpi_chunk_bytes = 1 << 30
+
+# EMData header entries that are recomputed from the data, not sent by wrap_mpi_bcast
+mpi_bcast_skip_attrs = (
+    "nx",
+    "ny",
+    "nz",
+    "minimum",
+    "maximum",
+    "mean",
+    "sigma",
+    "square_sum",
+    "mean_nonzero",
+    "sigma_nonzero",
+)
+
 
 def wrap_mpi_send(data, destination, communicator=None):
 
@@ -3491,69 +3508,195 @@ def wrap_mpi_recv(source, communicator=None):
     print([msg[i:i+1] for i in range(len(msg))])
     print([msg[i:i+1].decode('latin1') for i in range(len(msg))])'''
 
-def wrap_mpi_bcast(data, root, communicator=None):
+def mpi_bytes(buf):
+    """Raw bytes of a buffer returned by an MPI_CHAR call"""
 
-    if communicator == None:
-        communicator = mpi.MPI_COMM_WORLD
+    if isinstance(buf, numpy.ndarray):
+        return buf.tobytes()
+    return b"".join([entry if entry != b"" else b"\x00" for entry in buf])
 
-    rank = mpi.mpi_comm_rank(communicator)
-
-    if rank == root:
-        msg = pack_message(data)
-        n = struct.pack("I", len(msg))
 
-    else:
-        msg = None
-        n = None
+def mpi_char_view(data):
+    """Flat MPI_CHAR (S1) view of a bytes object or numpy array, without copying"""
 
-    sizeofdata = mpi.mpi_bcast(
-        n, 4, mpi.MPI_CHAR, root, communicator
-    )  # int MPI_Bcast ( void *buffer, int count, MPI_Datatype datatype, int root, MPI_Comm comm ).
+    if isinstance(data, bytes):
+        return numpy.frombuffer(data, dtype="S1")
+    return numpy.ascontiguousarray(data).reshape(-1).view("S1")
 
-    if mpi.mpi_comm_rank(communicator) == root:
-        sizeofdata = n
-    else:
-        sizeofdata = b''.join([entry if entry != b'' else b'\x00' for entry in sizeofdata])
 
-    n = struct.unpack("I", sizeofdata)[0]
-    msgtobcast = mpi.mpi_bcast(
-        msg, n, mpi.MPI_CHAR, root, communicator
-    )  # int MPI_Bcast ( void *buffer, int count, MPI_Datatype datatype, int root, MPI_Comm comm )
+def mpi_bcast_bytes(buf, nbytes, root, communicator):
+    """
+	Broadcast nbytes of raw data from root, split in MPI calls of at most
+	mpi_chunk_bytes each.  buf (bytes or numpy array) is only used on root.
+	Returns a flat S1 array with the data on every process.
+	"""
 
-    if mpi.mpi_comm_rank(communicator) == root:
-        msgtobcast = msg
+    rank = mpi.mpi_comm_rank(communicator)
+    if rank == root:
+        out = mpi_char_view(buf)
     else:
-        msgtobcast = b''.join([entry if entry != b'' else b'\x00' for entry in msgtobcast])
+        out = numpy.empty(nbytes, dtype="S1")
+    for start in range(0, nbytes, mpi_chunk_bytes):
+        count = min(mpi_chunk_bytes, nbytes - start)
+        if rank == root:
+            mpi.mpi_bcast(
+                out[start : start + count], count, mpi.MPI_CHAR, root, communicator
+            )
+        else:
+            out[start : start + count] = mpi.mpi_bcast(
+                None, count, mpi.MPI_CHAR, root, communicator
+            )
+    return out
 
-    return unpack_message(msgtobcast)
 
+def mpi_gatherv_bytes(buf, root, communicator):
+    """
+	Gather a variable length buffer (bytes or numpy array) from every process
+	of the communicator to root.  Returns on root the list of flat S1 arrays
+	received from each process in rank order, None elsewhere.  The transfer
+	is done in rounds in which no process contributes more than
+	mpi_chunk_bytes/nproc bytes, so any message size is supported.
+	"""
+
+    rank = mpi.mpi_comm_rank(communicator)
+    procs = mpi.mpi_comm_size(communicator)
+    buf = mpi_char_view(buf)
+
+    sizes = mpi.mpi_gather(
+        mpi_char_view(struct.pack("=q", len(buf))),
+        8,
+        mpi.MPI_CHAR,
+        8,
+        mpi.MPI_CHAR,
+        root,
+        communicator,
+    )
+    if rank == root:
+        sizes = mpi_bytes(sizes)
+    sizes = mpi_bcast_bytes(sizes, 8 * procs, root, communicator)
+    sizes = struct.unpack("=%dq" % procs, sizes.tobytes())
 
-# data must be a python list (numpy array also should be implemented)
+    step = max(mpi_chunk_bytes // procs, 1)
+    nrounds = (max(sizes) + step - 1) // step
+    if rank == root:
+        out = [numpy.empty(size, dtype="S1") for size in sizes]
+    else:
+        out = None
+    for k in range(nrounds):
+        start = k * step
+        counts = [min(max(size - start, 0), step) for size in sizes]
+        displs = [0] * procs
+        for p in range(1, procs):
+            displs[p] = displs[p - 1] + counts[p - 1]
+        recv = mpi.mpi_gatherv(
+            buf[start : start + counts[rank]],
+            counts[rank],
+            mpi.MPI_CHAR,
+            counts,
+            displs,
+            mpi.MPI_CHAR,
+            root,
+            communicator,
+        )
+        if rank == root:
+            for p in range(procs):
+                out[p][start : start + counts[p]] = recv[
+                    displs[p] : displs[p] + counts[p]
+                ]
+    return out
 
 
-def wrap_mpi_gatherv(data, root, communicator=None):
+def wrap_mpi_bcast(data, root, communicator=None):
+    """
+	Broadcast data from root to all processes of the communicator.
+	numpy arrays and EMData objects are sent as raw binary buffers, anything
+	else is packed with pack_message.  Large messages are split in chunks,
+	so there is no 2 GB limit.  Every process, root included, gets its own copy.
+	"""
 
     if communicator == None:
         communicator = mpi.MPI_COMM_WORLD
 
     rank = mpi.mpi_comm_rank(communicator)
-    procs = mpi.mpi_comm_size(communicator)
 
-    out_array = None
     if rank == root:
-        if type(data) is list:
-            out_array = []
-            for p in range(procs):
-                if p == rank:
-                    out_array.extend(data)
-                else:
-                    recv_data = wrap_mpi_recv(p, communicator)
-                    out_array.extend(recv_data)
+        if isinstance(data, numpy.ndarray) and not data.dtype.hasobject:
+            kind = 1
+            array = data
+            msg = pack_message((data.dtype.str, data.shape))
+        elif isinstance(data, EMAN2.EMData):
+            kind = 2
+            array = get_image_data(data)
+            attrs = data.get_attr_dict()
+            for key in mpi_bcast_skip_attrs:
+                attrs.pop(key, None)
+            msg = pack_message(
+                (array.shape, data.is_complex(), data.is_ri(), attrs)
+            )
         else:
-            raise Exception("wrap_mpi_gatherv: type of data not supported")
+            kind = 0
+            array = numpy.empty(0, dtype="S1")
+            msg = pack_message(data)
+        head = struct.pack("=iqq", kind, len(msg), array.nbytes)
     else:
-        wrap_mpi_send(data, root, communicator)
+        msg = None
+        array = None
+        head = None
+
+    head = mpi_bcast_bytes(head, 20, root, communicator)
+    kind, nmsg, nbytes = struct.unpack("=iqq", head.tobytes())
+    info = unpack_message(mpi_bcast_bytes(msg, nmsg, root, communicator).tobytes())
+    if kind == 0:
+        return info
+
+    buf = mpi_bcast_bytes(array, nbytes, root, communicator)
+    if kind == 1:
+        dtype, shape = info
+        if rank == root:
+            return data.copy()
+        return buf.view(dtype).reshape(shape)
+
+    shape, is_complex, is_ri, attrs = info
+    if rank == root:
+        return data.copy()
+    img = numpy2em_python(buf.view(numpy.float32).reshape(shape))
+    img.set_complex(is_complex)
+    img.set_ri(is_ri)
+    img.set_attr_dict(attrs)
+    return img
 
+
+def wrap_mpi_gatherv(data, root, communicator=None):
+    """
+	Gather data from all processes of the communicator on root, in rank order.
+	data is either a python list, in which case root gets the concatenated
+	list, or a numpy array, in which case root gets the arrays concatenated
+	along the first axis (all processes must use the same dtype and trailing
+	shape).  Every process must pass the same type.  Returns None except on root.
+	"""
+
+    if communicator == None:
+        communicator = mpi.MPI_COMM_WORLD
+
+    rank = mpi.mpi_comm_rank(communicator)
+
+    if isinstance(data, numpy.ndarray) and not data.dtype.hasobject:
+        parts = mpi_gatherv_bytes(data, root, communicator)
+        if rank != root:
+            return None
+        shape = (-1,) + data.shape[1:]
+        return numpy.concatenate(
+            [part.view(data.dtype).reshape(shape) for part in parts]
+        )
+
+    if rank == root and type(data) is not list:
+        raise Exception("wrap_mpi_gatherv: type of data not supported")
+    parts = mpi_gatherv_bytes(pack_message(data), root, communicator)
+    if rank != root:
+        return None
+    out_array = []
+    for part in parts:
+        out_array.extend(unpack_message(part.tobytes()))
     return out_array
 
 
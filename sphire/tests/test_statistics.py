@@ -2294,7 +2294,32 @@ class Test_locres(unittest.TestCase):
         """
 
 
-
+class Test_locres_shared(unittest.TestCase):
+    nx = 32
+
+    def volumes(self):
+        from sphire.sphire.libpy.sp_utilities import model_gauss_noise
+        vi = model_gauss_noise(1.0, self.nx, self.nx, self.nx)
+        ui = vi + model_gauss_noise(0.5, self.nx, self.nx, self.nx)
+        m = model_circle(self.nx // 2 - 4, self.nx, self.nx, self.nx)
+        return vi, ui, m
+
+    def test_processes_give_same_result(self):
+        vi, ui, m = self.volumes()
+        freqvol1, resolut1 = fu.locres_shared(vi, ui, m, 5, 0.5, 1.0, 1)
+        freqvol2, resolut2 = fu.locres_shared(vi, ui, m, 5, 0.5, 1.0, 3)
+        self.assertTrue(array_equal(freqvol1.get_3dview(), freqvol2.get_3dview()))
+        self.assertTrue(allclose(resolut1, resolut2))
+        self.assertEqual(len(resolut1), self.nx // 2)
+
+    def test_same_as_locres_below_nyquist(self):
+        vi, ui, m = self.volumes()
+        freqvol, resolut = fu.locres_shared(vi.copy(), ui.copy(), m, 5, 0.5, 1.0, 2)
+        freqvol_mpi, resolut_mpi = fu.locres(vi.copy(), ui.copy(), m, 5, 0.5, 1.0, 0, 0, 1)
+        a = freqvol_mpi.get_3dview()
+        valid = a < 0.5  # locres also assigns shells beyond Nyquist
+        self.assertTrue(allclose(freqvol.get_3dview()[valid], a[valid]))
+        self.assertTrue(allclose(resolut, resolut_mpi, atol=1.0e-5))
 
 
 class Test_k_means_match_clusters_asg_new(unittest.TestCase):
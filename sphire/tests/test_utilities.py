@@ -63,6 +63,7 @@ from __future__ import division
 from os import path, mkdir
 from mpi import *
 import sp_global_def
+import numpy
 from numpy import allclose, array_equal
 from numpy import full as numpy_full
 from numpy import float32 as numpy_float32
@@ -18917,6 +18918,125 @@ class Test_wrap_mpi_gatherv(unittest.TestCase):
         """
 
 
+class Test_wrap_mpi_bcast_binary(unittest.TestCase):
+    """ numpy arrays and EMData are sent as raw buffers, split in pieces of mpi_chunk_bytes"""
+
+    def setUp(self):
+        self.chunk_bytes = fu.mpi_chunk_bytes
+
+    def tearDown(self):
+        fu.mpi_chunk_bytes = self.chunk_bytes
+
+    def bcast(self, data):
+        return fu.wrap_mpi_bcast(
+            data if mpi_comm_rank(MPI_COMM_WORLD) == 0 else None,
+            root=0,
+            communicator=MPI_COMM_WORLD,
+        )
+
+    def check_array(self, data):
+        return_new = self.bcast(data)
+        self.assertEqual(return_new.dtype, data.dtype)
+        self.assertEqual(return_new.shape, data.shape)
+        self.assertTrue(array_equal(return_new, data))
+        self.assertFalse(numpy.shares_memory(return_new, data))
+
+    def check_image(self, data):
+        return_new = self.bcast(data)
+        self.assertEqual(return_new.is_complex(), data.is_complex())
+        self.assertEqual(return_new.is_ri(), data.is_ri())
+        self.assertEqual(return_new.get_xsize(), data.get_xsize())
+        self.assertEqual(return_new.get_ysize(), data.get_ysize())
+        self.assertEqual(return_new.get_attr("apix_x"), data.get_attr("apix_x"))
+        self.assertTrue(
+            array_equal(fu.get_image_data(return_new), fu.get_image_data(data))
+        )
+
+    def test_ndarray(self):
+        self.check_array(numpy.arange(60, dtype=numpy.float64).reshape(3, 4, 5))
+        self.check_array(numpy.arange(12, dtype=numpy.int16).reshape(3, 4).T)
+
+    def test_empty_ndarray(self):
+        self.check_array(numpy.zeros((0, 3), dtype=numpy.int32))
+
+    def test_real_EMData(self):
+        img = fu.model_gauss_noise(1.0, 16, 12)
+        img.set_attr("apix_x", 1.5)
+        self.check_image(img)
+
+    def test_complex_EMData(self):
+        img = fu.model_gauss_noise(1.0, 16, 12).do_fft()
+        img.set_attr("apix_x", 1.5)
+        self.check_image(img)
+
+    def test_multiple_chunks(self):
+        fu.mpi_chunk_bytes = 7
+        self.check_array(numpy.arange(100, dtype=numpy.float32))
+        img = fu.model_gauss_noise(1.0, 16, 12)
+        img.set_attr("apix_x", 1.5)
+        self.check_image(img)
+        data = {"a": list(range(100)), "b": "I am a string!!!"}
+        self.assertEqual(self.bcast(data), data)
+
+    def test_bytes_split_in_chunks(self):
+        fu.mpi_chunk_bytes = 3
+        data = bytes(bytearray(range(256))) * 2
+        return_new = fu.mpi_bcast_bytes(data, len(data), 0, MPI_COMM_WORLD)
+        self.assertEqual(return_new.tobytes(), data)
+
+
+class Test_wrap_mpi_gatherv_binary(unittest.TestCase):
+    """ numpy arrays are gathered as raw buffers and concatenated along the first axis"""
+
+    def setUp(self):
+        self.chunk_bytes = fu.mpi_chunk_bytes
+        self.rank = mpi_comm_rank(MPI_COMM_WORLD)
+        self.nproc = mpi_comm_size(MPI_COMM_WORLD)
+
+    def tearDown(self):
+        fu.mpi_chunk_bytes = self.chunk_bytes
+
+    def check_gather(self):
+        # process p sends p+1 rows filled with p
+        return_new = fu.wrap_mpi_gatherv(
+            data=numpy_full((self.rank + 1, 3), self.rank, dtype=numpy.int64),
+            root=0,
+            communicator=MPI_COMM_WORLD,
+        )
+        if self.rank != 0:
+            self.assertTrue(return_new is None)
+            return
+        expected = numpy.concatenate(
+            [numpy_full((p + 1, 3), p, dtype=numpy.int64) for p in range(self.nproc)]
+        )
+        self.assertEqual(return_new.dtype, expected.dtype)
+        self.assertTrue(array_equal(return_new, expected))
+
+    def test_ndarray_concatenation(self):
+        self.check_gather()
+
+    def test_empty_ndarray(self):
+        return_new = fu.wrap_mpi_gatherv(
+            data=numpy.zeros((0, 3), dtype=numpy_float32),
+            root=0,
+            communicator=MPI_COMM_WORLD,
+        )
+        if self.rank == 0:
+            self.assertEqual(return_new.shape, (0, 3))
+
+    def test_multiple_chunks(self):
+        fu.mpi_chunk_bytes = 5
+        self.check_gather()
+        return_new = fu.wrap_mpi_gatherv(
+            data=[self.rank, "s%d" % self.rank], root=0, communicator=MPI_COMM_WORLD
+        )
+        if self.rank == 0:
+            expected = []
+            for p in range(self.nproc):
+                expected.extend([p, "s%d" % p])
+            self.assertEqual(return_new, expected)
+
+
 class Test_get_colors_and_subsets(unittest.TestCase):
     def test_wrong_number_params_too_few_parameters_TypeError(self):
         with self.assertRaises(TypeError) as cm_new: